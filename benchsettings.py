@@ -0,0 +1,16 @@
+import os
+
+from testsettings import *
+
+# python manage.py drip_benchmark --settings=benchsettings
+# set DRIP_BENCH_DATABASE=postgres to run against a local postgres instead
+if os.environ.get('DRIP_BENCH_DATABASE') == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': os.environ.get('DRIP_BENCH_NAME', 'drip_bench'),
+            'USER': os.environ.get('DRIP_BENCH_USER', ''),
+            'PASSWORD': os.environ.get('DRIP_BENCH_PASSWORD', ''),
+            'HOST': os.environ.get('DRIP_BENCH_HOST', ''),
+        },
+    }
@@ -1,10 +1,20 @@
 import base64
 import json
+import logging
 
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.models import User
 
-from drip.models import Drip, SentDrip, QuerySetRule, SubqueryRule, ExcludeSubqueryRule
+from drip.models import Drip, SentDrip, SentDripStat, QuerySetRule, SubqueryRule, ExcludeSubqueryRule, SentDripRule
+from drip.models import AudienceSnapshot, AudienceView
+
+
+BEFORE_VAR = 'before'
+
+logger = logging.getLogger('drip')
 
 
 class QuerySetRuleInline(admin.TabularInline):
@@ -13,15 +23,99 @@ class SubqueryRuleInline(admin.TabularInline):
     model = SubqueryRule
 class ExcludeSubqueryRuleInline(admin.TabularInline):
     model = ExcludeSubqueryRule
+class SentDripRuleInline(admin.TabularInline):
+    model = SentDripRule
+    fk_name = 'drip'
+
+def audience_csv_rows(drips, fields, chunk_size=500):
+    """
+    Yield CSV lines for the current (pruned) audience of each drip. Each
+    audience is evaluated once into an `IdSet`, whose ids are then
+    fetched a chunk at a time.
+    """
+    import csv
+    from drip.idsets import IdSet
+
+    class Echo(object):
+        def write(self, value):
+            return value
+    writer = csv.writer(Echo())
+
+    encode = lambda value: unicode(value).encode('utf-8') if value is not None else ''
+
+    yield writer.writerow(['drip'] + list(fields))
+    for drip in drips:
+        drip = drip.drip
+        try:
+            drip.prune()
+            qs = drip.get_queryset()
+            user_ids = IdSet.from_sorted(qs.order_by('id').values_list('id', flat=True).iterator())
+            users = qs.model._default_manager.using(qs.db).order_by('id')
+        finally:
+            drip.drop_temp_tables()
+
+        for start in xrange(0, len(user_ids), chunk_size):
+            chunk = users.filter(id__in=list(user_ids.ids[start:start + chunk_size])).values_list(*fields)
+            for row in chunk:
+                yield writer.writerow([encode(drip.name)] + [encode(value) for value in row])
+
+def audience_csv_response(drips, fields):
+    try:
+        from django.http import StreamingHttpResponse
+    except ImportError:
+        # older django streams any iterator handed to HttpResponse
+        from django.http import HttpResponse as StreamingHttpResponse
+
+    response = StreamingHttpResponse(audience_csv_rows(drips, fields), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=drip-audience.csv'
+    return response
+
+def export_audience_csv(modeladmin, request, queryset):
+    fields = getattr(settings, 'DRIP_EXPORT_FIELDS', ('id', 'email', 'first_name', 'last_name'))
+    return audience_csv_response(queryset, fields)
+export_audience_csv.short_description = 'Export current audience as CSV'
+
+def refresh_audience_view(modeladmin, request, view):
+    """
+    Refresh view, telling the admin user rather than failing the request
+    when the rules can't be put in a view.
+    """
+    try:
+        view.refresh()
+    except ValueError as e:
+        logger.warning('Could not refresh the audience view of drip %s: %s', view.drip, e)
+        modeladmin.message_user(request, 'Could not refresh the audience view of %s: %s' % (view.drip, e))
+        return False
+    return True
+
+def refresh_audience_views(modeladmin, request, queryset):
+    views = AudienceView.objects.filter(drip__in=queryset)
+    refreshed = len([view for view in views if refresh_audience_view(modeladmin, request, view)])
+    modeladmin.message_user(request, 'Refreshed %d audience view(s).' % refreshed)
+refresh_audience_views.short_description = 'Refresh audience views'
+
 
 class DripAdmin(admin.ModelAdmin):
-    list_display = ('name', 'enabled')
+    list_display = ('name', 'enabled', 'failed')
+    readonly_fields = ('failure_sql',)
+    actions = [export_audience_csv, refresh_audience_views]
     inlines = [
         QuerySetRuleInline,
         SubqueryRuleInline,
         ExcludeSubqueryRuleInline,
+        SentDripRuleInline,
     ]
 
+    def save_related(self, request, form, formsets, change):
+        super(DripAdmin, self).save_related(request, form, formsets, change)
+        # rebuild the audience view once, with every rule saved
+        try:
+            view = AudienceView.objects.get(drip=form.instance)
+        except AudienceView.DoesNotExist:
+            return
+        if view.rules_hash != form.instance.rules_hash():
+            refresh_audience_view(self, request, view)
+
     av = lambda self, view: self.admin_site.admin_view(view)
     def timeline(self, request, drip_id, into_past, into_future):
         """
@@ -53,6 +147,43 @@ class DripAdmin(admin.ModelAdmin):
 
         return HttpResponse(html)
 
+    def snapshots(self, request, drip_id):
+        """
+        List the stored audience snapshots of a drip, with how each one
+        differs from the one before.
+        """
+        from django.shortcuts import render, get_object_or_404
+
+        drip = get_object_or_404(Drip, id=drip_id)
+
+        snapshots = list(AudienceSnapshot.objects.filter(drip=drip))
+        for snapshot, previous in zip(snapshots, snapshots[1:] + [None]):
+            snapshot.added = snapshot.removed = None
+            if previous is not None:
+                added, removed = snapshot.diff(previous)
+                snapshot.added, snapshot.removed = added.count(), removed.count()
+
+        return render(request, 'drip/snapshots.html', locals())
+
+    def view_snapshot(self, request, drip_id, snapshot_id):
+        """
+        Show who joined and left the audience in one snapshot.
+        """
+        from django.shortcuts import render, get_object_or_404
+
+        drip = get_object_or_404(Drip, id=drip_id)
+        snapshot = get_object_or_404(AudienceSnapshot, drip=drip, id=snapshot_id)
+        previous = snapshot.previous()
+
+        if previous is not None:
+            added, removed = snapshot.diff(previous)
+        else:
+            added, removed = snapshot.user_ids(), AudienceSnapshot.objects.none()
+        added_users = User.objects.filter(id__in=list(added[:500]))
+        removed_users = User.objects.filter(id__in=list(removed[:500]))
+
+        return render(request, 'drip/snapshot.html', locals())
+
     #Disabling this feature; if there are too many fields the page is unresponsive.
     #Also, it doesn't work for subqueries
     # def change_view(self, request, object_id, extra_context=None):
@@ -61,10 +192,107 @@ class DripAdmin(admin.ModelAdmin):
     #     extra_context['field_data'] = json.dumps(get_simple_fields(User))
     #     return super(DripAdmin, self).change_view(request, object_id, extra_context=extra_context)
 
+    def preview(self, request, drip_id):
+        """
+        JSON with a quick estimate of the audience size, plus the exact
+        size once a background count has finished.
+        """
+        from django.http import HttpResponse
+        from django.shortcuts import get_object_or_404
+
+        drip = get_object_or_404(Drip, id=drip_id).drip
+        approximate, method = drip.estimate_count()
+
+        data = {
+            'approximate': approximate,
+            'method': method,
+            'exact': drip.exact_count(),
+            'rules_hash': drip.drip_model.rules_hash(),
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+    def export_audience(self, request, drip_id):
+        """
+        Stream the current audience of a drip as CSV, optionally only
+        the comma separated User fields given in ?fields=.
+        """
+        from django.http import HttpResponseBadRequest
+        from django.shortcuts import get_object_or_404
+
+        drip = get_object_or_404(Drip, id=drip_id)
+
+        fields = getattr(settings, 'DRIP_EXPORT_FIELDS', ('id', 'email', 'first_name', 'last_name'))
+        if request.GET.get('fields'):
+            fields = request.GET['fields'].split(',')
+            allowed = [f.name for f in drip.drip.queryset().model._meta.fields]
+            if [f for f in fields if f not in allowed]:
+                return HttpResponseBadRequest('Fields must be some of: %s' % ', '.join(allowed))
+
+        return audience_csv_response([drip], fields)
+
+    def sent_stats(self, request):
+        """
+        SentDripStat rows for the last ?days= days (default 30), optionally
+        only for ?drip=<id>.
+        """
+        from datetime import date, timedelta
+        from django.http import Http404
+
+        try:
+            days = int(request.GET.get('days', 30))
+            drip_id = int(request.GET['drip']) if request.GET.get('drip') else None
+        except ValueError:
+            raise Http404
+
+        since = date.today() - timedelta(days=days)
+        stats = SentDripStat.objects.filter(date__gte=since)
+        if drip_id is not None:
+            stats = stats.filter(drip=drip_id)
+        return since, stats.order_by('-date', 'drip__name').values('drip', 'drip__name', 'date', 'count')
+
+    def stats(self, request):
+        """
+        Sends per drip per day, read only from the SentDripStat rollup.
+        """
+        from django.shortcuts import render
+
+        since, stats = self.sent_stats(request)
+        stats = list(stats)
+
+        totals = {}
+        for stat in stats:
+            totals[stat['drip__name']] = totals.get(stat['drip__name'], 0) + stat['count']
+        totals = sorted(totals.items())
+
+        return render(request, 'drip/stats.html', locals())
+
+    def stats_json(self, request):
+        from django.http import HttpResponse
+
+        since, stats = self.sent_stats(request)
+        data = {
+            'since': since.isoformat(),
+            'stats': [{'drip_id': stat['drip'],
+                       'drip': stat['drip__name'],
+                       'date': stat['date'].isoformat(),
+                       'count': stat['count']} for stat in stats],
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
     def get_urls(self):
         from django.conf.urls.defaults import patterns, url
         urls = super(DripAdmin, self).get_urls()
         my_urls = patterns('',
+            url(
+                r'^stats/$',
+                self.av(self.stats),
+                name='drip_stats'
+            ),
+            url(
+                r'^stats/json/$',
+                self.av(self.stats_json),
+                name='drip_stats_json'
+            ),
             url(
                 r'^(?P<drip_id>[\d]+)/timeline/(?P<into_past>[\d]+)/(?P<into_future>[\d]+)/$',
                 self.av(self.timeline),
@@ -74,13 +302,82 @@ class DripAdmin(admin.ModelAdmin):
                 r'^(?P<drip_id>[\d]+)/timeline/(?P<into_past>[\d]+)/(?P<into_future>[\d]+)/(?P<user_id>[\d]+)/$',
                 self.av(self.view_drip_email),
                 name='view_drip_email'
+            ),
+            url(
+                r'^(?P<drip_id>[\d]+)/preview/$',
+                self.av(self.preview),
+                name='drip_preview'
+            ),
+            url(
+                r'^(?P<drip_id>[\d]+)/export/$',
+                self.av(self.export_audience),
+                name='drip_export_audience'
+            ),
+            url(
+                r'^(?P<drip_id>[\d]+)/snapshots/$',
+                self.av(self.snapshots),
+                name='drip_snapshots'
+            ),
+            url(
+                r'^(?P<drip_id>[\d]+)/snapshots/(?P<snapshot_id>[\d]+)/$',
+                self.av(self.view_snapshot),
+                name='view_drip_snapshot'
             )
         )
         return my_urls + urls
 admin.site.register(Drip, DripAdmin)
 
 
+class KeysetChangeList(ChangeList):
+    """
+    A newest first changelist for tables too big to count or OFFSET into.
+    It shows an estimated count, and pages with "older" links that carry
+    on below the last id shown (?before=) instead of page numbers.
+    """
+    def get_query_set(self, request):
+        before = self.params.pop(BEFORE_VAR, None)
+        if before is not None and not before.isdigit():
+            raise IncorrectLookupParameters
+        self.before = before and int(before)
+
+        qs = super(KeysetChangeList, self).get_query_set(request)
+        return qs.defer(*getattr(self.model_admin, 'list_defer', ()))
+
+    def get_ordering(self, request, queryset):
+        return ['-pk']
+
+    def get_ordering_field_columns(self):
+        return {}
+
+    def get_results(self, request):
+        from drip.utils import estimate_count
+
+        qs = self.query_set
+        if self.before is not None:
+            qs = qs.filter(pk__lt=self.before)
+        result_list = list(qs[:self.list_per_page + 1])
+
+        self.result_count, method = estimate_count(self.query_set)
+        self.full_result_count = self.result_count
+        self.result_list = result_list[:self.list_per_page]
+        self.can_show_all = False
+        self.multi_page = len(result_list) > self.list_per_page
+        self.older_url = None
+        if self.multi_page:
+            self.older_url = self.get_query_string({BEFORE_VAR: self.result_list[-1].pk})
+
+
 class SentDripAdmin(admin.ModelAdmin):
-    list_display = [f.name for f in SentDrip._meta.fields]
+    list_display = ('id', 'date', 'drip', 'user')
+    list_filter = ('drip', 'date')
+    list_select_related = True
+    list_per_page = 100
+    raw_id_fields = ('drip', 'user')
     ordering = ['-id']
+
+    #: only loaded on the change page
+    list_defer = ('subject', 'body')
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
 admin.site.register(SentDrip, SentDripAdmin)
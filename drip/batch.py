@@ -0,0 +1,173 @@
+"""
+Evaluate the audiences of many drips in one pass over the user table.
+
+Drips made only of plain `QuerySetRule`s over single valued relations,
+and `SentDripRule`s, can share a query: each drip's rules compile to one condition, the query
+selects users matching any of them, and a CASE WHEN per drip flags which
+ones each user matched. Everything else goes the usual way, one query
+per drip.
+"""
+import operator
+from array import array
+
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models import Q
+from django.db.models.related import RelatedObject
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models.sql.where import WhereNode, AND
+from django.utils.datastructures import SortedDict
+
+from drip.idsets import IdSet, drop_temp_table
+from drip.utils import AliasedWhere
+from drip.models import QuerySetRule, SubqueryRule, ExcludeSubqueryRule, SentDripRule
+
+
+def is_profile_relation(related):
+    """
+    Whether related is User to its `AUTH_PROFILE_MODULE`, which Django
+    holds to one profile per user even when the key isn't unique.
+    """
+    from django.conf import settings
+
+    profile_module = getattr(settings, 'AUTH_PROFILE_MODULE', '')
+    return related.parent_model is User and \
+           '%s.%s' % (related.model._meta.app_label, related.model._meta.object_name) == profile_module
+
+
+def is_single_valued(model, field_name):
+    """
+    Whether every relation `field_name` (a rule lookup, less the lookup
+    type) crosses from model yields at most one row.
+    """
+    from django.db.models import FieldDoesNotExist, ForeignKey
+
+    parts = field_name.split('__')
+    for part in parts[:-1]:
+        try:
+            field, field_model, direct, m2m = model._meta.get_field_by_name(part)
+        except FieldDoesNotExist:
+            return False
+        if m2m:
+            return False
+        if direct and isinstance(field, ForeignKey):
+            model = field.rel.to
+        elif not direct and isinstance(field, RelatedObject) and \
+             (field.field.unique or is_profile_relation(field)):
+            model = field.model
+        else:
+            return False
+    return True
+
+
+def is_batchable(drip):
+    """
+    Whether a DripBase can be evaluated along with others by
+    `evaluate_drips`. Subclasses may override `queryset` or the rules,
+    so only plain model drips qualify.
+    """
+    from drip.drips import DripBase
+
+    if type(drip) is not DripBase or drip.now_shift_kwargs:
+        return False
+    if SubqueryRule.objects.filter(drip=drip.drip_model).exists() or \
+       ExcludeSubqueryRule.objects.filter(drip=drip.drip_model).exists():
+        return False
+
+    for rule in QuerySetRule.objects.filter(drip=drip.drip_model):
+        if rule.annotate != 'none' or not is_single_valued(User, rule.field_name):
+            return False
+    return True
+
+
+def rules_q(drip, using=None):
+    """
+    The QuerySetRules of drip as a single Q.
+    """
+    conditions = []
+    for rule in QuerySetRule.objects.filter(drip=drip.drip_model):
+        condition = Q(**rule.filter_kwargs(now=drip.now, using=using))
+        conditions.append(~condition if rule.method_type == 'exclude' else condition)
+    return reduce(operator.and_, conditions, Q())
+
+
+def audience_query(drips, using=None):
+    """
+    Returns a values_list queryset of (user id, flag per drip) for every
+    user in the audience of at least one of drips, where the flags are 1
+    for the drips the user is in.
+    """
+    qs = User.objects.using(using)
+    query = qs.query.clone()
+    connection = connections[qs.db]
+    base_alias = query.get_initial_alias()
+
+    # compile each drip on its own where tree, sharing the joins
+    nodes = []
+    for drip in drips:
+        query.where = WhereNode()
+        query.add_q(rules_q(drip, qs.db))
+        for rule in SentDripRule.objects.filter(drip=drip.drip_model):
+            sql, params = rule.where(qs.db, now=drip.now)
+            query.where.add(AliasedWhere(sql, params, base_alias, User._meta.pk.column), AND)
+        nodes.append(query.where)
+    query.where = WhereNode()
+
+    # a join one drip needs must not drop users for the others
+    for alias in query.tables:
+        if alias != base_alias:
+            query.promote_alias(alias, unconditional=True)
+
+    qn = query.get_compiler(qs.db).quote_name_unless_alias
+    conditions = []
+    for node in nodes:
+        try:
+            sql, params = node.as_sql(qn=qn, connection=connection)
+        except EmptyResultSet:
+            sql, params = '1 = 0', []
+        conditions.append((sql or '1 = 1', params))
+
+    qs.query = query
+    select, select_params = SortedDict(), []
+    for drip, (sql, params) in zip(drips, conditions):
+        select['drip_%d' % drip.drip_model.id] = 'CASE WHEN %s THEN 1 ELSE 0 END' % sql
+        select_params.extend(params)
+
+    where = ' OR '.join(['(%s)' % sql for sql, params in conditions])
+    where_params = reduce(operator.add, [params for sql, params in conditions], [])
+
+    return qs.extra(select=select, select_params=select_params,
+                    where=[where], params=where_params)\
+             .order_by('id')\
+             .values_list('id', *select.keys())
+
+
+def evaluate_drips(drips, using=None, limit_to=None):
+    """
+    Evaluate the audiences of the batchable drips among drips with a
+    single query, and pin each one's queryset to its users. Returns the
+    drips that were evaluated; the rest are left alone. limit_to, an
+    `IdSet`, narrows every audience to those users.
+    """
+    drips = [drip for drip in drips if is_batchable(drip)]
+    if not drips:
+        return []
+
+    using = drips[0].read_database_for(User) if using is None else using
+    user_ids = [array('l') for drip in drips]
+    audience = audience_query(drips, using)
+    temp_tables = []
+    if limit_to is not None:
+        audience = limit_to.filter(audience, temp_tables=temp_tables)
+    try:
+        for row in audience.iterator():
+            for ids, flag in zip(user_ids, row[1:]):
+                if flag:
+                    ids.append(row[0])
+    finally:
+        for temp_table in temp_tables:
+            drop_temp_table(*temp_table)
+
+    for drip, ids in zip(drips, user_ids):
+        drip._queryset = IdSet(ids).filter(drip.queryset().using(using), temp_tables=drip._temp_tables)
+    return drips
@@ -0,0 +1,122 @@
+"""
+Synthetic user populations for timing the drip pipeline.
+
+Needs the `credits` test app installed, since rules filter on its Profile.
+Everything here writes to whatever database is active, so run it through
+the `drip_benchmark` command, which sets up a throwaway test database.
+"""
+import random
+from datetime import datetime, timedelta
+from time import time
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Max
+
+from drip.models import Drip, SentDrip, QuerySetRule
+from drip.signals import drip_phase_finished
+
+
+def populate(size, sent_ratio=0.2, history_ratio=0.5, seed=0):
+    """
+    Bulk create `size` users with profiles, joined over the last 30 days.
+
+    A `history_ratio` share of them has already got a SentDrip from
+    another drip, and a `sent_ratio` share has already got the benchmark
+    drip itself, so prune has something to do.
+    """
+    from credits.models import Profile
+
+    rand = random.Random(seed)
+    now = datetime.now()
+
+    first_id = User.objects.aggregate(Max('id'))['id__max'] or 0
+    User.objects.bulk_create([
+        User(username='bench_%d' % i,
+             email='bench_%d@example.com' % i,
+             date_joined=now - timedelta(days=rand.randint(0, 29), hours=rand.randint(0, 23)))
+        for i in xrange(size)
+    ])
+    user_ids = list(User.objects.filter(id__gt=first_id).values_list('id', flat=True))
+
+    Profile.objects.bulk_create([Profile(user_id=user_id, credits=rand.randint(0, 100))
+                                 for user_id in user_ids])
+
+    history_drip = Drip.objects.create(name='Benchmark History', body_html_template='Hello.')
+    drip = build_drip()
+
+    sent = []
+    for user_id in user_ids:
+        if rand.random() < history_ratio:
+            sent.append(SentDrip(drip=history_drip, user_id=user_id, subject='Hi', body='Hello.'))
+        if rand.random() < sent_ratio:
+            sent.append(SentDrip(drip=drip, user_id=user_id, subject='Hi', body='Hello.'))
+    SentDrip.objects.bulk_create(sent)
+
+    return drip
+
+def build_drip():
+    """
+    A week old users with at least 50 credits drip, the shape most of our
+    real drips have.
+    """
+    drip = Drip.objects.create(
+        name='Benchmark',
+        enabled=True,
+        subject_template='Hi {{ user.username }}',
+        body_html_template='<h1>Hello</h1> <p>You have been with us for a week!</p>'
+    )
+    QuerySetRule.objects.create(drip=drip, field_name='date_joined',
+                                lookup_type='lt', field_value='now-7 days')
+    QuerySetRule.objects.create(drip=drip, field_name='date_joined',
+                                lookup_type='gte', field_value='now-14 days')
+    QuerySetRule.objects.create(drip=drip, field_name='profile__credits',
+                                lookup_type='gte', field_value='50')
+    return drip
+
+def result(seconds, rows):
+    return {
+        'seconds': seconds,
+        'rows': rows,
+        'rows_per_second': rows / seconds if seconds else None,
+    }
+
+def run_benchmark(size, **kwargs):
+    """
+    Populate, then time audience evaluation, prune, render and recording
+    for the benchmark drip. Returns a dict that serializes to JSON.
+    """
+    results = {}
+
+    start = time()
+    drip_model = populate(size, **kwargs)
+    results['populate'] = result(time() - start, size)
+
+    drip = drip_model.drip
+    start = time()
+    rows = len(list(drip.get_queryset().values_list('id', flat=True)))
+    results['audience'] = result(time() - start, rows)
+
+    start = time()
+    drip.prune()
+    rows = len(list(drip.get_queryset().values_list('id', flat=True)))
+    results['prune'] = result(time() - start, rows)
+
+    phases = {}
+    def collect(sender, phase, duration, rows, **kw):
+        phases[phase] = result(duration, rows)
+
+    drip_phase_finished.connect(collect)
+    try:
+        drip_model.drip.run()
+    finally:
+        drip_phase_finished.disconnect(collect)
+
+    for phase in ('render', 'record'):
+        results[phase] = phases.get(phase, result(0.0, 0))
+
+    return {
+        'size': size,
+        'database': connection.vendor,
+        'results': results,
+    }
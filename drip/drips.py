@@ -1,12 +1,41 @@
+import itertools
+import threading
 from django.conf import settings
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.contrib.auth.models import User
 from django.template import Context, Template
-from drip.models import SentDrip, QuerySetRule, SubqueryRule, ExcludeSubqueryRule
+from drip.models import SentDrip, SentDripClaim, SentDripFilter, SentDripStat, DripOutbox
+from drip.models import QuerySetRule, SubqueryRule, ExcludeSubqueryRule, SentDripRule, AudienceSnapshot, AudienceView
+from drip.instrumentation import get_instrument, NULL_INSTRUMENT
+from drip.guards import get_guard, DripTimeout, NULL_GUARD
+from drip.idsets import IdSet, drop_temp_table
+from drip.rendering import compile_partial
+from drip.utils import where_pk
 from django.core.mail import EmailMultiAlternatives
+from django.db import connections, router, transaction, DatabaseError, DEFAULT_DB_ALIAS
+from django.db.models import Count
 from django.db.models.loading import get_model
 
+# https://bitbucket.org/schinckel/django-timedelta-field/
+import timedelta as djangotimedelta
+
+
+_template_cache = {}
+
+def compile_template(source):
+    """
+    Compile a drip template once per process, rather than once per
+    recipient. Long running processes drop the cache when it gets big,
+    since edited drips leave their old templates behind.
+    """
+    try:
+        return _template_cache[source]
+    except KeyError:
+        if len(_template_cache) >= 256:
+            _template_cache.clear()
+        template = _template_cache[source] = Template(source)
+        return template
 
 
 class DripBase(object):
@@ -34,6 +63,18 @@ class DripBase(object):
 
         self.now_shift_kwargs = kwargs.get('now_shift_kwargs', {})
 
+        #: replaced with a live `Instrument` and `Guard` for the duration of `run`
+        self.instrument = NULL_INSTRUMENT
+        self.guard = NULL_GUARD
+
+        #: alias to evaluate audiences on, eg. a read replica
+        self.read_database = getattr(settings, 'DRIP_READ_DATABASE', None)
+
+        #: (alias, name) of temporary id tables the querysets depend on
+        self._temp_tables = []
+
+        #: token of the `SentDripClaim` rows this run made
+        self.claim_token = None
 
     #########################
     ### DATE MANIPULATION ###
@@ -65,27 +106,54 @@ class DripBase(object):
             walked_range.append(self.__class__(**kwargs))
         return walked_range
 
-    def apply_queryset_rules(self, qs):
+    def read_database_for(self, model):
+        """
+        Models that normally live on the primary are read from
+        `read_database` instead, anything routed elsewhere stays put.
+        """
+        if self.read_database and router.db_for_read(model) == DEFAULT_DB_ALIAS:
+            return self.read_database
+        return None
+
+    def apply_lookup_rules(self, qs):
+        """
+        The rules that are plain conditions on the user query, ie. all
+        but subquery rules.
+        """
         for queryset_rule in QuerySetRule.objects.filter(drip=self.drip_model):
             qs = queryset_rule.apply(qs, now=self.now)
+        for sent_drip_rule in SentDripRule.objects.filter(drip=self.drip_model):
+            qs = sent_drip_rule.apply(qs, now=self.now)
+        return qs
+
+    def has_subquery_rules(self):
+        return SubqueryRule.objects.filter(drip=self.drip_model).exists() or \
+               ExcludeSubqueryRule.objects.filter(drip=self.drip_model).exists()
+
+    def apply_queryset_rules(self, qs):
+        qs = self.apply_lookup_rules(qs)
+
+        include_ids = exclude_ids = None
 
         for app_model_name in SubqueryRule.objects.filter(drip=self.drip_model).values('model_name', 'app_name', 'user_field').distinct():
             model=get_model(app_model_name['app_name'], app_model_name['model_name'])
             
-            model_qs = model.objects.values_list(app_model_name['user_field'], flat=True).distinct()
+            model_qs = model.objects.using(self.read_database_for(model))\
+                                    .values_list(app_model_name['user_field'], flat=True).distinct()
             for subquery_rule in SubqueryRule.objects.filter(drip=self.drip_model)\
                                                      .filter(app_name=app_model_name['app_name'])\
                                                      .filter(model_name=app_model_name['model_name'])\
                                                      .filter(user_field=app_model_name['user_field']):
                 model_qs = subquery_rule.apply(model_qs, now=self.now)
 
-            user_ids = model_qs
-            qs = qs.filter(id__in=list(user_ids))
+            user_ids = IdSet.from_sorted(model_qs.order_by(app_model_name['user_field']).iterator())
+            include_ids = user_ids if include_ids is None else include_ids.intersection(user_ids)
 
         for app_model_name in ExcludeSubqueryRule.objects.filter(drip=self.drip_model).values('model_name', 'app_name', 'user_field').distinct():
             model=get_model(app_model_name['app_name'], app_model_name['model_name'])
             
-            model_qs = model.objects.values_list(app_model_name['user_field'], flat=True).distinct()
+            model_qs = model.objects.using(self.read_database_for(model))\
+                                    .values_list(app_model_name['user_field'], flat=True).distinct()
             for exclude_subquery_rule in ExcludeSubqueryRule.objects\
                                                             .filter(drip=self.drip_model)\
                                                             .filter(app_name=app_model_name['app_name'])\
@@ -93,9 +161,17 @@ class DripBase(object):
                                                             .filter(user_field=app_model_name['user_field']):
                 model_qs = exclude_subquery_rule.apply(model_qs, now=self.now)
 
-            user_ids = model_qs
-            qs = qs.exclude(id__in=list(user_ids))
-            
+            user_ids = IdSet.from_sorted(model_qs.order_by(app_model_name['user_field']).iterator())
+            exclude_ids = user_ids if exclude_ids is None else exclude_ids.union(user_ids)
+
+        # do the set algebra in memory and hand the database one set
+        if include_ids is not None and exclude_ids is not None:
+            include_ids, exclude_ids = include_ids.difference(exclude_ids), None
+        if include_ids is not None:
+            qs = include_ids.filter(qs, temp_tables=self._temp_tables)
+        if exclude_ids is not None:
+            qs = exclude_ids.filter(qs, exclude=True, temp_tables=self._temp_tables)
+
         return qs.distinct()
 
     ##################
@@ -106,70 +182,450 @@ class DripBase(object):
         try:
             return self._queryset
         except AttributeError:
-            self._queryset = self.apply_queryset_rules(self.queryset())
+            qs = self.queryset()
+            qs = qs.using(self.read_database_for(qs.model))
+
+            view = self.audience_view()
+            if view is not None:
+                self._queryset = view.filter(qs)
+            else:
+                self._queryset = self.apply_queryset_rules(qs)
             return self._queryset
 
-    def run(self):
+    def limit_to(self, user_ids):
+        """
+        Narrow the audience to an `IdSet` of users, eg. the ones whose
+        data changed since the last run.
+        """
+        self._queryset = user_ids.filter(self.get_queryset(), temp_tables=self._temp_tables)
+
+    def audience_view(self):
+        """
+        The drip's `AudienceView`, if it has one that is fresh and matches
+        the rules. Timelines shift "now", so they always use the rules.
+        """
+        if self.now_shift_kwargs:
+            return None
+        try:
+            view = AudienceView.objects.get(drip=self.drip_model)
+        except AudienceView.DoesNotExist:
+            return None
+        return view if view.is_usable() else None
+
+    def estimate_count(self):
+        """
+        Returns (count, method): a quick guess at the audience size, from
+        the planner where the backend gives row estimates, otherwise by
+        sampling the user table.
+
+        Subquery rules would fetch their users and maybe fill temporary
+        tables, too much for a preview polled every few seconds, so they
+        are left to the exact count. Without an audience view to read,
+        the guess then only covers the other rules, and is an upper bound
+        ('... without subquery rules').
+        """
+        from drip.utils import estimate_count
+
+        qs = self.queryset()
+        qs = qs.using(self.read_database_for(qs.model))
+        view = self.audience_view()
+        if view is not None:
+            return estimate_count(view.filter(qs))
+
+        count, method = estimate_count(self.apply_lookup_rules(qs).distinct())
+        if self.has_subquery_rules():
+            method += ' without subquery rules'
+        return count, method
+
+    def exact_count_key(self):
+        return 'drip-count-%s-%s' % (self.drip_model.id, self.drip_model.rules_hash())
+
+    def exact_count(self, wait=False):
+        """
+        Returns the cached exact audience size, or None while it is still
+        being counted. Counting happens on a background thread unless
+        `DRIP_PREVIEW_ASYNC` is off or wait is True.
+        """
+        from django.core.cache import cache
+
+        key = self.exact_count_key()
+        count = cache.get(key)
+        if count is not None:
+            return count
+
+        timeout = getattr(settings, 'DRIP_PREVIEW_CACHE_TIMEOUT', 600)
+        # only one counter per rule set at a time
+        if not cache.add(key + '-running', True, timeout):
+            return None
+
+        def count_audience(close_connection=False):
+            from django import db
+            try:
+                # build the queryset afresh, any temporary tables it needs
+                # have to live on this thread's connection
+                drip = self.__class__(drip_model=self.drip_model, name=self.name,
+                                      now_shift_kwargs=self.now_shift_kwargs)
+                cache.set(key, drip.get_queryset().count(), timeout)
+                drip.drop_temp_tables()
+            finally:
+                cache.delete(key + '-running')
+                if close_connection:
+                    db.close_connection()
+
+        if wait or not getattr(settings, 'DRIP_PREVIEW_ASYNC', True):
+            count_audience()
+            return cache.get(key)
+
+        thread = threading.Thread(target=count_audience, kwargs={'close_connection': True})
+        thread.daemon = True
+        thread.start()
+        return None
+
+    def run(self, dry_run=False, record=True):
         """
         Get the queryset, prune sent people, and send it.
+
+        A dry run renders every email but sends and records nothing.
+        Without record the run doesn't count as the drip's last, eg. one
+        `limit_to` a few users, so it leaves `last_run` and the duration
+        estimate alone.
         """
         if not self.drip_model.enabled:
             return None
 
-        self.prune()
-        count = self.send()
+        started = datetime.now()
+        self.claim_token = None
+        self.instrument = get_instrument(self)
+        self.instrument.start()
+        self.guard = get_guard(self)
+        try:
+            with self.guard:
+                with self.instrument.phase('rules'):
+                    self.get_queryset()
+                self.instrument.emit('rules')
+
+                self.guard.arm()
+                with self.instrument.phase('prune'):
+                    self.prune()
+                self.instrument.emit('prune')
+
+                if getattr(settings, 'DRIP_AUDIENCE_SNAPSHOTS', False) and not dry_run:
+                    with self.instrument.phase('snapshot'):
+                        self.snapshot_audience()
+                    self.instrument.emit('snapshot')
+
+                self.guard.arm()
+                if self.use_outbox() and not dry_run:
+                    # drain_drip_outbox counts these as it delivers them
+                    with self.instrument.phase('record'):
+                        count = self.enqueue()
+                else:
+                    count = self.send(dry_run=dry_run)
+                    if not dry_run:
+                        SentDripStat.increment(self.drip_model, datetime.now().date(), count)
+
+                if getattr(settings, 'DRIP_SENT_FILTER', False) and not dry_run:
+                    with self.instrument.phase('record'):
+                        SentDripFilter.for_drip(self.drip_model)
+        except Exception as e:
+            if isinstance(e, DatabaseError):
+                # PostgreSQL won't run anything until the failed statement's
+                # transaction is gone
+                for using in set([router.db_for_write(SentDrip), router.db_for_write(self.drip_model.__class__)]):
+                    transaction.rollback_unless_managed(using=using)
+            if self.claim_token is not None:
+                # users claimed but never sent to would be skipped for good
+                SentDripClaim.release(self.drip_model, self.claim_token, unsent_only=True)
+            self.record_failure(e, started if record and not dry_run else None)
+            raise
+        finally:
+            self.instrument.finish()
+            self.instrument = NULL_INSTRUMENT
+            self.guard = NULL_GUARD
+            self.drop_temp_tables()
+
+        if record and not dry_run:
+            self.record_run(started, datetime.now() - started)
 
         return count
 
+    def drop_temp_tables(self):
+        """
+        Drop the temporary id tables behind the querysets. They go away
+        with the connection anyway, but daemons keep connections open.
+        """
+        if not self._temp_tables:
+            return
+        while self._temp_tables:
+            drop_temp_table(*self._temp_tables.pop())
+        # the cached queryset pointed at them, so rebuild it next time
+        self.__dict__.pop('_queryset', None)
+
+    def record_failure(self, error, started=None):
+        """
+        A timeout flags the drip as failed, with the SQL that timed out,
+        until a run gets through again. A failed real run still counts
+        as the last run, so the daemon waits out `send_interval` before
+        trying again rather than rerunning it every tick.
+        """
+        updates = {}
+        if isinstance(error, DripTimeout):
+            updates.update(failed=True, failure_sql=error.sql or '')
+        if started is not None:
+            updates['last_run'] = started
+        if not updates:
+            return
+
+        self.drip_model.__class__.objects.filter(id=self.drip_model.id).update(**updates)
+        for name, value in updates.items():
+            setattr(self.drip_model, name, value)
+
+    def record_run(self, started, duration):
+        """
+        Note when the drip last ran, and fold how long it took into the
+        moving average `send_drips --time-budget` plans with.
+        """
+        duration = duration.days * 86400 + duration.seconds + duration.microseconds / 1e6
+        estimate = self.drip_model.estimated_duration
+        if estimate is None:
+            estimate = duration
+        else:
+            estimate = 0.7 * estimate + 0.3 * duration
+
+        self.drip_model.__class__.objects.filter(id=self.drip_model.id)\
+                                         .update(last_run=started, estimated_duration=estimate,
+                                                 failed=False, failure_sql='')
+        self.drip_model.last_run = started
+        self.drip_model.estimated_duration = estimate
+        self.drip_model.failed = False
+        self.drip_model.failure_sql = ''
+
     def prune(self):
         """
         Do an exclude for all Users who have a SentDrip already.
         """
+        if getattr(settings, 'DRIP_CLAIM_SENDS', False) and getattr(settings, 'DRIP_CLAIM_SKIP_PRUNE', False):
+            # claims keep out anyone sent already
+            self._queryset = self.apply_frequency_cap(self.get_queryset())
+            return
+
+        if getattr(settings, 'DRIP_SENT_FILTER', False):
+            self._queryset = self.prune_with_filter(self.get_queryset())
+            self._queryset = self.apply_frequency_cap(self.get_queryset())
+            return
+
         target_user_ids = self.get_queryset().values_list('id', flat=True)
-        exclude_user_ids = SentDrip.objects.filter(date__lt=datetime.now(),
+        exclude_user_ids = SentDrip.objects.using(self.get_queryset().db)\
+                                           .filter(date__lt=datetime.now(),
                                                    drip=self.drip_model,
                                                    user__id__in=target_user_ids)\
                                            .values_list('user_id', flat=True)
         self._queryset = self.get_queryset().exclude(id__in=exclude_user_ids)
 
-    def build_email(self, user, send=False):
+        if self.get_queryset().db != router.db_for_write(SentDrip):
+            # the replica may not have caught up with our latest sends yet
+            recent_user_ids = list(self.recently_sent_user_ids())
+            if recent_user_ids:
+                self._queryset = self.get_queryset().exclude(id__in=recent_user_ids)
+
+        self._queryset = self.apply_frequency_cap(self.get_queryset())
+
+    def prune_with_filter(self, qs):
         """
-        Creates Email instance and optionally sends to user.
+        Pin qs to the users in it who were never sent this drip, checking
+        them against the drip's `SentDripFilter` and going to the database
+        only for the ones the filter can't rule out.
+
+        The filter and the check both read the primary, so this is safe
+        against replica lag too.
         """
-        use_createsend = getattr(settings, 'DRIP_USE_CREATESEND', False)
+        sent_filter = SentDripFilter.for_drip(self.drip_model)
+
+        user_ids = IdSet.from_sorted(qs.values_list('id', flat=True).order_by('id').iterator())
+        sent_ids = IdSet.from_iterable(sent_filter.sent_user_ids(user_ids))
+        return user_ids.difference(sent_ids).filter(qs, temp_tables=self._temp_tables)
+
+    def apply_frequency_cap(self, qs):
+        """
+        Exclude users who got `DRIP_FREQUENCY_CAP` or more drips of any
+        kind within `DRIP_FREQUENCY_CAP_WINDOW`, as a single NOT IN over
+        the (user, date) index on SentDrip. In outbox mode, drips still
+        queued for the user count too.
+        """
+        cap = getattr(settings, 'DRIP_FREQUENCY_CAP', None)
+        if not cap:
+            return qs
+
+        window = djangotimedelta.parse(getattr(settings, 'DRIP_FREQUENCY_CAP_WINDOW', '1 day'))
+        since = datetime.now() - window
+
+        # drips waiting in the outbox are as good as sent
+        outbox = self.use_outbox()
+
+        write_database = router.db_for_write(SentDrip)
+        if qs.db != write_database:
+            # sends from earlier drips in this run may not be replicated yet
+            sent = {}
+            counts = [SentDrip.objects.using(write_database).filter(date__gte=since)]
+            if outbox:
+                counts.append(DripOutbox.objects.using(write_database)
+                                                .filter(date__gte=since, status__in=('pending', 'leased')))
+            for count in counts:
+                for row in count.values('user').annotate(sent=Count('id')):
+                    sent[row['user']] = sent.get(row['user'], 0) + row['sent']
+            return qs.exclude(id__in=[user_id for user_id, count in sent.items() if count >= cap])
+
+        connection = connections[qs.db]
+        qn = connection.ops.quote_name
+        since = connection.ops.value_to_db_datetime(since)
+
+        opts = SentDrip._meta
+        sends = 'SELECT %s AS user_id FROM %s WHERE %s >= %%s' % (
+            qn(opts.get_field('user').column), qn(opts.db_table), qn(opts.get_field('date').column))
+        params = [since]
+        if outbox:
+            opts = DripOutbox._meta
+            sends += ' UNION ALL SELECT %s FROM %s WHERE %s >= %%s AND %s IN (%%s, %%s)' % (
+                qn(opts.get_field('user').column), qn(opts.db_table),
+                qn(opts.get_field('date').column), qn(opts.get_field('status').column))
+            params += [since, 'pending', 'leased']
+
+        where = '{pk} NOT IN (SELECT user_id FROM (%s) sends GROUP BY user_id HAVING COUNT(*) >= %%s)' % sends
+        return where_pk(qs, where, params + [cap])
+
+    def recently_sent_user_ids(self):
+        """
+        Users sent this drip within `DRIP_READ_DATABASE_MAX_LAG` seconds,
+        read from the primary so replication lag can't hide them.
+        """
+        since = datetime.now() - timedelta(seconds=getattr(settings, 'DRIP_READ_DATABASE_MAX_LAG', 3600))
+        return SentDrip.objects.using(router.db_for_write(SentDrip))\
+                               .filter(drip=self.drip_model, date__gte=since)\
+                               .values_list('user_id', flat=True)
+
+    def snapshot_audience(self):
+        """
+        Record who the (pruned) queryset targets right now.
+        """
+        user_ids = self.get_queryset().values_list('id', flat=True).order_by('id').iterator()
+        return AudienceSnapshot.take(self.drip_model, user_ids)
+
+    def use_outbox(self):
+        return getattr(settings, 'DRIP_USE_OUTBOX', False) and \
+               not getattr(settings, 'DRIP_USE_CREATESEND', False)
 
-        from django.utils.html import strip_tags
+    def render_key(self):
+        import hashlib
+        # hash the text rather than its repr, which differs for str and unicode
+        text = u'\0'.join([self.subject_template or u'', self.body_template or u''])
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    def enqueue(self, chunk_size=500):
+        """
+        Queue the audience in `DripOutbox` for `drain_drip_outbox`,
+        skipping users queued already. With `DRIP_CLAIM_SENDS` only the
+        users this run claims are queued, as with a direct send. Returns
+        the number queued.
+        """
+        import uuid
+        from drip.utils import iter_keyset
+
+        render_key = self.render_key()
+        claim = getattr(settings, 'DRIP_CLAIM_SENDS', False)
+        self.claim_token = uuid.uuid4().hex
+
+        def queue(user_ids):
+            if claim:
+                claimed = SentDripClaim.claim(self.drip_model, user_ids, self.claim_token)
+                user_ids = [user_id for user_id in user_ids if user_id in claimed]
+            queued = DripOutbox.queued_user_ids(self.drip_model, user_ids)
+            user_ids = [user_id for user_id in user_ids if user_id not in queued]
+            DripOutbox.objects.bulk_create([DripOutbox(drip=self.drip_model, user_id=user_id, render_key=render_key)
+                                            for user_id in user_ids])
+            return len(user_ids)
+
+        count = 0
+        user_ids = []
+        for (user_id,) in iter_keyset(self.get_queryset(), ['id'], chunk_size):
+            user_ids.append(user_id)
+            if len(user_ids) >= chunk_size:
+                count += queue(user_ids)
+                user_ids = []
+        if user_ids:
+            count += queue(user_ids)
+        return count
+
+    def claimed(self, users, chunk_size=200):
+        """
+        Yield the users this run gets a `SentDripClaim` in for, claiming a
+        chunk at a time. Anyone claimed already, by an earlier or a
+        concurrent run, is skipped. The claims' token is kept on
+        `claim_token` so a failed run can release them.
+        """
+        import uuid
+
+        token = self.claim_token = uuid.uuid4().hex
+        users = iter(users)
+        while True:
+            chunk = list(itertools.islice(users, chunk_size))
+            if not chunk:
+                return
+            with self.instrument.phase('record'):
+                claimed = SentDripClaim.claim(self.drip_model, [user.id for user in chunk], token)
+            for user in chunk:
+                if user.id in claimed:
+                    yield user
+
+    def render_email(self, user):
+        """
+        Renders the email for user, returning it with its subject and body.
+        """
+        use_createsend = getattr(settings, 'DRIP_USE_CREATESEND', False)
 
         from_email = getattr(settings, 'DRIP_FROM_EMAIL', settings.EMAIL_HOST_USER)
-        if use_createsend:
-            context = Context({'user': user})
-        else:
-            context = Context()
-        subject = Template(self.subject_template).render(context)
-        body = Template(self.body_template).render(context)
-        plain = strip_tags(body)
+        with self.instrument.phase('render') as timer:
+            if use_createsend:
+                context = Context({'user': user})
+            else:
+                context = Context()
+            # the static parts of each template are rendered once, and
+            # only what depends on the recipient is rendered per user
+            subject = compile_partial(self.subject_template).render(context)
+            body, plain = compile_partial(self.body_template).render_with_plain(context)
+
+            email = EmailMultiAlternatives(subject, plain, from_email, [user.email])
 
-        email = EmailMultiAlternatives(subject, plain, from_email, [user.email])
+            # check if there are html tags in the rendered template
+            if len(plain) != len(body):
+                email.attach_alternative(body, 'text/html')
+            timer.rows += 1
 
-        # check if there are html tags in the rendered template
-        if len(plain) != len(body):
-            email.attach_alternative(body, 'text/html')
+        return email, subject, body
+
+    def build_email(self, user, send=False):
+        """
+        Creates Email instance and optionally sends to user.
+        """
+        use_createsend = getattr(settings, 'DRIP_USE_CREATESEND', False)
+        email, subject, body = self.render_email(user)
 
         if send and not use_createsend:
-            sd = SentDrip.objects.create(
-                drip=self.drip_model,
-                user=user,
-                subject=subject,
-                body=body
-            )
+            with self.instrument.phase('record') as timer:
+                sd = SentDrip.objects.create(
+                    drip=self.drip_model,
+                    user_id=user.id,
+                    subject=subject,
+                    body=body
+                )
+                timer.rows += 1
             #This is commented out for safety. I don't want to ever send email via smtp
             #in our setup.
             #email.send()
 
         return email
 
-    def send(self):
-        if getattr(settings, 'DRIP_USE_CREATESEND', False):
+    def send(self, dry_run=False):
+        if getattr(settings, 'DRIP_USE_CREATESEND', False) and not dry_run:
 
             template_name = self.drip_model.template_name
             segment_name = 'Drip Segment %s' % self.drip_model.name.replace("'",'').replace('"','')
@@ -195,10 +651,13 @@ class DripBase(object):
             rules = []
             count = 0
 
-            qs = self.get_queryset()
+            users = self.instrument.iterate('fetch', self.get_queryset())
+            if getattr(settings, 'DRIP_CLAIM_SENDS', False):
+                users = self.claimed(users)
+            users = list(users)
             clauses = []
 
-            for user in qs:
+            for user in users:
                 clauses.append("EQUALS %s" % user.email)
                 count += 1
             rules = [{
@@ -209,54 +668,67 @@ class DripBase(object):
 
 
             if count:
-                if segment_id is not None:
-                    segment = Segment(segment_id)
-                    segment.clear_rules()
-                    segment.update(segment_name, rules)
-                else:
-                    segment_id = Segment().create(settings.CREATESEND_LIST_ID, segment_name, rules)
-                    segment = Segment(segment_id)
-
-                subject = Template(self.subject_template).render(Context())
-                body = Template(self.body_template).render(Context())
-                name    = 'Drip Campaign %s %s' % (self.drip_model.name, datetime.now().isoformat())
-
-                from_address = getattr(settings, 'DRIP_FROM_EMAIL', settings.EMAIL_HOST_USER)
-
-                template_content = {
-                    "Multilines" : [{
-                        'Content': body,
-                        },],
-                    }
-
-
-                campaign_id = Campaign().create_from_template(settings.CREATESEND_CLIENT_ID, 
-                                                              subject, 
-                                                              name, 
-                                                              from_address, 
-                                                              from_address, 
-                                                              from_address, 
-                                                              [], 
-                                                              [segment.details().SegmentID], 
-                                                              template_id, 
-                                                              template_content,
-                                                              )
-                campaign = Campaign(campaign_id)
-                failed = False
-                try:
-                    campaign.send(settings.CREATESEND_CONFIRMATION_EMAIL)
-                except BadRequest as br:
-                    print "ERROR: Could not send Drip %s: %s" % (self.drip_model.name, br)
-                    failed = True
+                with self.instrument.phase('render'):
+                    subject = compile_template(self.subject_template).render(Context())
+                    body = compile_template(self.body_template).render(Context())
+
+                with self.instrument.phase('dispatch'):
+                    if segment_id is not None:
+                        segment = Segment(segment_id)
+                        segment.clear_rules()
+                        segment.update(segment_name, rules)
+                    else:
+                        segment_id = Segment().create(settings.CREATESEND_LIST_ID, segment_name, rules)
+                        segment = Segment(segment_id)
+
+                    name    = 'Drip Campaign %s %s' % (self.drip_model.name, datetime.now().isoformat())
+
+                    from_address = getattr(settings, 'DRIP_FROM_EMAIL', settings.EMAIL_HOST_USER)
+
+                    template_content = {
+                        "Multilines" : [{
+                            'Content': body,
+                            },],
+                        }
+
+
+                    campaign_id = Campaign().create_from_template(settings.CREATESEND_CLIENT_ID, 
+                                                                  subject, 
+                                                                  name, 
+                                                                  from_address, 
+                                                                  from_address, 
+                                                                  from_address, 
+                                                                  [], 
+                                                                  [segment.details().SegmentID], 
+                                                                  template_id, 
+                                                                  template_content,
+                                                                  )
+                    campaign = Campaign(campaign_id)
+                    failed = False
+                    try:
+                        campaign.send(settings.CREATESEND_CONFIRMATION_EMAIL)
+                    except BadRequest as br:
+                        print "ERROR: Could not send Drip %s: %s" % (self.drip_model.name, br)
+                        failed = True
+                        count = 0
+                        if getattr(settings, 'DRIP_CLAIM_SENDS', False):
+                            # nobody got it, so let the next run claim them again
+                            SentDripClaim.release(self.drip_model, self.claim_token)
                 
                 if not failed:
-                    for user in qs:
-                        sd = SentDrip.objects.create(
-                            drip=self.drip_model,
-                            user=user,
-                            subject=subject,
-                            body=body
-                            )
+                    # the campaign is out, so neither a timeout nor a failure
+                    # may undo the claims and let the next run send it again
+                    self.guard.settle()
+                    self.claim_token = None
+                    with self.instrument.phase('record') as timer:
+                        for user in users:
+                            sd = SentDrip.objects.create(
+                                drip=self.drip_model,
+                                user_id=user.id,
+                                subject=subject,
+                                body=body
+                                )
+                            timer.rows += 1
 
             return count
 
@@ -269,15 +741,49 @@ class DripBase(object):
             Add that user to the SentDrip.
 
             Returns a list of created SentDrips.
+
+            Dry runs come through here too, to render without sending.
             """
 
+            users = self.instrument.iterate('fetch', self.get_queryset())
+            if getattr(settings, 'DRIP_CLAIM_SENDS', False) and not dry_run:
+                users = self.claimed(users)
+            if getattr(settings, 'DRIP_SEND_PIPELINE', False):
+                return self.send_pipelined(users, dry_run=dry_run)
+
             count = 0
-            for user in self.get_queryset():
-                msg = self.build_email(user, send=True)
+            for user in users:
+                self.guard.check()
+                msg = self.build_email(user, send=not dry_run)
                 count += 1
 
             return count
 
+    def send_pipelined(self, users, dry_run=False):
+        """
+        Like the SMTP send, but users are fetched a chunk ahead and their
+        SentDrips written in batches on background threads, so the
+        database works while this thread renders.
+        """
+        from drip.pipeline import Pipeline
+
+        def render(user):
+            self.guard.check()
+            email, subject, body = self.render_email(user)
+            if not dry_run:
+                return SentDrip(drip=self.drip_model, user_id=user.id, subject=subject, body=body)
+
+        def flush(sent):
+            with self.instrument.phase('record') as timer:
+                SentDrip.objects.using(router.db_for_write(SentDrip)).bulk_create(sent)
+                timer.rows += len(sent)
+
+        pipeline = Pipeline(chunk_size=getattr(settings, 'DRIP_PIPELINE_CHUNK_SIZE', 100),
+                            flush_size=getattr(settings, 'DRIP_PIPELINE_FLUSH_SIZE', 100),
+                            queue_size=getattr(settings, 'DRIP_PIPELINE_QUEUE_SIZE', 2),
+                            using=set([self.get_queryset().db, router.db_for_write(SentDrip)]))
+        return pipeline.run(users, render, flush)
+
 
     ####################
     ### USER DEFINED ###
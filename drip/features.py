@@ -0,0 +1,193 @@
+"""
+Per-user features, eg. total credits or last purchase date, kept up to
+date in `UserFeature` so rules filter a narrow indexed table instead of
+joining and aggregating on every run.
+
+Features are declared in `DRIP_USER_FEATURES`, a dict of feature name to:
+
+* model: 'app_label.Model' whose rows are aggregated per user,
+* aggregate: 'count', 'sum', 'min', 'max' or 'avg',
+* field: the field aggregated (default 'pk'),
+* user_field: the foreign key to User on model (default 'user').
+
+A `QuerySetRule` with a field name of `feature:<name>` then filters on the
+feature's value, eg. `feature:total_credits` `gte` `100`. Users with no
+rows to aggregate have no value, except for counts, where they count 0.
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Avg, Count, DateField, FieldDoesNotExist, Max, Min, Sum
+from django.db.models.loading import get_model
+
+
+FEATURE_PREFIX = 'feature:'
+
+AGGREGATES = {
+    'count': Count,
+    'sum': Sum,
+    'min': Min,
+    'max': Max,
+    'avg': Avg,
+}
+
+#: whether a count of 0 passes a lookup against value
+ZERO_LOOKUPS = {
+    'exact': lambda value: value == 0,
+    'gt': lambda value: 0 > value,
+    'gte': lambda value: 0 >= value,
+    'lt': lambda value: 0 < value,
+    'lte': lambda value: 0 <= value,
+}
+
+
+class Feature(object):
+    def __init__(self, name, model, aggregate, field='pk', user_field='user'):
+        if aggregate not in AGGREGATES:
+            raise ImproperlyConfigured('Drip feature %s has an unknown aggregate %r' % (name, aggregate))
+        self.name = name
+        self.model = get_model(*model.split('.'))
+        if self.model is None:
+            raise ImproperlyConfigured('Drip feature %s is on an unknown model %r' % (name, model))
+        self.aggregate = aggregate
+        self.field = field
+        self.user_field = user_field
+        self.user_attname = self.model._meta.get_field(user_field).attname
+
+    @property
+    def column(self):
+        """
+        The `UserFeature` column the value goes in.
+        """
+        if self.aggregate in ('min', 'max'):
+            try:
+                if isinstance(self.model._meta.get_field(self.field), DateField):
+                    return 'value_date'
+            except FieldDoesNotExist:
+                pass
+        return 'value_number'
+
+    def values(self, user_ids=None):
+        """
+        (user id, value) for every user with rows, or just for user_ids.
+        """
+        qs = self.model.objects.all()
+        if user_ids is not None:
+            qs = qs.filter(**{'%s__in' % self.user_field: list(user_ids)})
+        qs = qs.values(self.user_field)\
+               .annotate(feature_value=AGGREGATES[self.aggregate](self.field))\
+               .order_by(self.user_field)
+        return qs.values_list(self.user_field, 'feature_value')
+
+    def refresh(self, user_ids=None, batch_size=500):
+        """
+        Recompute the feature for user_ids, or for everybody, replacing
+        what `UserFeature` had. Returns the number of values written.
+        """
+        from drip.models import UserFeature
+
+        if user_ids is not None:
+            user_ids = list(user_ids)
+            count = 0
+            for start in range(0, len(user_ids), batch_size):
+                count += self.write(self.values(user_ids[start:start + batch_size]),
+                                    user_ids[start:start + batch_size])
+            return count
+
+        started = datetime.now()
+        count, chunk = 0, []
+        for row in self.values().iterator():
+            chunk.append(row)
+            if len(chunk) >= batch_size:
+                count += self.write(chunk)
+                chunk = []
+        count += self.write(chunk)
+
+        # whoever wasn't written this time no longer has any rows
+        UserFeature.objects.filter(name=self.name, updated__lt=started).delete()
+        return count
+
+    def write(self, rows, user_ids=None):
+        """
+        Upsert the (user id, value) rows, so readers never see a user
+        without their value, and with user_ids drop the values of those
+        users who have no rows any more.
+        """
+        from drip.models import UserFeature
+        from drip.utils import bulk_upsert
+
+        now = datetime.now()
+        rows = [(user_id, value) for user_id, value in rows if value is not None]
+        if user_ids is not None:
+            written = set([user_id for user_id, value in rows])
+            gone = [user_id for user_id in user_ids if user_id not in written]
+            if gone:
+                UserFeature.objects.filter(name=self.name, user__in=gone).delete()
+        if not rows:
+            return 0
+
+        bulk_upsert(UserFeature, ('user', 'name', 'updated', self.column), ('name', 'user'),
+                    [(user_id, self.name, now, value) for user_id, value in rows])
+        return len(rows)
+
+    def filter_kwargs(self, lookup_type, value, using=None):
+        """
+        The {lookup: value} on User keeping those whose feature matches.
+        """
+        from django.contrib.auth.models import User
+        from drip.models import UserFeature
+
+        values = UserFeature.objects.using(using).filter(name=self.name)
+        lookup = {'%s__%s' % (self.column, lookup_type): value}
+        if self.matches_missing(lookup_type, value):
+            # users without a row count 0, so keep all but the mismatches
+            mismatches = values.exclude(**lookup).values('user')
+            return {'pk__in': User.objects.using(using).exclude(pk__in=mismatches).values('pk')}
+        return {'pk__in': values.filter(**lookup).values('user')}
+
+    def matches_missing(self, lookup_type, value):
+        """
+        Whether users with no rows, who have no `UserFeature`, pass the
+        lookup: a count of nothing is 0, anything else has no value.
+        """
+        if self.aggregate != 'count' or lookup_type not in ZERO_LOOKUPS:
+            return False
+        try:
+            return ZERO_LOOKUPS[lookup_type](float(value))
+        except (TypeError, ValueError):
+            return False
+
+    def __repr__(self):
+        return '<Feature %s: %s(%s.%s)>' % (self.name, self.aggregate, self.model.__name__, self.field)
+
+
+#: (the DRIP_USER_FEATURES they came from, {name: Feature})
+_features = (None, {})
+
+
+def get_features():
+    """
+    A {name: Feature} of `DRIP_USER_FEATURES`, parsed once per setting.
+    """
+    global _features
+
+    definitions = getattr(settings, 'DRIP_USER_FEATURES', None) or {}
+    if _features[0] is not definitions:
+        _features = (definitions, dict((name, Feature(name, **definition))
+                                       for name, definition in definitions.items()))
+    return _features[1]
+
+
+def get_feature(name):
+    try:
+        return get_features()[name]
+    except KeyError:
+        raise ImproperlyConfigured('No drip feature %r in DRIP_USER_FEATURES' % name)
+
+
+def features_for_model(model):
+    """
+    The features aggregating rows of model.
+    """
+    return [feature for feature in get_features().values() if feature.model is model]
@@ -0,0 +1,211 @@
+"""
+Keep one slow drip from holding up the rest of a `send_drips` run.
+
+With `DRIP_STATEMENT_TIMEOUT` or `DRIP_TIME_LIMIT` set (in seconds), a run
+happens inside a transaction on its databases and under a statement
+timeout: `SET LOCAL statement_timeout` on PostgreSQL, `max_execution_time`
+on MySQL, and a progress handler on SQLite, where the timeout bounds each
+phase rather than each statement. Overrunning either rolls the run back
+and raises `DripTimeout`. Once a run can't be taken back, eg. the
+campaign went out, `settle` commits it and lifts the timeouts.
+"""
+import sys
+from time import time
+
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+
+from drip.utils import watch_queries, unwatch_queries
+
+
+#: how timeouts show up in database errors, by vendor
+TIMEOUT_MESSAGES = {
+    'postgresql': 'statement timeout',
+    'mysql': 'maximum statement execution time exceeded',
+    'sqlite': 'interrupted',
+}
+
+
+class DripTimeout(Exception):
+    """
+    A drip ran past its statement timeout or time limit. sql is the
+    statement that was running, or failing that the slowest one.
+    """
+    def __init__(self, message, sql=None):
+        super(DripTimeout, self).__init__(message)
+        self.sql = sql
+
+
+class NullGuard(object):
+    enabled = False
+
+    def arm(self):
+        pass
+
+    def check(self):
+        pass
+
+    def settle(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Guard(object):
+    """
+    Times out a single `DripBase.run`. Phases call `arm` as they start,
+    which gives the next statements whatever is left of the time limit,
+    and loops call `check` to stop between statements.
+    """
+    enabled = True
+    #: SQLite virtual machine instructions between progress handler calls
+    sqlite_steps = 1000
+
+    def __init__(self, statement_timeout=None, time_limit=None, using=(), read_using=None):
+        self.statement_timeout = statement_timeout
+        self.time_limit = time_limit
+        self.using = list(using)
+        self.read_using = read_using
+        self.connection = connections[read_using]
+
+    def __enter__(self):
+        self.started = time()
+        self.deadline = self.started + self.time_limit if self.time_limit else None
+        self.interrupted = False
+
+        for using in self.using:
+            transaction.enter_transaction_management(using=using)
+            transaction.managed(True, using=using)
+
+        # note the latest and the slowest statement, so a timeout can
+        # say which one it was
+        self.last_query = self.slowest_query = None
+        watch_queries(self.connection, self.executed)
+
+        if self.connection.vendor == 'sqlite':
+            self.connection.cursor()
+            self.connection.connection.set_progress_handler(self.progress, self.sqlite_steps)
+        try:
+            self.arm()
+        except DripTimeout:
+            # __exit__ isn't called when __enter__ raises
+            self.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                for using in self.using:
+                    transaction.commit(using=using)
+            else:
+                for using in self.using:
+                    transaction.rollback(using=using)
+        finally:
+            unwatch_queries(self.connection, self.executed)
+            self.disarm()
+            for using in self.using:
+                transaction.leave_transaction_management(using=using)
+
+        if exc_type is DripTimeout and exc_value.sql is None:
+            exc_value.sql = self.slowest_query and self.slowest_query[1]
+        elif exc_type is not None and issubclass(exc_type, DatabaseError) and self.timed_out(exc_value):
+            raise DripTimeout('Drip timed out: %s' % exc_value, sql=self.last_query)
+        return False
+
+    def executed(self, sql, duration):
+        self.last_query = sql
+        if self.slowest_query is None or duration > self.slowest_query[0]:
+            self.slowest_query = (duration, sql)
+
+    def remaining(self):
+        """
+        Seconds the next statement may take, or None for no limit.
+        """
+        limits = []
+        if self.statement_timeout:
+            limits.append(self.statement_timeout)
+        if self.deadline is not None:
+            limits.append(self.deadline - time())
+        return min(limits) if limits else None
+
+    def check(self):
+        if self.deadline is not None and time() > self.deadline:
+            raise DripTimeout('Drip ran past its %ss time limit' % self.time_limit)
+
+    def settle(self):
+        """
+        Commit the run so far and drop its timeouts, so nothing after
+        this point can roll it back.
+        """
+        for using in self.using:
+            transaction.commit(using=using)
+        self.statement_timeout = self.deadline = None
+        self.limit = None
+        self.disarm()
+
+    def arm(self):
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return
+
+        vendor = self.connection.vendor
+        milliseconds = max(1, int(remaining * 1000))
+        if vendor == 'postgresql':
+            self.connection.cursor().execute('SET LOCAL statement_timeout = %d' % milliseconds)
+        elif vendor == 'mysql':
+            self.connection.cursor().execute('SET SESSION max_execution_time = %d' % milliseconds)
+        elif vendor == 'sqlite':
+            self.limit = time() + remaining
+
+    def disarm(self):
+        # SET LOCAL went with the transaction
+        if self.connection.vendor == 'mysql':
+            self.connection.cursor().execute('SET SESSION max_execution_time = 0')
+        elif self.connection.vendor == 'sqlite' and self.connection.connection is not None:
+            self.connection.connection.set_progress_handler(None, self.sqlite_steps)
+
+    def progress(self):
+        """
+        SQLite's progress handler; returning True interrupts the statement.
+        """
+        if getattr(self, 'limit', None) is not None and time() > self.limit:
+            self.interrupted = True
+            return True
+        return False
+
+    def timed_out(self, error):
+        if self.interrupted:
+            return True
+        if self.deadline is not None and time() > self.deadline:
+            return True
+        message = TIMEOUT_MESSAGES.get(self.connection.vendor)
+        return message is not None and message in str(error)
+
+
+NULL_GUARD = NullGuard()
+
+
+def get_guard(drip):
+    """
+    Return a `Guard` for drip when `DRIP_STATEMENT_TIMEOUT` or
+    `DRIP_TIME_LIMIT` is set, otherwise the shared `NullGuard`.
+    """
+    from django.contrib.auth.models import User
+    from django.db import router
+    from drip.models import SentDrip
+
+    statement_timeout = getattr(settings, 'DRIP_STATEMENT_TIMEOUT', None)
+    time_limit = getattr(settings, 'DRIP_TIME_LIMIT', None)
+    if not statement_timeout and not time_limit:
+        return NULL_GUARD
+
+    read_using = drip.read_database_for(User) or router.db_for_read(User)
+    return Guard(statement_timeout, time_limit,
+                 using=sorted(set([read_using, router.db_for_write(SentDrip)])),
+                 read_using=read_using)
@@ -0,0 +1,254 @@
+import logging
+import socket
+import threading
+from time import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils.importlib import import_module
+
+from drip.signals import drip_phase_finished
+from drip.utils import watch_queries, unwatch_queries
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = logging.getLogger('drip')
+
+
+def max_rss():
+    """
+    Peak resident memory of this process in KB, if the platform tells us.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PhaseTimer(object):
+    """
+    Accumulates time, queries and rows for one phase of a run. It can
+    be entered any number of times, eg. once per user in the send loop,
+    and is reentrant: entering it again, from a nested call or another
+    thread of the send pipeline, before it was left only extends the
+    span being timed rather than counting it twice.
+    """
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+        self.duration = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.memory = None
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            if not self._depth:
+                self._start = time()
+                self._queries = self.instrument.query_count()
+            self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self._depth -= 1
+            if not self._depth:
+                self.duration += time() - self._start
+                self.queries += self.instrument.query_count() - self._queries
+                self.memory = max_rss()
+
+
+class NullTimer(object):
+    name = None
+    duration = 0.0
+    queries = 0
+    rows = 0
+    memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullInstrument(object):
+    """
+    Stands in when nobody is listening, so a run pays next to nothing.
+    """
+    enabled = False
+
+    def phase(self, name):
+        return NullTimer()
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def emit(self, *names):
+        pass
+
+    def start(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Instrument(object):
+    """
+    Times the phases of a single `DripBase.run` and sends
+    `drip_phase_finished` for each of them.
+    """
+    enabled = True
+
+    def __init__(self, drip, using=None):
+        self.drip = drip
+        #: every database the run touches, eg. a read replica too
+        self.connections = [connections[alias] for alias in (using or run_databases(drip))]
+        self.phases = {}
+        self.order = []
+        self.emitted = set()
+        self.queries = 0
+
+    def query_count(self):
+        return self.queries
+
+    def executed(self, sql, duration):
+        self.queries += 1
+
+    def phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = PhaseTimer(self, name)
+            self.order.append(name)
+        return self.phases[name]
+
+    def iterate(self, name, iterable):
+        """
+        Yield from iterable, charging the time spent fetching to a phase.
+        """
+        timer = self.phase(name)
+        iterator = iter(iterable)
+        while True:
+            with timer:
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+            timer.rows += 1
+            yield item
+
+    def emit(self, *names):
+        for name in names:
+            if name in self.emitted or name not in self.phases:
+                continue
+            timer = self.phases[name]
+            drip_phase_finished.send(sender=self.drip.__class__,
+                                     drip=self.drip,
+                                     phase=name,
+                                     duration=timer.duration,
+                                     queries=timer.queries,
+                                     rows=timer.rows,
+                                     memory=timer.memory)
+            self.emitted.add(name)
+
+    def start(self):
+        """
+        Count the run's statements on each of its connections, without
+        keeping them.
+        """
+        for connection in self.connections:
+            watch_queries(connection, self.executed)
+
+    def finish(self):
+        self.emit(*self.order)
+        for connection in self.connections:
+            unwatch_queries(connection, self.executed)
+
+
+def run_databases(drip):
+    """
+    The aliases a run of drip queries: the default, where its audience is
+    read from and where SentDrips are written.
+    """
+    from django.contrib.auth.models import User
+    from django.db import router, DEFAULT_DB_ALIAS
+    from drip.models import SentDrip
+
+    aliases = [DEFAULT_DB_ALIAS, drip.read_database_for(User) or router.db_for_read(User),
+               router.db_for_write(SentDrip)]
+    return sorted(set(aliases))
+
+
+NULL_INSTRUMENT = NullInstrument()
+_sinks_connected = False
+
+
+def connect_sinks():
+    """
+    Connect the receivers listed in `DRIP_INSTRUMENTATION_SINKS`.
+    """
+    global _sinks_connected
+
+    for path in getattr(settings, 'DRIP_INSTRUMENTATION_SINKS', ()):
+        module_name, attr = path.rsplit('.', 1)
+        sink = getattr(import_module(module_name), attr)
+        drip_phase_finished.connect(sink, dispatch_uid=path)
+    _sinks_connected = True
+
+
+def get_instrument(drip):
+    """
+    Return an `Instrument` for drip if anything listens to
+    `drip_phase_finished`, otherwise the shared `NullInstrument`.
+    """
+    if not _sinks_connected:
+        connect_sinks()
+
+    if drip_phase_finished.receivers:
+        return Instrument(drip)
+    return NULL_INSTRUMENT
+
+
+#############
+### SINKS ###
+#############
+
+def log_phase(sender, drip, phase, duration, queries, rows, memory, **kwargs):
+    logger.info('drip %s: %s took %.3fs, %d queries, %d rows, peak memory %s KB',
+                drip.name, phase, duration, queries, rows, memory)
+
+
+_statsd_socket = None
+
+
+def statsd_phase(sender, drip, phase, duration, queries, rows, memory, **kwargs):
+    """
+    Fire StatsD metrics over UDP to `DRIP_STATSD_HOST`:`DRIP_STATSD_PORT`.
+    """
+    from django.template.defaultfilters import slugify
+
+    global _statsd_socket
+    if _statsd_socket is None:
+        _statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    address = (getattr(settings, 'DRIP_STATSD_HOST', 'localhost'),
+               getattr(settings, 'DRIP_STATSD_PORT', 8125))
+    prefix = '%s.%s.%s' % (getattr(settings, 'DRIP_STATSD_PREFIX', 'drip'),
+                           slugify(drip.name).replace('-', '_'),
+                           phase)
+
+    metrics = ['%s.time:%d|ms' % (prefix, duration * 1000),
+               '%s.queries:%d|c' % (prefix, queries),
+               '%s.rows:%d|c' % (prefix, rows)]
+    if memory is not None:
+        metrics.append('%s.memory:%d|g' % (prefix, memory))
+
+    try:
+        _statsd_socket.sendto('\n'.join(metrics), address)
+    except socket.error:
+        logger.warning('Could not send drip metrics to statsd at %s:%s', *address)
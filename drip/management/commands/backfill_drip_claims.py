@@ -0,0 +1,51 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '[drip name or id ...]'
+    help = ('Claim every user already sent a drip (every drip by default), so DRIP_CLAIM_SENDS ' +
+            'keeps them out without prune.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            dest='batch_size',
+            type='int',
+            default=1000,
+            help='SentDrips read per query (default: 1000).'),
+    )
+
+    def handle(self, *args, **options):
+        from drip.models import Drip
+
+        if args:
+            drips = []
+            for arg in args:
+                try:
+                    if arg.isdigit():
+                        drips.append(Drip.objects.get(id=arg))
+                    else:
+                        drips.append(Drip.objects.get(name=arg))
+                except Drip.DoesNotExist:
+                    raise CommandError('Drip `{0}` does not exist.'.format(arg))
+        else:
+            drips = Drip.objects.all()
+
+        for drip in drips:
+            claimed = self.backfill(drip, options['batch_size'])
+            self.stdout.write('%s: %d sent users claimed\n' % (drip.name, claimed))
+
+    def backfill(self, drip, batch_size):
+        from drip.models import SentDrip, SentDripClaim
+        from drip.utils import iter_keyset
+
+        claimed = 0
+        user_ids = []
+        for sent_id, user_id in iter_keyset(SentDrip.objects.filter(drip=drip), ['id', 'user'], batch_size):
+            user_ids.append(user_id)
+            if len(user_ids) >= batch_size:
+                claimed += len(SentDripClaim.claim(drip, set(user_ids), 'backfill'))
+                user_ids = []
+        claimed += len(SentDripClaim.claim(drip, set(user_ids), 'backfill'))
+        return claimed
@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '[drip name or id ...]'
+    help = ('Rebuild the per day send counts of drips (every drip by default) from SentDrip. ' +
+            'Best run while send_drips is not.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            dest='batch_size',
+            type='int',
+            default=10000,
+            help='SentDrips read per query (default: 10000).'),
+    )
+
+    def handle(self, *args, **options):
+        from drip.models import Drip
+
+        if args:
+            drips = []
+            for arg in args:
+                try:
+                    if arg.isdigit():
+                        drips.append(Drip.objects.get(id=arg))
+                    else:
+                        drips.append(Drip.objects.get(name=arg))
+                except Drip.DoesNotExist:
+                    raise CommandError('Drip `{0}` does not exist.'.format(arg))
+        else:
+            drips = Drip.objects.all()
+
+        for drip in drips:
+            days = self.backfill(drip, options['batch_size'])
+            self.stdout.write('%s: %d days\n' % (drip.name, days))
+
+    def backfill(self, drip, batch_size):
+        """
+        Count the sends of drip per day, a batch of SentDrips at a time,
+        then swap the counts in. Returns the number of days with sends.
+        """
+        from django.db import transaction
+        from drip.models import SentDrip, SentDripStat
+        from drip.utils import iter_keyset
+
+        counts = {}
+        for sent_id, date in iter_keyset(SentDrip.objects.filter(drip=drip), ['id', 'date'], batch_size):
+            counts[date.date()] = counts.get(date.date(), 0) + 1
+
+        with transaction.commit_on_success():
+            SentDripStat.objects.filter(drip=drip).delete()
+            SentDripStat.objects.bulk_create([SentDripStat(drip=drip, date=day, count=count)
+                                              for day, count in sorted(counts.items())])
+        return len(counts)
@@ -0,0 +1,98 @@
+import logging
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+logger = logging.getLogger('drip')
+
+
+class Command(BaseCommand):
+    help = ('Render and deliver the drips queued in the outbox by send_drips with DRIP_USE_OUTBOX. ' +
+            'Run as many workers as you like.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            dest='batch_size',
+            type='int',
+            default=100,
+            help='Rows leased at a time (default: 100).'),
+        make_option('--lease',
+            dest='lease',
+            type='int',
+            default=300,
+            help='Seconds before rows a worker leased but did not finish go to another worker (default: 300).'),
+        make_option('--max-attempts',
+            dest='max_attempts',
+            type='int',
+            default=3,
+            help='Give up on a row after this many failed deliveries (default: 3).'),
+        make_option('--wait',
+            dest='wait',
+            type='int',
+            default=0,
+            help='Instead of exiting when the outbox is empty, check again every this many seconds.'),
+    )
+
+    def handle(self, *args, **options):
+        delivered = 0
+        while True:
+            count = self.drain(options['batch_size'], options['lease'], options['max_attempts'])
+            delivered += count
+            if count:
+                continue
+            if not options['wait']:
+                break
+            time.sleep(options['wait'])
+
+        self.stdout.write('%d delivered\n' % delivered)
+
+    def drain(self, batch_size, lease, max_attempts):
+        """
+        Lease a batch of rows and deliver each one in its own transaction,
+        with its SentDrip. Returns the number leased.
+        """
+        from datetime import datetime
+        from django.db import transaction
+        from drip.models import DripOutbox, SentDripClaim, SentDripStat
+
+        rows = DripOutbox.lease(batch_size, lease)
+
+        drips = {}
+        delivered = {}
+        for row in rows:
+            if row.drip_id not in drips:
+                drips[row.drip_id] = row.drip.drip
+            drip = drips[row.drip_id]
+
+            if row.render_key != drip.render_key():
+                # the templates changed since the row was queued, so leave
+                # the user to the next run, which decides under the new ones
+                DripOutbox.objects.filter(id=row.id, lease_token=row.lease_token)\
+                                  .update(status='failed', error='Drip templates changed since it was queued')
+                SentDripClaim.objects.filter(drip=row.drip_id, user=row.user_id).delete()
+                transaction.commit_unless_managed()
+                continue
+
+            try:
+                with transaction.commit_on_success():
+                    # if the lease ran out and another worker has the row, leave it to them
+                    if not DripOutbox.objects.filter(id=row.id, lease_token=row.lease_token, status='leased')\
+                                             .update(status='done', sent=datetime.now()):
+                        continue
+                    drip.build_email(row.user, send=True)
+            except Exception as e:
+                logger.exception('Could not deliver drip %s to user %s', drip.name, row.user_id)
+                DripOutbox.objects.filter(id=row.id, lease_token=row.lease_token)\
+                                  .update(status='failed' if row.attempts >= max_attempts else 'pending',
+                                          error=unicode(e))
+                transaction.commit_unless_managed()
+            else:
+                delivered[row.drip_id] = delivered.get(row.drip_id, 0) + 1
+
+        for drip_id, count in delivered.items():
+            SentDripStat.increment(drips[drip_id].drip_model, datetime.now().date(), count)
+        transaction.commit_unless_managed()
+
+        return len(rows)
@@ -0,0 +1,61 @@
+import json
+import platform
+from optparse import make_option
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Time the drip pipeline against synthetic user populations in a throwaway database.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes',
+            dest='sizes',
+            default='10000',
+            help='Comma separated population sizes (default: 10000).'),
+        make_option('--output',
+            dest='output',
+            default=None,
+            help='Write the JSON results to this file instead of stdout.'),
+    )
+
+    def handle(self, *args, **options):
+        from django.db import connection
+        import drip
+        from drip.benchmarks import run_benchmark
+
+        if 'credits' not in settings.INSTALLED_APPS:
+            raise CommandError('The benchmarks need the `credits` test app in INSTALLED_APPS.')
+
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma separated list of integers.')
+
+        runs = []
+        for size in sizes:
+            # a fresh test database per size, so nothing real is touched
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                runs.append(run_benchmark(size))
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps({
+            'version': drip.__version__,
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'runs': runs,
+        }, indent=2, sort_keys=True)
+
+        if options['output']:
+            out = open(options['output'], 'w')
+            try:
+                out.write(output)
+            finally:
+                out.close()
+        else:
+            self.stdout.write(output + '\n')
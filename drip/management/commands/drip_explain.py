@@ -0,0 +1,173 @@
+from optparse import make_option
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '<drip name or id>'
+    help = 'Print the SQL, query plans and timings behind a drip.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--analyze',
+            action='store_true',
+            dest='analyze',
+            default=False,
+            help='Run EXPLAIN ANALYZE where the backend supports it (executes the queries).'),
+        make_option('--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Rank every enabled drip by planner cost, running nothing but EXPLAIN.'),
+    )
+
+    def handle(self, *args, **options):
+        from drip.models import Drip
+
+        try:
+            if options['all']:
+                if options['analyze']:
+                    raise CommandError('--all only runs EXPLAIN, leave out --analyze.')
+                return self.rank(Drip.objects.filter(enabled=True))
+        except NotImplementedError as e:
+            raise CommandError(str(e))
+
+        if len(args) != 1:
+            raise CommandError('Give exactly one drip name or id, or use --all.')
+
+        try:
+            if args[0].isdigit():
+                drip_model = Drip.objects.get(id=args[0])
+            else:
+                drip_model = Drip.objects.get(name=args[0])
+        except Drip.DoesNotExist:
+            raise CommandError('Drip `{0}` does not exist.'.format(args[0]))
+
+        try:
+            self.explain(drip_model, options['analyze'])
+        except NotImplementedError as e:
+            raise CommandError(str(e))
+
+    def phases(self, drip_model, analyze=False):
+        """
+        Build, explain and time the audience and prune querysets of a drip.
+        """
+        from drip.utils import explain_queryset
+
+        drip = drip_model.drip
+        phases = []
+
+        start = time()
+        qs = drip.get_queryset()
+        rules_time = time() - start
+
+        start = time()
+        count = qs.count()
+        phases.append({
+            'name': 'get_queryset',
+            'sql': str(qs.query),
+            'plan': explain_queryset(qs, analyze=analyze),
+            'rules_time': rules_time,
+            'count_time': time() - start,
+            'count': count,
+        })
+
+        start = time()
+        drip.prune()
+        qs = drip.get_queryset()
+        rules_time = time() - start
+
+        start = time()
+        count = qs.count()
+        phases.append({
+            'name': 'prune',
+            'sql': str(qs.query),
+            'plan': explain_queryset(qs, analyze=analyze),
+            'rules_time': rules_time,
+            'count_time': time() - start,
+            'count': count,
+        })
+
+        return phases
+
+    def unindexed_fields(self, drip_model):
+        """
+        Return (model name, field_name) pairs for rule fields whose
+        columns have no index.
+        """
+        from django.db.models.loading import get_model
+        from drip.models import QuerySetRule, SubqueryRule, ExcludeSubqueryRule
+        from drip.utils import get_field_index_map
+
+        index_maps = {}
+        unindexed = []
+
+        # feature:<name> rules go to UserFeature's own indexes
+        rules = [(drip_model.drip.queryset().model, rule.field_name)
+                 for rule in QuerySetRule.objects.filter(drip=drip_model) if not rule.is_feature()]
+        for Rule in (SubqueryRule, ExcludeSubqueryRule):
+            rules.extend([(get_model(rule.app_name, rule.model_name), rule.field_name)
+                          for rule in Rule.objects.filter(drip=drip_model)])
+
+        for Model, field_name in rules:
+            if Model not in index_maps:
+                index_maps[Model] = get_field_index_map(Model)
+            indexed = index_maps[Model].get(field_name)
+            if indexed is None:
+                unindexed.append((Model.__name__, field_name, 'unknown field'))
+            elif not indexed:
+                unindexed.append((Model.__name__, field_name, 'no index'))
+
+        return unindexed
+
+    def explain(self, drip_model, analyze=False):
+        self.stdout.write('Drip: %s\n' % drip_model.name)
+
+        for phase in self.phases(drip_model, analyze):
+            self.stdout.write('\n== %s ==\n' % phase['name'])
+            self.stdout.write('%s\n\n' % phase['sql'])
+            for line in phase['plan']:
+                self.stdout.write('  %s\n' % line)
+            self.stdout.write('\nbuild: %.4fs  count: %.4fs  rows: %d\n' % (
+                phase['rules_time'], phase['count_time'], phase['count']))
+
+        unindexed = self.unindexed_fields(drip_model)
+        if unindexed:
+            self.stdout.write('\n== index advisor ==\n')
+            for model_name, field_name, reason in unindexed:
+                self.stdout.write('  %s.%s: %s\n' % (model_name, field_name, reason))
+
+    def planned_queryset(self, drip_model):
+        """
+        A drip's audience, pruned, as a single query that can be explained
+        without running anything first: subquery rules, which fetch their
+        users up front, are left out, and sends are pruned by SentDrip
+        rather than the sent filter, which may need building.
+        """
+        from drip.models import SentDrip
+
+        drip = drip_model.drip
+        qs = drip.queryset()
+        qs = drip.apply_lookup_rules(qs.using(drip.read_database_for(qs.model))).distinct()
+        return qs.exclude(id__in=SentDrip.objects.using(qs.db).filter(drip=drip_model).values('user'))
+
+    def rank(self, drip_models):
+        from drip.utils import explain_queryset, get_plan_cost
+
+        ranked, unranked = [], []
+        for drip_model in drip_models:
+            cost = get_plan_cost(explain_queryset(self.planned_queryset(drip_model)))
+            if cost is None:
+                unranked.append(drip_model)
+            else:
+                ranked.append((cost, drip_model))
+
+        if ranked:
+            self.stdout.write('== by planner cost ==\n')
+            for cost, drip_model in sorted(ranked, key=lambda r: r[0], reverse=True):
+                self.stdout.write('%12.4f  %s\n' % (cost, drip_model.name))
+        if unranked:
+            # eg. SQLite, whose plans have no costs
+            self.stdout.write('== no planner cost ==\n')
+            for drip_model in unranked:
+                self.stdout.write('%12s  %s\n' % ('-', drip_model.name))
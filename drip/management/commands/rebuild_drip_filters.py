@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '[drip name or id ...]'
+    help = 'Rebuild the sent drip filters prune uses with DRIP_SENT_FILTER, for every drip by default.'
+
+    def handle(self, *args, **options):
+        from drip.models import Drip, SentDripFilter
+
+        if args:
+            drips = []
+            for arg in args:
+                try:
+                    if arg.isdigit():
+                        drips.append(Drip.objects.get(id=arg))
+                    else:
+                        drips.append(Drip.objects.get(name=arg))
+                except Drip.DoesNotExist:
+                    raise CommandError('Drip `{0}` does not exist.'.format(arg))
+        else:
+            drips = Drip.objects.all()
+
+        for drip in drips:
+            sent_filter, created = SentDripFilter.objects.get_or_create(drip=drip)
+            sent_filter.refresh(rebuild=True)
+            self.stdout.write('%s: %d sends, %d bits\n' % (drip.name, sent_filter.count, sent_filter.num_bits))
@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '[feature name ...]'
+    help = ('Recompute DRIP_USER_FEATURES (every feature by default) for all users. Saves and deletes ' +
+            'keep them current between runs; run this to fill them in, and after bulk updates that ' +
+            'skip signals.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            dest='batch_size',
+            type='int',
+            default=500,
+            help='Users written per query (default: 500).'),
+    )
+
+    def handle(self, *args, **options):
+        from drip.features import get_features
+
+        features = get_features()
+        for name in args:
+            if name not in features:
+                raise CommandError('Feature `{0}` is not in DRIP_USER_FEATURES.'.format(name))
+
+        for name in sorted(args or features):
+            count = features[name].refresh(batch_size=options['batch_size'])
+            self.stdout.write('%s: %d users\n' % (name, count))
@@ -0,0 +1,63 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '[drip name or id ...]'
+    help = 'Refresh the audience views of drips, every drip that has one by default.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--create',
+            action='store_true',
+            dest='create',
+            default=False,
+            help='Give the named drips an audience view if they have none.'),
+        make_option('--materialized',
+            action='store_true',
+            dest='materialized',
+            default=False,
+            help='With --create, make materialized views (PostgreSQL only).'),
+        make_option('--drop',
+            action='store_true',
+            dest='drop',
+            default=False,
+            help='Drop the audience views of the named drips instead.'),
+    )
+
+    def handle(self, *args, **options):
+        from drip.models import Drip, AudienceView
+
+        if (options['create'] or options['drop']) and not args:
+            raise CommandError('Name the drips to --create or --drop views for.')
+
+        drips = []
+        for arg in args:
+            try:
+                if arg.isdigit():
+                    drips.append(Drip.objects.get(id=arg))
+                else:
+                    drips.append(Drip.objects.get(name=arg))
+            except Drip.DoesNotExist:
+                raise CommandError('Drip `{0}` does not exist.'.format(arg))
+
+        views = AudienceView.objects.select_related('drip')
+        if drips:
+            views = views.filter(drip__in=drips)
+
+        if options['drop']:
+            for view in views:
+                view.delete()
+                self.stdout.write('%s: dropped %s\n' % (view.drip.name, view.name))
+            return
+
+        if options['create']:
+            for drip in drips:
+                AudienceView.objects.get_or_create(drip=drip, defaults={'materialized': options['materialized']})
+
+        for view in views:
+            try:
+                view.refresh()
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write('%s: refreshed %s\n' % (view.drip.name, view.name))
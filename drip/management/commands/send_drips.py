@@ -1,9 +1,323 @@
+import logging
+import os
+import signal
+import time
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
 
+from drip.guards import DripTimeout
+
+
+SEND_PHASES = ('fetch', 'render', 'dispatch', 'record')
+
+logger = logging.getLogger('drip')
+
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Render every drip without sending or recording SentDrips.'),
+        make_option('--profile',
+            action='store_true',
+            dest='profile',
+            default=False,
+            help='Dry run each drip under cProfile and write a report per drip.'),
+        make_option('--profile-dir',
+            dest='profile_dir',
+            default='drip_profiles',
+            help='Where --profile writes its reports (default: drip_profiles).'),
+        make_option('--daemon',
+            action='store_true',
+            dest='daemon',
+            default=False,
+            help='Stay running and send each drip whenever its send_interval comes around.'),
+        make_option('--tick',
+            dest='tick',
+            type='int',
+            default=60,
+            help='Seconds between checks for due drips in --daemon mode (default: 60).'),
+        make_option('--time-budget',
+            dest='time_budget',
+            type='int',
+            default=None,
+            help=('Seconds the run may take. Drips whose estimated duration no longer fits ' +
+                  'are deferred, lowest priority first.')),
+        make_option('--batch-evaluate',
+            action='store_true',
+            dest='batch_evaluate',
+            default=False,
+            help=('Evaluate the audiences of all drips made only of plain queryset rules ' +
+                  'in a single query up front.')),
+        make_option('--pending',
+            action='store_true',
+            dest='pending',
+            default=False,
+            help=('Only consider users queued by DRIP_ELIGIBILITY_MODELS since the last --pending run. ' +
+                  'Works with --batch-evaluate, not with --time-budget.')),
+    )
+
     def handle(self, *args, **options):
         from drip.models import Drip
 
-        for drip in Drip.objects.filter(enabled=True):
-            drip.drip.run()
+        self.batch_evaluate = options['batch_evaluate']
+        self.evaluated = {}
+
+        if options['daemon']:
+            return self.daemon(options['tick'], options['time_budget'])
+
+        if options['profile'] and not os.path.isdir(options['profile_dir']):
+            try:
+                os.makedirs(options['profile_dir'])
+            except OSError as e:
+                raise CommandError('Could not create %s: %s' % (options['profile_dir'], e))
+
+        drips = Drip.objects.filter(enabled=True).order_by('-priority', 'id')
+        if options['pending']:
+            if options['time_budget']:
+                # estimated durations are of full runs, which would defer nearly everything
+                raise CommandError('--time-budget does not apply to --pending runs.')
+            count = self.run_pending(drips)
+            self.stdout.write('%d pending users\n' % count)
+            return
+
+        if self.batch_evaluate and not options['profile']:
+            self.evaluate(drips)
+
+        if options['time_budget'] and not (options['profile'] or options['dry_run']):
+            ran, deferred = self.run_within_budget(drips, options['time_budget'])
+            self.report(ran, deferred, options['time_budget'])
+            return
+
+        for drip in drips:
+            try:
+                if options['profile']:
+                    self.profile(drip, options['profile_dir'])
+                elif options['dry_run']:
+                    count = self.dripbase(drip).run(dry_run=True)
+                    self.stdout.write('%s: %d\n' % (drip.name, count))
+                else:
+                    self.dripbase(drip).run()
+            except DripTimeout as e:
+                # rolled back and flagged on the drip, on to the next one
+                logger.warning('Drip %s timed out: %s', drip.name, e)
+                self.stdout.write('%s: %s\n' % (drip.name, e))
+
+    def run_within_budget(self, drips, budget=None, log_errors=False):
+        """
+        Run drips in order for as long as each one's estimated duration
+        still fits in what is left of budget seconds. A drip that doesn't
+        fit is deferred, but smaller ones after it may still run.
+
+        Returns two lists of (drip, seconds taken or estimated).
+        """
+        from django import db
+
+        start = time.time()
+        ran, deferred = [], []
+
+        for drip in drips:
+            if getattr(self, 'stopping', False):
+                break
+
+            estimate = drip.estimated_duration or 0
+            if budget and time.time() - start + estimate > budget:
+                deferred.append((drip, estimate))
+                continue
+
+            drip_start = time.time()
+            try:
+                self.dripbase(drip).run()
+            except DripTimeout as e:
+                logger.warning('Drip %s timed out: %s', drip.name, e)
+            except db.DatabaseError:
+                raise
+            except Exception:
+                if not log_errors:
+                    raise
+                logger.exception('Drip %s failed', drip.name)
+            else:
+                ran.append((drip, time.time() - drip_start))
+
+        return ran, deferred
+
+    def evaluate(self, drips, limit_to=None):
+        """
+        Evaluate the audiences of every drip `drip.batch` can handle in one
+        query, and keep them for `dripbase`.
+        """
+        from drip.batch import evaluate_drips
+
+        evaluated = evaluate_drips([drip.drip for drip in drips], limit_to=limit_to)
+        self.evaluated = dict((drip.drip_model.id, drip) for drip in evaluated)
+        logger.info('Evaluated %d of %d drips in one pass', len(evaluated), len(drips))
+
+    def dripbase(self, drip):
+        """
+        The DripBase to run for a Drip, evaluated up front if it could be.
+        """
+        return getattr(self, 'evaluated', {}).pop(drip.id, None) or drip.drip
+
+    def run_pending(self, drips):
+        """
+        Run every drip for just the users queued in PendingUser, then
+        clear them from the queue. Returns the number of users it had.
+        """
+        from datetime import datetime
+        from drip.models import PendingUser
+
+        started = datetime.now()
+        user_ids = PendingUser.pending(started)
+        if len(user_ids):
+            if self.batch_evaluate:
+                self.evaluate(drips, limit_to=user_ids)
+            for drip in drips:
+                dripbase = self.evaluated.pop(drip.id, None)
+                if dripbase is None:
+                    dripbase = drip.drip
+                    dripbase.limit_to(user_ids)
+                try:
+                    # a few users' run says nothing about the drip's schedule or duration
+                    dripbase.run(record=False)
+                except DripTimeout as e:
+                    logger.warning('Drip %s timed out: %s', drip.name, e)
+        PendingUser.clear(started)
+        return len(user_ids)
+
+    def report(self, ran, deferred, budget):
+        for drip, seconds in ran:
+            self.stdout.write('ran       %-40s priority %4d %8.1fs\n' % (drip.name, drip.priority, seconds))
+        for drip, seconds in deferred:
+            self.stdout.write('deferred  %-40s priority %4d %8.1fs estimated\n' % (drip.name, drip.priority, seconds))
+        if deferred:
+            self.stdout.write('%d drip(s) deferred, they did not fit in the %ds budget\n' % (len(deferred), budget))
+
+    def daemon(self, tick, time_budget=None):
+        """
+        Run due drips every tick seconds until SIGTERM or SIGINT, which
+        let the drip being sent finish first.
+        """
+        from django import db
+
+        self.stopping = False
+        def stop(signum, frame):
+            logger.info('send_drips daemon stopping after the current drip')
+            self.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not self.stopping:
+            try:
+                self.run_due(time_budget)
+            except db.DatabaseError:
+                logger.exception('send_drips daemon lost its database connection')
+                db.close_connection()
+
+            db.reset_queries()
+            next_tick = time.time() + tick
+            while not self.stopping and time.time() < next_tick:
+                time.sleep(min(1, tick))
+
+    def run_due(self, time_budget=None):
+        """
+        Run every enabled drip whose send_interval has passed, highest
+        priority first. Returns the names of the drips that ran.
+        """
+        from django import db
+        from drip.models import Drip
+
+        due = []
+        for drip in Drip.objects.filter(enabled=True).order_by('-priority', 'id'):
+            try:
+                if drip.is_due():
+                    due.append(drip)
+            except (TypeError, ValueError):
+                # eg. a send_interval saved before it was validated
+                logger.exception('Drip %s has a bad send_interval %r', drip.name, drip.send_interval)
+        if getattr(self, 'batch_evaluate', False):
+            self.evaluate(due)
+
+        ran, deferred = self.run_within_budget(due, time_budget, log_errors=True)
+        for drip, estimate in deferred:
+            logger.warning('Deferred drip %s, estimated %.1fs did not fit the %ds budget',
+                           drip.name, estimate, time_budget)
+
+        # don't sit idle in a transaction between ticks
+        db.transaction.commit_unless_managed()
+        return [drip.name for drip, seconds in ran]
+
+    def profile(self, drip_model, profile_dir):
+        """
+        Dry run a drip under cProfile, capturing every query on each of
+        its databases and the time spent in each phase, and write
+        `<slug>.txt`, `<slug>.sql` and `<slug>.prof`.
+        """
+        import cProfile
+        import pstats
+        from StringIO import StringIO
+
+        from django.db import connections
+        from django.template.defaultfilters import slugify
+        from drip.instrumentation import run_databases
+        from drip.signals import drip_phase_finished
+        from drip.utils import watch_queries, unwatch_queries
+
+        phases = []
+        def collect(sender, drip, phase, duration, queries, rows, **kwargs):
+            phases.append((phase, duration, queries, rows))
+
+        queries = []
+        watchers = []
+        for alias in run_databases(drip_model.drip):
+            def log_query(sql, duration, alias=alias):
+                queries.append((alias, sql, duration))
+            watch_queries(connections[alias], log_query)
+            watchers.append((connections[alias], log_query))
+        drip_phase_finished.connect(collect)
+
+        profiler = cProfile.Profile()
+        try:
+            count = profiler.runcall(drip_model.drip.run, dry_run=True)
+        finally:
+            drip_phase_finished.disconnect(collect)
+            for connection, log_query in watchers:
+                unwatch_queries(connection, log_query)
+
+        filename = os.path.join(profile_dir, slugify(drip_model.name))
+        profiler.dump_stats(filename + '.prof')
+
+        log = open(filename + '.sql', 'w')
+        try:
+            for alias, sql, duration in queries:
+                log.write((u'-- %s, %.3fs\n%s;\n\n' % (alias, duration, sql)).encode('utf-8'))
+        finally:
+            log.close()
+
+        out = StringIO()
+        out.write('Drip: %s\n' % drip_model.name)
+        out.write('Users (dry run): %d\n' % count)
+
+        out.write('\n== phases ==\n')
+        for phase, duration, num_queries, rows in phases:
+            out.write('%-10s %10.4fs %6d queries %8d rows\n' % (phase, duration, num_queries, rows))
+        out.write('%-10s %10.4fs\n' % ('send', sum([p[1] for p in phases if p[0] in SEND_PHASES])))
+
+        out.write('\n== slowest queries (%d total) ==\n' % len(queries))
+        for alias, sql, duration in sorted(queries, key=lambda query: query[2], reverse=True)[:10]:
+            out.write('%.3fs  %s  %s\n' % (duration, alias, sql))
+
+        out.write('\n== top functions ==\n')
+        stats = pstats.Stats(profiler, stream=out)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(25)
+
+        report = open(filename + '.txt', 'w')
+        try:
+            report.write(out.getvalue())
+        finally:
+            report.close()
+
+        self.stdout.write('%s: %d, report in %s.txt, queries in %s.sql\n'
+                          % (drip_model.name, count, filename, filename))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'SentDripFilter'
+        db.create_table('drip_sentdripfilter', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('lastchanged', self.gf('django.db.models.fields.DateTimeField')(auto_now=True, blank=True)),
+            ('drip', self.gf('django.db.models.fields.related.OneToOneField')(related_name='sent_filter', unique=True, to=orm['drip.Drip'])),
+            ('bits', self.gf('django.db.models.fields.TextField')(blank=True)),
+            ('num_bits', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('num_hashes', self.gf('django.db.models.fields.PositiveSmallIntegerField')(default=0)),
+            ('capacity', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('max_sentdrip_id', self.gf('django.db.models.fields.IntegerField')(default=0)),
+        ))
+        db.send_create_signal('drip', ['SentDripFilter'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'SentDripFilter'
+        db.delete_table('drip_sentdripfilter')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'drip.audiencesnapshot': {
+            'Meta': {'ordering': "['-id']", 'object_name': 'AudienceSnapshot'},
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'drip': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'audience_snapshots'", 'to': "orm['drip.Drip']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'size': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'})
+        },
+        'drip.audiencesnapshotentry': {
+            'Meta': {'object_name': 'AudienceSnapshotEntry'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'snapshot': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'entries'", 'to': "orm['drip.AudienceSnapshot']"}),
+            'user_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        },
+        'drip.baserule': {
+            'Meta': {'object_name': 'BaseRule'},
+            'annotate': ('django.db.models.fields.CharField', [], {'default': "'none'", 'max_length': '32'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'drip': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['drip.Drip']"}),
+            'field_name': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'field_value': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lastchanged': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'lookup_type': ('django.db.models.fields.CharField', [], {'default': "'exact'", 'max_length': '12'}),
+            'method_type': ('django.db.models.fields.CharField', [], {'default': "'filter'", 'max_length': '12'})
+        },
+        'drip.drip': {
+            'Meta': {'object_name': 'Drip'},
+            'body_html_template': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'estimated_duration': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_run': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'lastchanged': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'priority': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'send_interval': ('django.db.models.fields.CharField', [], {'max_length': '64', 'blank': 'True'}),
+            'subject_template': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'template_name': ('django.db.models.fields.CharField', [], {'default': "'Drip Template'", 'max_length': '255', 'blank': 'True'})
+        },
+        'drip.excludesubqueryrule': {
+            'Meta': {'object_name': 'ExcludeSubqueryRule', '_ormbases': ['drip.BaseRule']},
+            'app_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'baserule_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['drip.BaseRule']", 'unique': 'True', 'primary_key': 'True'}),
+            'model_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'user_field': ('django.db.models.fields.CharField', [], {'default': "'user'", 'max_length': '128'})
+        },
+        'drip.querysetrule': {
+            'Meta': {'object_name': 'QuerySetRule', '_ormbases': ['drip.BaseRule']},
+            'baserule_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['drip.BaseRule']", 'unique': 'True', 'primary_key': 'True'})
+        },
+        'drip.sentdrip': {
+            'Meta': {'object_name': 'SentDrip'},
+            'body': ('django.db.models.fields.TextField', [], {}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'drip': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sent_drips'", 'to': "orm['drip.Drip']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'subject': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'sent_drips'", 'to': "orm['auth.User']"})
+        },
+        'drip.sentdripfilter': {
+            'Meta': {'object_name': 'SentDripFilter'},
+            'bits': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'capacity': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'drip': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'sent_filter'", 'unique': 'True', 'to': "orm['drip.Drip']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lastchanged': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'max_sentdrip_id': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'num_bits': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'num_hashes': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0'})
+        },
+        'drip.subqueryrule': {
+            'Meta': {'object_name': 'SubqueryRule', '_ormbases': ['drip.BaseRule']},
+            'app_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'baserule_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['drip.BaseRule']", 'unique': 'True', 'primary_key': 'True'}),
+            'model_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'user_field': ('django.db.models.fields.CharField', [], {'default': "'user'", 'max_length': '128'})
+        }
+    }
+
+    complete_apps = ['drip']
\ No newline at end of file
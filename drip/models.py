@@ -4,12 +4,31 @@ from django.db.models import Count, Min, Max, Sum, Avg
 from django.db import models
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from drip.signals import connect_to_models
 
 # just using this to parse, but totally insane package naming...
 # https://bitbucket.org/schinckel/django-timedelta-field/
 import timedelta as djangotimedelta
 
 
+def validate_timedelta(value):
+    """
+    Reject intervals `djangotimedelta.parse` can't read; it wants eg.
+    `3 days` or `6 hours`. An empty interval, eg. `0 days`, would have
+    a drip run on every daemon tick, so that is out too.
+    """
+    if not value:
+        return
+    try:
+        interval = djangotimedelta.parse(value)
+    except (TypeError, ValueError):
+        raise ValidationError(u'`%s` is not an interval like `1 day` or `6 hours`.' % value)
+    if interval <= timedelta(0):
+        raise ValidationError(u'`%s` is an empty interval.' % value)
+
+
 class Drip(models.Model):
     date = models.DateTimeField(auto_now_add=True)
     lastchanged = models.DateTimeField(auto_now=True)
@@ -21,6 +40,19 @@ class Drip(models.Model):
         help_text='A unique name for this drip.')
 
     enabled = models.BooleanField(default=False)
+    priority = models.IntegerField(default=0,
+        help_text='Higher priority drips send first, so they get users ahead of the frequency cap.')
+
+    send_interval = models.CharField(max_length=64, blank=True, validators=[validate_timedelta],
+        help_text=('How often `send_drips --daemon` runs this drip, eg. `1 day` or `6 hours`. ' +
+                   'Blank uses DRIP_DAEMON_DEFAULT_INTERVAL.'))
+    last_run = models.DateTimeField(null=True, blank=True, editable=False)
+    estimated_duration = models.FloatField(null=True, blank=True, editable=False,
+        help_text='Seconds a run usually takes, averaged over past runs.')
+    failed = models.BooleanField(default=False, editable=False,
+        help_text='The last run timed out under DRIP_STATEMENT_TIMEOUT or DRIP_TIME_LIMIT.')
+    failure_sql = models.TextField(blank=True, editable=False,
+        help_text='The statement the last failed run was stuck on.')
 
     subject_template = models.TextField(null=True, blank=True)
     if getattr(settings, 'DRIP_USE_CREATESEND', False):        
@@ -51,6 +83,29 @@ class Drip(models.Model):
                         body_template=self.body_html_template if self.body_html_template else None)
         return drip
 
+    def is_due(self, now=None):
+        """
+        Whether `send_interval` has passed since this drip last ran.
+        """
+        if self.last_run is None:
+            return True
+        interval = self.send_interval or getattr(settings, 'DRIP_DAEMON_DEFAULT_INTERVAL', '1 day')
+        return self.last_run + djangotimedelta.parse(interval) <= (now or datetime.now())
+
+    def rules_hash(self):
+        """
+        A digest of every rule on this drip, so results computed from the
+        rules can be cached until someone edits them.
+        """
+        import hashlib
+
+        rules = []
+        for Rule in (QuerySetRule, SubqueryRule, ExcludeSubqueryRule, SentDripRule):
+            fields = [f.name for f in Rule._meta.fields
+                      if not f.primary_key and f.name not in ('date', 'lastchanged')]
+            rules.append(sorted(Rule.objects.filter(drip=self).values_list(*fields)))
+        return hashlib.md5(repr(rules)).hexdigest()
+
     def __unicode__(self):
         return self.name
 
@@ -59,7 +114,7 @@ class SentDrip(models.Model):
     """
     Keeps a record of all sent drips.
     """
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
 
     drip = models.ForeignKey('drip.Drip', related_name='sent_drips')
     user = models.ForeignKey('auth.User', related_name='sent_drips')
@@ -68,6 +123,557 @@ class SentDrip(models.Model):
     body = models.TextField()
 
 
+class SentDripClaim(models.Model):
+    """
+    One row per drip and user, ever. A run inserts claims before sending
+    and only sends to the users whose claim it got in, so overlapping runs
+    can't send anyone a drip twice.
+    """
+    date = models.DateTimeField(auto_now_add=True)
+
+    drip = models.ForeignKey('drip.Drip', related_name='claims')
+    user = models.ForeignKey('auth.User', related_name='drip_claims')
+    token = models.CharField(max_length=32, db_index=True)
+
+    class Meta:
+        unique_together = ('drip', 'user')
+
+    @classmethod
+    def claim(cls, drip, user_ids, token, using=None, batch_size=200):
+        """
+        Insert claims for user_ids, skipping users claimed already, and
+        return the set of user_ids this call claimed.
+        """
+        from django.db import router
+        from drip.utils import bulk_insert_ignore
+
+        using = using or router.db_for_write(cls)
+        user_ids = list(user_ids)
+        now = datetime.now()
+        bulk_insert_ignore(cls, ('drip', 'user', 'token', 'date'),
+                           [(drip.id, user_id, token, now) for user_id in user_ids],
+                           using=using, batch_size=batch_size)
+
+        claimed = set()
+        for start in xrange(0, len(user_ids), 500):
+            claimed.update(cls.objects.using(using)
+                                      .filter(drip=drip, token=token, user__in=user_ids[start:start + 500])
+                                      .values_list('user_id', flat=True))
+        return claimed
+
+    @classmethod
+    def release(cls, drip, token, using=None, unsent_only=False):
+        """
+        Drop the claims made with token, for a run that claimed users but
+        couldn't send to them, so the next run can. With unsent_only the
+        users it did record a SentDrip for keep their claims.
+        """
+        from django.db import router
+
+        using = using or router.db_for_write(cls)
+        claims = cls.objects.using(using).filter(drip=drip, token=token)
+        if unsent_only:
+            claims = claims.exclude(user__in=SentDrip.objects.using(using).filter(drip=drip).values('user'))
+        return claims.delete()
+
+    def __unicode__(self):
+        return u'%s claimed %s' % (self.user_id, self.drip)
+
+
+OUTBOX_STATUSES = (
+    ('pending', 'Pending'),
+    ('leased', 'Leased'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+
+class DripOutbox(models.Model):
+    """
+    A user a drip run decided to send to, waiting for `drain_drip_outbox`
+    to render and deliver it. Workers lease rows with a conditional
+    update, so any number of them can drain the same outbox.
+    """
+    date = models.DateTimeField(auto_now_add=True)
+
+    drip = models.ForeignKey('drip.Drip', related_name='outbox')
+    user = models.ForeignKey('auth.User', related_name='drip_outbox')
+    #: digest of the templates the row was queued under
+    render_key = models.CharField(max_length=32)
+
+    status = models.CharField(max_length=12, default='pending', choices=OUTBOX_STATUSES, db_index=True)
+    lease_token = models.CharField(max_length=32, blank=True, db_index=True)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    sent = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    @classmethod
+    def queued_user_ids(cls, drip, user_ids):
+        """
+        Which of user_ids are queued for drip, delivered or not. Only
+        failed rows leave a user free to be queued again.
+        """
+        return set(cls.objects.filter(drip=drip, user__in=user_ids, status__in=('pending', 'leased', 'done'))
+                              .values_list('user_id', flat=True))
+
+    @classmethod
+    def lease(cls, batch_size=100, lease_seconds=300):
+        """
+        Lease up to batch_size rows that are pending, or whose lease has
+        run out, and return them. The UPDATE only takes rows still in the
+        state they were picked in, so two workers never get the same row.
+        """
+        import uuid
+        from django.db.models import F, Q
+
+        now = datetime.now()
+        available = Q(status='pending') | Q(status='leased', leased_until__lt=now)
+        ids = list(cls.objects.filter(available).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+
+        token = uuid.uuid4().hex
+        cls.objects.filter(available, id__in=ids).update(status='leased',
+                                                         lease_token=token,
+                                                         leased_until=now + timedelta(seconds=lease_seconds),
+                                                         attempts=F('attempts') + 1)
+        return list(cls.objects.filter(lease_token=token, status='leased')
+                               .select_related('drip', 'user').order_by('id'))
+
+    def __unicode__(self):
+        return u'%s to %s (%s)' % (self.drip, self.user_id, self.status)
+
+
+class PendingUser(models.Model):
+    """
+    A user whose data changed since the last `send_drips --pending`, and
+    so may have just become eligible for a drip. One row per user; saving
+    again only moves `date` forward.
+    """
+    user_id = models.IntegerField(unique=True)
+    date = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def enqueue(cls, user_ids):
+        from drip.utils import bulk_insert_ignore
+
+        now = datetime.now()
+        user_ids = [user_id for user_id in user_ids if user_id is not None]
+        if not user_ids:
+            return
+        if cls.objects.filter(user_id__in=user_ids).update(date=now) < len(user_ids):
+            bulk_insert_ignore(cls, ('user_id', 'date'), [(user_id, now) for user_id in user_ids])
+
+    @classmethod
+    def pending(cls, before):
+        """
+        An IdSet of the users queued before datetime before.
+        """
+        from drip.idsets import IdSet
+        return IdSet.from_sorted(cls.objects.filter(date__lt=before).order_by('user_id')
+                                            .values_list('user_id', flat=True).iterator())
+
+    @classmethod
+    def clear(cls, before):
+        """
+        Forget users queued before datetime before, leaving anyone saved
+        again since then for the next run.
+        """
+        cls.objects.filter(date__lt=before).delete()
+
+    def __unicode__(self):
+        return u'%s pending since %s' % (self.user_id, self.date)
+
+
+def enqueue_pending_user(sender, instance, **kwargs):
+    """
+    Queue the user behind an instance of any model listed in
+    `DRIP_ELIGIBILITY_MODELS`, a dict of 'app_label.Model' to the field
+    that holds (or is) the user, eg. {'auth.User': 'pk',
+    'credits.Profile': 'user'}. Only those models are connected.
+    """
+    eligibility_models = getattr(settings, 'DRIP_ELIGIBILITY_MODELS', None)
+    if not eligibility_models or kwargs.get('raw'):
+        return
+
+    field_name = eligibility_models.get('%s.%s' % (sender._meta.app_label, sender._meta.object_name))
+    if field_name is None:
+        return
+    if field_name != 'pk':
+        field_name = sender._meta.get_field(field_name).attname
+    PendingUser.enqueue([getattr(instance, field_name)])
+
+def connect_eligibility_models():
+    connect_to_models(enqueue_pending_user, getattr(settings, 'DRIP_ELIGIBILITY_MODELS', None) or (),
+                      dispatch_uid='drip.enqueue_pending_user')
+
+connect_eligibility_models()
+
+
+class UserFeature(models.Model):
+    """
+    The value of one of `DRIP_USER_FEATURES` for one user. Users without
+    rows to aggregate have no value: `filter` rules on the feature never
+    match them, and `exclude` rules never drop them. Count features are
+    the exception, their rules take a missing value for 0.
+    """
+    user = models.ForeignKey(User, related_name='drip_features')
+    name = models.CharField(max_length=64)
+    value_number = models.FloatField(null=True, blank=True)
+    value_date = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('name', 'user')
+
+    def __unicode__(self):
+        value = self.value_date if self.value_number is None else self.value_number
+        return u'%s of %s: %s' % (self.name, self.user_id, value)
+
+
+def update_user_features(sender, instance, **kwargs):
+    """
+    Recompute the `DRIP_USER_FEATURES` that aggregate sender for the user
+    behind instance. A failure is logged and rolled back to a savepoint
+    rather than breaking the save it came from; `refresh_drip_features`
+    catches the user up later.
+    """
+    if not getattr(settings, 'DRIP_USER_FEATURES', None) or kwargs.get('raw'):
+        return
+
+    import logging
+    from django.db import router, transaction, DatabaseError
+    from drip.features import features_for_model
+
+    using = router.db_for_write(UserFeature)
+    for feature in features_for_model(sender):
+        user_id = getattr(instance, feature.user_attname)
+        if user_id is None:
+            continue
+        sid = transaction.savepoint(using=using)
+        try:
+            feature.refresh([user_id])
+            transaction.savepoint_commit(sid, using=using)
+        except DatabaseError:
+            transaction.savepoint_rollback(sid, using=using)
+            logging.getLogger('drip').exception('Could not update drip feature %s of user %s', feature.name, user_id)
+
+def connect_feature_models():
+    features = getattr(settings, 'DRIP_USER_FEATURES', None) or {}
+    connect_to_models(update_user_features, [definition['model'] for definition in features.values()],
+                      dispatch_uid='drip.update_user_features')
+
+connect_feature_models()
+
+
+class SentDripStat(models.Model):
+    """
+    How many SentDrips a drip recorded on one day, kept up to date by each
+    run so reports never have to GROUP BY over SentDrip.
+    """
+    drip = models.ForeignKey('drip.Drip', related_name='sent_stats')
+    date = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('drip', 'date')
+        ordering = ['-date']
+
+    @classmethod
+    def increment(cls, drip, date, count):
+        """
+        Add the count SentDrips a run (or outbox drain) just wrote to date.
+        Runs pass their own count rather than counting rows, which would
+        take in whatever concurrent runs wrote too.
+        """
+        from django.db.models import F
+
+        if not count:
+            return
+        stat, created = cls.objects.get_or_create(drip=drip, date=date, defaults={'count': count})
+        if not created:
+            cls.objects.filter(id=stat.id).update(count=F('count') + count)
+
+    def __unicode__(self):
+        return u'%s on %s: %d' % (self.drip, self.date, self.count)
+
+
+class SentDripFilter(models.Model):
+    """
+    A Bloom filter over the users a drip has been sent to, so prune only
+    has to ask the database about the few users it might match.
+
+    It is caught up from SentDrips past `max_sentdrip_id`. That mark only
+    moves past rows older than `DRIP_SENT_FILTER_LAG` seconds, so a row
+    committed late with a lower id than its neighbours is still picked up.
+    """
+    lastchanged = models.DateTimeField(auto_now=True)
+
+    drip = models.OneToOneField('drip.Drip', related_name='sent_filter')
+
+    bits = models.TextField(blank=True)
+    num_bits = models.PositiveIntegerField(default=0)
+    num_hashes = models.PositiveSmallIntegerField(default=0)
+    capacity = models.PositiveIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+    max_sentdrip_id = models.IntegerField(default=0)
+
+    @classmethod
+    def for_drip(cls, drip):
+        """
+        The filter of drip, created or brought up to date as needed.
+        """
+        sent_filter, created = cls.objects.get_or_create(drip=drip)
+        sent_filter.refresh(rebuild=created)
+        return sent_filter
+
+    def bloom(self):
+        from drip.idsets import BloomFilter
+
+        if not hasattr(self, '_bloom'):
+            self._bloom = BloomFilter.from_string(self.num_bits, self.num_hashes, self.bits)
+        return self._bloom
+
+    def refresh(self, rebuild=False):
+        """
+        Add users from SentDrips written since the last refresh. Starts
+        over, sized for twice the sends so far, when rebuild is set or the
+        filter has filled up past its capacity.
+        """
+        from drip.idsets import BloomFilter
+
+        if not rebuild and self.count > self.capacity:
+            rebuild = True
+
+        if rebuild:
+            capacity = max(2 * SentDrip.objects.filter(drip=self.drip_id).count(),
+                           getattr(settings, 'DRIP_SENT_FILTER_MIN_CAPACITY', 10000))
+            self._bloom = BloomFilter.for_capacity(capacity)
+            self.num_bits, self.num_hashes = self._bloom.num_bits, self._bloom.num_hashes
+            self.capacity = capacity
+            self.count = self.max_sentdrip_id = 0
+
+        bloom = self.bloom()
+        settled = datetime.now() - timedelta(seconds=getattr(settings, 'DRIP_SENT_FILTER_LAG', 3600))
+        moving = True
+        added = 0
+
+        sent = SentDrip.objects.filter(drip=self.drip_id, id__gt=self.max_sentdrip_id)\
+                               .order_by('id').values_list('id', 'user', 'date')
+        for sent_id, user_id, date in sent.iterator():
+            bloom.add(user_id)
+            added += 1
+            if moving and date < settled:
+                self.max_sentdrip_id = sent_id
+                self.count += 1
+            else:
+                moving = False
+
+        if added or rebuild:
+            self.bits = bloom.to_string()
+            self.save()
+
+    def sent_user_ids(self, user_ids, batch_size=500):
+        """
+        Which of user_ids were sent the drip. Only the ones the filter
+        can't rule out are looked up.
+        """
+        bloom = self.bloom()
+        maybe = [user_id for user_id in user_ids if user_id in bloom]
+
+        sent = set()
+        for start in xrange(0, len(maybe), batch_size):
+            sent.update(SentDrip.objects.filter(drip=self.drip_id, user__in=maybe[start:start + batch_size])
+                                        .values_list('user_id', flat=True))
+        return sent
+
+    def __unicode__(self):
+        return u'Sent filter for %s' % self.drip
+
+
+
+class AudienceSnapshot(models.Model):
+    """
+    The users a drip was about to send to on one run, kept so runs can be
+    compared and looked over without re-running the rules.
+    """
+    date = models.DateTimeField(auto_now_add=True)
+
+    drip = models.ForeignKey('drip.Drip', related_name='audience_snapshots')
+    size = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-id']
+
+    def user_ids(self):
+        return self.entries.values_list('user_id', flat=True)
+
+    def previous(self):
+        try:
+            return AudienceSnapshot.objects.filter(drip=self.drip_id, id__lt=self.id)[0]
+        except IndexError:
+            return None
+
+    def diff(self, other):
+        """
+        Returns (added, removed): user ids in this snapshot but not in
+        other, and the other way around. Both are done in SQL.
+        """
+        added = self.user_ids().exclude(user_id__in=other.user_ids())
+        removed = other.user_ids().exclude(user_id__in=self.user_ids())
+        return added, removed
+
+    @classmethod
+    def take(cls, drip, user_ids, batch_size=1000):
+        """
+        Store user_ids as a new snapshot of drip, in bulk, then drop any
+        snapshots past `DRIP_AUDIENCE_SNAPSHOT_RETENTION`.
+        """
+        snapshot = cls.objects.create(drip=drip)
+
+        size = 0
+        batch = []
+        for user_id in user_ids:
+            batch.append(AudienceSnapshotEntry(snapshot=snapshot, user_id=user_id))
+            if len(batch) >= batch_size:
+                AudienceSnapshotEntry.objects.bulk_create(batch)
+                size += len(batch)
+                batch = []
+        AudienceSnapshotEntry.objects.bulk_create(batch)
+        size += len(batch)
+
+        cls.objects.filter(id=snapshot.id).update(size=size)
+        snapshot.size = size
+
+        retention = getattr(settings, 'DRIP_AUDIENCE_SNAPSHOT_RETENTION', 7)
+        expired = list(cls.objects.filter(drip=drip).values_list('id', flat=True)[retention:])
+        if expired:
+            AudienceSnapshotEntry.objects.filter(snapshot__in=expired).delete()
+            cls.objects.filter(id__in=expired).delete()
+
+        return snapshot
+
+    def __unicode__(self):
+        return u'%s on %s' % (self.drip, self.date)
+
+
+class AudienceSnapshotEntry(models.Model):
+    snapshot = models.ForeignKey(AudienceSnapshot, related_name='entries')
+    user_id = models.IntegerField(db_index=True)
+
+
+class AudienceView(models.Model):
+    """
+    A database view, `drip_audience_<drip id>`, of the user ids a drip's
+    rules select, which runs and previews read instead of the rules. On
+    PostgreSQL it can be a materialized view with a unique index.
+
+    Rule values like `now-7 days` are fixed when the view is built, so a
+    view is only used within `DRIP_AUDIENCE_VIEW_MAX_AGE` seconds of its
+    last refresh, and only while the rules hash the same.
+    """
+    drip = models.OneToOneField('drip.Drip', related_name='audience_view')
+    materialized = models.BooleanField(default=False,
+        help_text='Materialize the view, on PostgreSQL only.')
+
+    sql = models.TextField(blank=True, editable=False)
+    #: what is in the database now, 'VIEW' or 'MATERIALIZED VIEW'
+    kind = models.CharField(max_length=32, blank=True, editable=False)
+    rules_hash = models.CharField(max_length=32, blank=True, editable=False)
+    refreshed = models.DateTimeField(null=True, blank=True, editable=False)
+
+    @property
+    def name(self):
+        return 'drip_audience_%d' % self.drip_id
+
+    def connection(self):
+        from django.db import connections, router
+        return connections[router.db_for_write(AudienceView)]
+
+    def is_materialized(self):
+        return self.materialized and self.connection().vendor == 'postgresql'
+
+    def compile(self):
+        """
+        The SELECT behind the view, from the drip's rules as of now.
+        """
+        from django.db import router
+        from drip.utils import inline_sql
+
+        drip = self.drip.drip
+        qs = drip.apply_queryset_rules(drip.queryset().using(router.db_for_write(AudienceView)))
+        if drip._temp_tables:
+            drip.drop_temp_tables()
+            raise ValueError('Drip %s has too many subquery rule users to put in a view, '
+                             'raise DRIP_IDSET_TEMP_TABLE_THRESHOLD.' % self.drip)
+        return inline_sql(qs.values_list('id', flat=True).order_by())
+
+    def refresh(self):
+        """
+        Bring the view up to date. A materialized view whose SQL hasn't
+        changed is refreshed in place, concurrently so readers aren't
+        blocked. Relative dates change the SQL on most refreshes though,
+        so a changed materialized view is built alongside the old one and
+        swapped in by renaming it. A plain view is cheap to build, so it
+        is just dropped and created again.
+        """
+        from django.db import transaction
+
+        connection = self.connection()
+        qn = connection.ops.quote_name
+        sql = self.compile()
+        kind = 'MATERIALIZED VIEW' if self.is_materialized() else 'VIEW'
+        cursor = connection.cursor()
+
+        if sql == self.sql and kind == self.kind:
+            if kind == 'MATERIALIZED VIEW':
+                cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY %s' % qn(self.name))
+        elif kind == 'MATERIALIZED VIEW':
+            building = self.name + '_new'
+            cursor.execute('DROP MATERIALIZED VIEW IF EXISTS %s' % qn(building))
+            cursor.execute('CREATE MATERIALIZED VIEW %s AS %s' % (qn(building), sql))
+            cursor.execute('CREATE UNIQUE INDEX %s ON %s (id)' % (qn(building + '_id'), qn(building)))
+            # readers only wait for the swap, not the build
+            self.drop_view()
+            cursor.execute('ALTER MATERIALIZED VIEW %s RENAME TO %s' % (qn(building), qn(self.name)))
+            cursor.execute('ALTER INDEX %s RENAME TO %s' % (qn(building + '_id'), qn(self.name + '_id')))
+        else:
+            self.drop_view()
+            cursor.execute('CREATE VIEW %s AS %s' % (qn(self.name), sql))
+        transaction.commit_unless_managed(using=connection.alias)
+
+        self.sql = sql
+        self.kind = kind
+        self.rules_hash = self.drip.rules_hash()
+        self.refreshed = datetime.now()
+        self.save()
+
+    def drop_view(self):
+        if self.kind:
+            connection = self.connection()
+            connection.cursor().execute('DROP %s IF EXISTS %s' % (self.kind, connection.ops.quote_name(self.name)))
+            self.kind = ''
+
+    def is_usable(self):
+        max_age = timedelta(seconds=getattr(settings, 'DRIP_AUDIENCE_VIEW_MAX_AGE', 3600))
+        return self.refreshed is not None and \
+               self.refreshed + max_age > datetime.now() and \
+               self.rules_hash == self.drip.rules_hash()
+
+    def filter(self, qs):
+        """
+        Restrict a User queryset to the view.
+        """
+        from django.db import connections
+        from drip.utils import where_pk
+
+        return where_pk(qs, '{pk} IN (SELECT id FROM %s)' % connections[qs.db].ops.quote_name(self.name))
+
+    def __unicode__(self):
+        return self.name
+
+
 
 METHOD_TYPES = (
     ('filter', 'Filter'),
@@ -112,7 +718,8 @@ class BaseRule(models.Model):
     drip = models.ForeignKey(Drip)
 
     method_type = models.CharField(max_length=12, default='filter', choices=METHOD_TYPES)
-    field_name = models.CharField(max_length=128, verbose_name='Field name off User')
+    field_name = models.CharField(max_length=128, verbose_name='Field name off User',
+        help_text='Or `feature:<name>` for one of DRIP_USER_FEATURES.')
     annotate   = models.CharField(max_length=32, choices=ANNOTATE_TYPES, default='none')
     lookup_type = models.CharField(max_length=12, default='exact', choices=LOOKUP_TYPES)
 
@@ -121,7 +728,7 @@ class BaseRule(models.Model):
                    '`now-7 days` or `now+3 days` for fancy timedelta.'))
 
     def apply(self, qs, now=datetime.now):
-        if self.annotate != 'none':
+        if self.annotate != 'none' and not self.is_feature():
             field_name = "%s__annotate%s" % (self.field_name, self.id)
             if self.annotate == 'sum':
                 _kwargs = {
@@ -147,8 +754,25 @@ class BaseRule(models.Model):
         else:
             field_name = self.field_name
 
+        kwargs = self.filter_kwargs(field_name, now=now, using=qs.db)
 
-        field_name = '__'.join([field_name, self.lookup_type])
+        if self.method_type == 'filter':
+            return qs.filter(**kwargs)
+        elif self.method_type == 'exclude':
+            return qs.exclude(**kwargs)
+
+        # catch as default
+        return qs.filter(**kwargs)
+
+    def is_feature(self):
+        from drip.features import FEATURE_PREFIX
+        return self.field_name.startswith(FEATURE_PREFIX)
+
+    def filter_kwargs(self, field_name=None, now=datetime.now, using=None):
+        """
+        The {lookup: value} this rule filters or excludes by. Rules on a
+        `feature:<name>` look it up in `UserFeature`, on database using.
+        """
         field_value = self.field_value
 
         # set time deltas and dates
@@ -167,15 +791,13 @@ class BaseRule(models.Model):
         if field_value == 'False':
             field_value = False
 
-        kwargs = {field_name: field_value}
+        if self.is_feature():
+            from drip.features import FEATURE_PREFIX, get_feature
+            feature = get_feature(self.field_name[len(FEATURE_PREFIX):])
+            return feature.filter_kwargs(self.lookup_type, field_value, using=using)
 
-        if self.method_type == 'filter':
-            return qs.filter(**kwargs)
-        elif self.method_type == 'exclude':
-            return qs.exclude(**kwargs)
-
-        # catch as default
-        return qs.filter(**kwargs)
+        field_name = '__'.join([field_name or self.field_name, self.lookup_type])
+        return {field_name: field_value}
 
 class QuerySetRule(BaseRule):
     pass
@@ -190,3 +812,65 @@ class ExcludeSubqueryRule(BaseRule):
     app_name   = models.CharField(max_length=64, verbose_name='App where the model is stored')
     model_name = models.CharField(max_length=64, verbose_name='Model to subquery')
     user_field = models.CharField(max_length=128, verbose_name='Field name which is a foreign key to User', default='user')
+
+
+class SentDripRule(models.Model):
+    """
+    Keeps (filter) or drops (exclude) users who were sent another drip,
+    optionally only within a window, eg. "sent drip A more than 3 days
+    ago". Compiles to a correlated EXISTS on SentDrip's (drip, user, date)
+    index rather than a list of ids.
+    """
+    date = models.DateTimeField(auto_now_add=True)
+    lastchanged = models.DateTimeField(auto_now=True)
+
+    drip = models.ForeignKey(Drip, related_name='sent_drip_rules')
+    # a rule can't outlive the drip it follows up on
+    sent_drip = models.ForeignKey(Drip, related_name='+', verbose_name='Users sent drip',
+                                  on_delete=models.PROTECT)
+
+    method_type = models.CharField(max_length=12, default='filter', choices=METHOD_TYPES)
+    older_than = models.CharField(max_length=64, blank=True, validators=[validate_timedelta],
+        help_text='eg. `3 days`: only sends at least this long ago count. Blank for any.')
+    newer_than = models.CharField(max_length=64, blank=True, validators=[validate_timedelta],
+        help_text='eg. `30 days`: only sends at most this long ago count. Blank for any.')
+
+    def where(self, using=None, now=datetime.now):
+        """
+        The SQL and params of this rule as a condition on User, with
+        `{pk}` for the user's primary key column, for `AliasedWhere`.
+        """
+        from django.db import connections, DEFAULT_DB_ALIAS
+
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        qn = connection.ops.quote_name
+        opts = SentDrip._meta
+        column = lambda name: 'sent.%s' % qn(opts.get_field(name).column)
+
+        conditions, params = ['%s = {pk}' % column('user'), '%s = %%s' % column('drip')], [self.sent_drip_id]
+        if self.older_than:
+            conditions.append('%s <= %%s' % column('date'))
+            params.append(connection.ops.value_to_db_datetime(now() - djangotimedelta.parse(self.older_than)))
+        if self.newer_than:
+            conditions.append('%s >= %%s' % column('date'))
+            params.append(connection.ops.value_to_db_datetime(now() - djangotimedelta.parse(self.newer_than)))
+
+        sql = 'EXISTS (SELECT 1 FROM %s sent WHERE %s)' % (qn(opts.db_table), ' AND '.join(conditions))
+        if self.method_type == 'exclude':
+            sql = 'NOT ' + sql
+        return sql, params
+
+    def apply(self, qs, now=datetime.now):
+        from drip.utils import where_pk
+
+        sql, params = self.where(qs.db, now=now)
+        return where_pk(qs, sql, params)
+
+    def __unicode__(self):
+        return u'%s %s' % ('not sent' if self.method_type == 'exclude' else 'sent', self.sent_drip)
+
+
+def drop_audience_view(sender, instance, **kwargs):
+    instance.drop_view()
+
+models.signals.post_delete.connect(drop_audience_view, sender=AudienceView)
@@ -0,0 +1,148 @@
+"""
+Overlap the database work of a send with rendering.
+
+`Pipeline` reads items a chunk at a time on one background thread, hands
+them to a function on the calling thread, and passes what that returns
+in batches to another background thread. Queues between the threads are
+bounded, so neither side runs more than a few chunks ahead.
+
+The background threads use the calling thread's database connections,
+as Django's live server tests do, so they see the same transaction, temp
+tables and (under test) in-memory database. They take turns on them
+through a lock; only the calling thread runs alongside them.
+"""
+import sys
+import threading
+from itertools import islice
+from Queue import Queue, Empty, Full
+
+from django.db import connections
+
+
+#: marks the end of a queue
+DONE = object()
+
+
+class Pipeline(object):
+    #: seconds between checks for a failure on the other threads
+    poll = 0.1
+
+    def __init__(self, chunk_size=100, flush_size=100, queue_size=2, using=()):
+        self.chunk_size = chunk_size
+        self.flush_size = flush_size
+        self.queue_size = queue_size
+        self.using = using
+        self.lock = threading.Lock()
+
+    def run(self, items, process, flush):
+        """
+        Calls process on every item in items, and flush with lists of
+        whatever it returns other than None. items is iterated and flush
+        called on background threads. Returns the number of items
+        processed; the first exception raised anywhere stops the lot and
+        is raised here.
+        """
+        self.stopped = threading.Event()
+        self.exc_info = None
+        fetched, results = Queue(self.queue_size), Queue(self.queue_size)
+
+        shared = dict((alias, connections[alias]) for alias in self.using)
+        sharing = dict((alias, connection.allow_thread_sharing) for alias, connection in shared.items())
+        for connection in shared.values():
+            connection.allow_thread_sharing = True
+
+        threads = [threading.Thread(target=self.worker, args=(shared, self.fetch, items, fetched)),
+                   threading.Thread(target=self.worker, args=(shared, self.write, results, flush))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        count = 0
+        try:
+            batch = []
+            for chunk in self.drain(fetched):
+                for item in chunk:
+                    result = process(item)
+                    count += 1
+                    if result is not None:
+                        batch.append(result)
+                    if len(batch) >= self.flush_size:
+                        self.put(results, batch)
+                        batch = []
+            if batch:
+                self.put(results, batch)
+            self.put(results, DONE)
+        except:
+            self.stopped.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            for alias, connection in shared.items():
+                connection.allow_thread_sharing = sharing[alias]
+
+        self.check()
+        return count
+
+    def worker(self, shared, target, *args):
+        for alias, connection in shared.items():
+            connections[alias] = connection
+        try:
+            target(*args)
+        except StopPipeline:
+            pass
+        except:
+            if self.exc_info is None:
+                self.exc_info = sys.exc_info()
+            self.stopped.set()
+
+    def fetch(self, items, fetched):
+        iterator = iter(items)
+        while True:
+            with self.lock:
+                chunk = list(islice(iterator, self.chunk_size))
+            if not chunk:
+                break
+            self.put(fetched, chunk)
+        self.put(fetched, DONE)
+
+    def write(self, results, flush):
+        for batch in self.drain(results):
+            with self.lock:
+                flush(batch)
+
+    def check(self):
+        """
+        Raise, on this thread, whatever stopped another one.
+        """
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def put(self, queue, item):
+        while True:
+            if self.stopped.is_set():
+                self.check()
+                raise StopPipeline
+            try:
+                return queue.put(item, timeout=self.poll)
+            except Full:
+                pass
+
+    def drain(self, queue):
+        while True:
+            if self.stopped.is_set():
+                self.check()
+                raise StopPipeline
+            try:
+                item = queue.get(timeout=self.poll)
+            except Empty:
+                continue
+            if item is DONE:
+                return
+            yield item
+
+
+class StopPipeline(Exception):
+    """
+    Winds up a background thread once the pipeline has stopped.
+    """
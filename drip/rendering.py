@@ -0,0 +1,122 @@
+"""
+Render mostly static drip templates once per process instead of once per
+recipient.
+
+A template's top level nodes are split into static chunks, rendered up
+front, and slots, rendered for each recipient:
+
+* text is always static,
+* a `{{ variable }}` is static if neither it nor its filter arguments
+  look at `user`, and no tag comes before it that might have put
+  something into the context,
+* anything else, tags included, is a slot.
+
+Plain text versions are stripped a chunk at a time where that is sure to
+give what stripping the whole body would, and from the whole body
+otherwise.
+"""
+from django.template import Context, Template
+from django.template.base import TextNode, Variable, VariableNode
+from django.utils.html import strip_tags
+
+
+_partial_cache = {}
+
+
+def compile_partial(source):
+    """
+    A `PartialTemplate` for source, compiled once per process. Long
+    running processes drop the cache when it gets big.
+    """
+    try:
+        return _partial_cache[source]
+    except KeyError:
+        if len(_partial_cache) >= 256:
+            _partial_cache.clear()
+        partial = _partial_cache[source] = PartialTemplate(source)
+        return partial
+
+
+def uses_name(filter_expression, names):
+    """
+    Whether a variable, or any argument to its filters, starts with one
+    of names.
+    """
+    variables = [filter_expression.var]
+    for func, args in filter_expression.filters:
+        variables.extend([arg for lookup, arg in args if lookup])
+
+    for variable in variables:
+        if isinstance(variable, Variable) and variable.lookups and variable.lookups[0] in names:
+            return True
+    return False
+
+
+def closes_tags(text):
+    """
+    Whether stripping tags from text, then from what follows it, strips
+    the same as doing both at once; ie. no `<` is left open at the end.
+    """
+    return text.rfind('<') <= text.rfind('>')
+
+
+class PartialTemplate(object):
+    #: context names that differ per recipient
+    per_recipient = ('user',)
+
+    def __init__(self, source):
+        self.template = Template(source)
+
+        #: (text, None) for static chunks, (None, node) for slots
+        self.pieces = []
+        static = []
+        after_tag = False
+        context = Context()
+
+        for node in self.template.nodelist:
+            if isinstance(node, TextNode):
+                static.append(node.render(context))
+                continue
+            if isinstance(node, VariableNode) and not after_tag and \
+               not uses_name(node.filter_expression, self.per_recipient):
+                static.append(node.render(context))
+                continue
+
+            if not isinstance(node, VariableNode):
+                after_tag = True
+            if static:
+                self.pieces.append((u''.join(static), None))
+                static = []
+            self.pieces.append((None, node))
+        if static:
+            self.pieces.append((u''.join(static), None))
+
+        # strip the static chunks now, as long as no tags straddle pieces
+        self.plain = [strip_tags(text) if text is not None else None for text, node in self.pieces]
+        self.strip_by_piece = all([closes_tags(text) for text, node in self.pieces[:-1] if text is not None])
+
+    def is_static(self):
+        return all([node is None for text, node in self.pieces])
+
+    def render(self, context):
+        return self.render_with_plain(context, plain=False)[0]
+
+    def render_with_plain(self, context, plain=True):
+        """
+        Returns (rendered, rendered with tags stripped), the latter None
+        unless plain is set.
+        """
+        rendered = []
+        for text, node in self.pieces:
+            rendered.append(text if node is None else node.render(context))
+        body = u''.join(rendered)
+        if not plain:
+            return body, None
+
+        if not self.strip_by_piece or \
+           not all([closes_tags(part) for part, (text, node) in zip(rendered[:-1], self.pieces) if node is not None]):
+            return body, strip_tags(body)
+
+        stripped = [self.plain[i] if node is None else strip_tags(part)
+                    for i, (part, (text, node)) in enumerate(zip(rendered, self.pieces))]
+        return body, u''.join(stripped)
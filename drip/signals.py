@@ -0,0 +1,51 @@
+from django.db.models import get_model, signals as model_signals
+from django.dispatch import Signal
+
+
+#: sent by `DripBase.run` as each phase (rules, prune, fetch, render,
+#: dispatch, record) finishes. `memory` is the process' peak RSS in KB.
+drip_phase_finished = Signal(providing_args=['drip', 'phase', 'duration', 'queries', 'rows', 'memory'])
+
+
+#: {dispatch_uid: (receiver, set of lower cased 'app_label.model' labels)}
+_model_receivers = {}
+
+
+def _label(model):
+    return ('%s.%s' % (model._meta.app_label, model._meta.object_name)).lower()
+
+
+def _connect(receiver, model, dispatch_uid):
+    model_signals.post_save.connect(receiver, sender=model, dispatch_uid=dispatch_uid)
+    model_signals.post_delete.connect(receiver, sender=model, dispatch_uid=dispatch_uid)
+
+
+def connect_to_models(receiver, labels, dispatch_uid):
+    """
+    Connect receiver to post_save and post_delete of just the models
+    labelled 'app_label.Model' in labels, disconnecting it from whatever
+    it was connected to under dispatch_uid before. Models that aren't
+    loaded yet are connected as their class is prepared.
+    """
+    old_receiver, old_labels = _model_receivers.get(dispatch_uid, (None, set()))
+    for label in old_labels:
+        model = get_model(*label.split('.'), seed_cache=False, only_installed=False)
+        if model is not None:
+            model_signals.post_save.disconnect(old_receiver, sender=model, dispatch_uid=dispatch_uid)
+            model_signals.post_delete.disconnect(old_receiver, sender=model, dispatch_uid=dispatch_uid)
+
+    labels = set(label.lower() for label in labels)
+    _model_receivers[dispatch_uid] = (receiver, labels)
+    for label in labels:
+        model = get_model(*label.split('.'), seed_cache=False, only_installed=False)
+        if model is not None:
+            _connect(receiver, model, dispatch_uid)
+
+
+def connect_prepared_model(sender, **kwargs):
+    label = _label(sender)
+    for dispatch_uid, (receiver, labels) in _model_receivers.items():
+        if label in labels:
+            _connect(receiver, sender, dispatch_uid)
+
+model_signals.class_prepared.connect(connect_prepared_model)
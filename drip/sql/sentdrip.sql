@@ -0,0 +1,12 @@
+-- Multi column indexes, which syncdb creates along with the table.
+-- The South migrations create them too. On installs synced before an index was
+-- added, run it by hand.
+
+-- for the cross drip frequency cap
+CREATE INDEX drip_sentdrip_user_id_date ON drip_sentdrip (user_id, date);
+
+-- newest first sends of one drip, for the admin changelist
+CREATE INDEX drip_sentdrip_drip_id_id ON drip_sentdrip (drip_id, id);
+
+-- SentDripRules: was this user sent that drip, and when
+CREATE INDEX drip_sentdrip_drip_id_user_id_date ON drip_sentdrip (drip_id, user_id, date);
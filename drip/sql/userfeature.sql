@@ -0,0 +1,7 @@
+-- Multi column indexes, which syncdb creates along with the table.
+-- The South migrations create them too. On installs synced before an index was
+-- added, run it by hand.
+
+-- rules on a feature:<name> filter one feature by its value
+CREATE INDEX drip_userfeature_name_value_number ON drip_userfeature (name, value_number, user_id);
+CREATE INDEX drip_userfeature_name_value_date ON drip_userfeature (name, value_date, user_id);
@@ -1,6 +1,7 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User
 
 from drip.models import Drip, SentDrip, QuerySetRule
@@ -8,6 +9,22 @@ from drip.drips import DripBase
 from django.core.mail import EmailMultiAlternatives
 
 
+@contextmanager
+def override_connected_settings(connect, **options):
+    """
+    `override_settings` for settings that decide which models drip
+    signals are connected to, which only happens at import otherwise.
+    """
+    from django.test.utils import override_settings
+
+    try:
+        with override_settings(**options):
+            connect()
+            yield
+    finally:
+        connect()
+
+
 class DripsTestCase(TestCase):
     def setUp(self):
         """
@@ -222,3 +239,1285 @@ class DripsTestCase(TestCase):
         email = drip.build_email(user, send=True)
 
         self.assertIsInstance(email, EmailMultiAlternatives)
+
+
+    #######################
+    ### INSTRUMENTATION ###
+    #######################
+
+    def test_run_sends_phase_signals(self):
+        from drip.signals import drip_phase_finished
+
+        phases = {}
+        def receiver(sender, drip, phase, **kwargs):
+            phases[phase] = kwargs
+        drip_phase_finished.connect(receiver)
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+        try:
+            model_drip.drip.run()
+        finally:
+            drip_phase_finished.disconnect(receiver)
+
+        self.assertEqual(['fetch', 'prune', 'record', 'render', 'rules'], sorted(phases.keys()))
+        self.assertEqual(2, phases['fetch']['rows'])
+        self.assertEqual(2, phases['record']['rows'])
+        self.assertEqual(2, phases['record']['queries'])
+
+    def test_nested_phase(self):
+        from django.db import connection
+        from drip.instrumentation import Instrument
+
+        model_drip = self.build_joined_date_drip()
+        instrument = Instrument(model_drip.drip)
+        logged = len(connection.queries)
+        instrument.start()
+        try:
+            with instrument.phase('record'):
+                User.objects.count()
+                with instrument.phase('record'):
+                    User.objects.count()
+        finally:
+            instrument.finish()
+        self.assertEqual(2, instrument.phase('record').queries)
+        # counted, not logged
+        self.assertEqual(logged, len(connection.queries))
+
+    def test_statsd_phase(self):
+        import socket
+        from django.test.utils import override_settings
+        from drip.instrumentation import statsd_phase
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+
+        model_drip = self.build_joined_date_drip()
+        with override_settings(DRIP_STATSD_HOST='127.0.0.1', DRIP_STATSD_PORT=listener.getsockname()[1]):
+            statsd_phase(sender=None, drip=model_drip.drip, phase='render',
+                         duration=0.25, queries=3, rows=2, memory=None)
+
+        self.assertEqual(['drip.a_custom_week_ago.render.time:250|ms',
+                          'drip.a_custom_week_ago.render.queries:3|c',
+                          'drip.a_custom_week_ago.render.rows:2|c'],
+                         listener.recv(1024).split('\n'))
+        listener.close()
+
+    #################
+    ### PROFILING ###
+    #################
+
+    def test_dry_run(self):
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        self.assertEqual(2, model_drip.drip.run(dry_run=True))
+        self.assertEqual(0, SentDrip.objects.count())
+
+    def test_send_drips_profile(self):
+        import os
+        import shutil
+        import tempfile
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        profile_dir = tempfile.mkdtemp()
+        try:
+            call_command('send_drips', profile=True, profile_dir=profile_dir, stdout=StringIO())
+            self.assertTrue(os.path.exists(os.path.join(profile_dir, 'a-custom-week-ago.prof')))
+            report = open(os.path.join(profile_dir, 'a-custom-week-ago.txt')).read()
+            log = open(os.path.join(profile_dir, 'a-custom-week-ago.sql')).read()
+        finally:
+            shutil.rmtree(profile_dir)
+
+        self.assertEqual(0, SentDrip.objects.count())
+        self.assertIn('Users (dry run): 2', report)
+        self.assertIn('== slowest queries', report)
+        self.assertIn('apply_queryset_rules', report)
+        self.assertIn('-- default, ', log)
+        self.assertIn('FROM "auth_user"', log)
+        for phase in ('rules', 'prune', 'fetch', 'render', 'send'):
+            self.assertIn('\n%s ' % phase, report)
+
+    #################
+    ### SNAPSHOTS ###
+    #################
+
+    def test_audience_snapshots(self):
+        from django.test.utils import override_settings
+        from drip.models import AudienceSnapshot
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        with override_settings(DRIP_AUDIENCE_SNAPSHOTS=True, DRIP_AUDIENCE_SNAPSHOT_RETENTION=2):
+            model_drip.drip.run()
+            first = AudienceSnapshot.objects.get(drip=model_drip)
+            self.assertEqual(2, first.size)
+            self.assertEqual(set(model_drip.drip.get_queryset().values_list('id', flat=True)),
+                             set(first.user_ids()))
+
+            # everyone got it, so the next audience is empty
+            model_drip.drip.run()
+            second = AudienceSnapshot.objects.all()[0]
+            self.assertEqual(0, second.size)
+            self.assertEqual(first, second.previous())
+
+            added, removed = second.diff(first)
+            self.assertEqual(0, added.count())
+            self.assertEqual(set(first.user_ids()), set(removed))
+
+            model_drip.drip.run()
+            self.assertEqual(2, AudienceSnapshot.objects.count())
+            self.assertFalse(AudienceSnapshot.objects.filter(id=first.id).exists())
+
+    ##############
+    ### EXPORT ###
+    ##############
+
+    def test_iter_keyset(self):
+        from drip.utils import iter_keyset
+
+        qs = User.objects.filter(username__contains='credits_a_day')
+        rows = list(iter_keyset(qs, ['email'], chunk_size=3))
+        self.assertEqual([(u.email,) for u in qs.order_by('id')], rows)
+
+        rows = list(iter_keyset(qs, ['id', 'username'], chunk_size=4))
+        self.assertEqual(list(qs.order_by('id').values_list('id', 'username')), rows)
+
+    def test_audience_csv_rows(self):
+        from drip.admin import audience_csv_rows
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.drip.send()
+        QuerySetRule.objects.filter(drip=model_drip, lookup_type='gte').update(field_value='now-9 days')
+
+        from django.db import connections
+        from drip.utils import watch_queries, unwatch_queries
+
+        connection = connections['default']
+        audience_queries = []
+        def watch(sql, duration):
+            if 'date_joined' in sql:
+                audience_queries.append(sql)
+        watch_queries(connection, watch)
+        try:
+            lines = list(audience_csv_rows([model_drip], ['id', 'email'], chunk_size=1))
+        finally:
+            unwatch_queries(connection, watch)
+        self.assertEqual('drip,id,email\r\n', lines[0])
+        # the rules are evaluated once, not once per chunk
+        self.assertEqual(1, len(audience_queries))
+
+        # the two users sent to already are pruned
+        users = model_drip.drip.get_queryset().exclude(sent_drips__drip=model_drip).order_by('id')
+        self.assertEqual(['A Custom Week Ago,%d,%s\r\n' % (u.id, u.email) for u in users], lines[1:])
+        self.assertEqual(2, len(lines[1:]))
+
+    def test_sent_drip_changelist(self):
+        from django.contrib.admin.sites import AdminSite
+        from django.test.client import RequestFactory
+        from drip.admin import SentDripAdmin
+
+        model_drip = self.build_joined_date_drip()
+        for user in User.objects.all():
+            SentDrip.objects.create(drip=model_drip, user=user, subject='hi', body='hi')
+
+        model_admin = SentDripAdmin(SentDrip, AdminSite())
+        model_admin.list_per_page = 8
+
+        def changelist(**params):
+            request = RequestFactory().get('/', params)
+            ChangeList = model_admin.get_changelist(request)
+            return ChangeList(request, SentDrip, model_admin.list_display, model_admin.list_display_links,
+                              model_admin.list_filter, model_admin.date_hierarchy, model_admin.search_fields,
+                              model_admin.list_select_related, model_admin.list_per_page,
+                              model_admin.list_max_show_all, model_admin.list_editable, model_admin)
+
+        seen = []
+        cl = changelist()
+        self.assertEqual(20, cl.result_count)
+        while True:
+            seen.extend(sent.id for sent in cl.result_list)
+            self.assertTrue(all(sent._deferred for sent in cl.result_list))
+            if not cl.older_url:
+                break
+            cl = changelist(before=str(cl.result_list[-1].id))
+
+        self.assertEqual(list(SentDrip.objects.order_by('-id').values_list('id', flat=True)), seen)
+
+    ##################
+    ### SEND STATS ###
+    ##################
+
+    def test_run_records_stats(self):
+        import json
+        from django.contrib.admin.sites import AdminSite
+        from django.test.client import RequestFactory
+        from drip.admin import DripAdmin
+        from drip.models import SentDripStat
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        self.assertEqual(2, model_drip.drip.run())
+        self.assertEqual(0, model_drip.drip.run(dry_run=True))
+        self.assertEqual([(datetime.now().date(), 2)],
+                         list(SentDripStat.objects.filter(drip=model_drip).values_list('date', 'count')))
+
+        request = RequestFactory().get('/', {'drip': model_drip.id})
+        data = json.loads(DripAdmin(Drip, AdminSite()).stats_json(request).content)
+        self.assertEqual([{'drip_id': model_drip.id, 'drip': model_drip.name,
+                           'date': datetime.now().date().isoformat(), 'count': 2}], data['stats'])
+
+    def test_run_stats_ignore_concurrent_sends(self):
+        from django.db.models.signals import post_save
+        from drip.models import SentDripStat
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+        outsider = User.objects.create(username='outsider', email='outsider@test.com')
+
+        def concurrent_run(sender, instance, created, **kwargs):
+            # another run writes to the same drip while this one sends
+            post_save.disconnect(concurrent_run, sender=SentDrip)
+            SentDrip.objects.create(drip=model_drip, user=outsider, subject='hi', body='hi')
+        post_save.connect(concurrent_run, sender=SentDrip)
+        try:
+            self.assertEqual(2, model_drip.drip.run())
+        finally:
+            post_save.disconnect(concurrent_run, sender=SentDrip)
+
+        self.assertEqual(3, SentDrip.objects.filter(drip=model_drip).count())
+        self.assertEqual([2], list(SentDripStat.objects.filter(drip=model_drip).values_list('count', flat=True)))
+
+    def test_backfill_drip_stats(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from drip.models import SentDripStat
+
+        model_drip = self.build_joined_date_drip()
+        for i, user in enumerate(User.objects.all()[:5]):
+            sent = SentDrip.objects.create(drip=model_drip, user=user, subject='hi', body='hi')
+            SentDrip.objects.filter(id=sent.id).update(date=datetime.now() - timedelta(days=i % 2))
+        SentDripStat.objects.create(drip=model_drip, date=datetime.now().date(), count=100)
+
+        call_command('backfill_drip_stats', model_drip.name, batch_size=2, stdout=StringIO())
+
+        today = datetime.now().date()
+        self.assertEqual([(today, 3), (today - timedelta(days=1), 2)],
+                         list(SentDripStat.objects.filter(drip=model_drip).values_list('date', 'count')))
+
+    ###############
+    ### PREVIEW ###
+    ###############
+
+    def test_rules_hash(self):
+        model_drip = self.build_joined_date_drip()
+        rules_hash = model_drip.rules_hash()
+        self.assertEqual(rules_hash, Drip.objects.get(id=model_drip.id).rules_hash())
+
+        QuerySetRule.objects.filter(drip=model_drip, lookup_type='lt').update(field_value='now-6 days')
+        self.assertNotEqual(rules_hash, model_drip.rules_hash())
+
+    def test_sample_count(self):
+        from drip.utils import sample_count
+
+        qs = User.objects.filter(username__contains='credits_a_day')
+        self.assertEqual(10, sample_count(qs))  # too few users to bother sampling
+        self.assertEqual(10, sample_count(qs, fraction=0.5, windows=2))
+        self.assertEqual(0, sample_count(User.objects.none().filter(id__gt=1000)))
+
+    def test_exact_count(self):
+        from django.core.cache import cache
+        from django.test.utils import override_settings
+
+        cache.clear()
+        model_drip = self.build_joined_date_drip()
+        drip = model_drip.drip
+
+        self.assertEqual((2, 'sample'), drip.estimate_count())
+        with override_settings(DRIP_PREVIEW_ASYNC=False):
+            self.assertEqual(2, drip.exact_count())
+        self.assertEqual(2, cache.get(drip.exact_count_key()))
+
+    ####################
+    ### READ REPLICA ###
+    ####################
+
+    def test_read_database(self):
+        from django.db import connections
+        from django.test.utils import override_settings
+
+        # stand the default connection in as the replica
+        setattr(connections._connections, 'replica', connections['default'])
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        try:
+            with override_settings(DRIP_READ_DATABASE='replica'):
+                drip = model_drip.drip
+                self.assertEqual('replica', drip.get_queryset().db)
+                self.assertEqual(2, drip.run())
+                self.assertEqual(2, SentDrip.objects.using('default').count())
+
+                drip = model_drip.drip
+                self.assertEqual(set(SentDrip.objects.values_list('user_id', flat=True)),
+                                 set(drip.recently_sent_user_ids()))
+                drip.prune()
+                self.assertEqual(0, drip.get_queryset().count())
+        finally:
+            delattr(connections._connections, 'replica')
+
+    #####################
+    ### FREQUENCY CAP ###
+    #####################
+
+    def test_frequency_cap(self):
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+
+        low = self.build_joined_date_drip()
+        high = Drip.objects.create(name='A Custom Week Ago Too', body_html_template='MORE KETTEHS', priority=10)
+        for rule in QuerySetRule.objects.filter(drip=low):
+            QuerySetRule.objects.create(drip=high, field_name=rule.field_name,
+                                        lookup_type=rule.lookup_type, field_value=rule.field_value)
+        Drip.objects.all().update(enabled=True)
+
+        with override_settings(DRIP_FREQUENCY_CAP=1, DRIP_FREQUENCY_CAP_WINDOW='1 day'):
+            call_command('send_drips')
+
+            # the higher priority drip claimed both users first
+            self.assertEqual(2, SentDrip.objects.filter(drip=high).count())
+            self.assertEqual(0, SentDrip.objects.filter(drip=low).count())
+
+            # once the window has passed, the lower priority drip gets its turn
+            SentDrip.objects.update(date=datetime.now() - timedelta(days=2))
+            call_command('send_drips')
+            self.assertEqual(2, SentDrip.objects.filter(drip=low).count())
+
+    ###################
+    ### SENT FILTER ###
+    ###################
+
+    def test_bloom_filter(self):
+        from drip.idsets import BloomFilter
+
+        bloom = BloomFilter.for_capacity(1000)
+        for i in xrange(0, 2000, 2):
+            bloom.add(i)
+
+        copy = BloomFilter.from_string(bloom.num_bits, bloom.num_hashes, bloom.to_string())
+        self.assertTrue(all(i in copy for i in xrange(0, 2000, 2)))
+        false_positives = len([i for i in xrange(1, 2000, 2) if i in copy])
+        self.assertTrue(false_positives < 50, false_positives)
+
+    def test_sent_filter_refresh(self):
+        from django.test.utils import override_settings
+        from drip.models import SentDripFilter
+
+        model_drip = self.build_joined_date_drip()
+        users = list(User.objects.all()[:3])
+        SentDrip.objects.create(drip=model_drip, user=users[0], subject='hi', body='hi')
+        SentDrip.objects.filter(user=users[0]).update(date=datetime.now() - timedelta(days=1))
+
+        with override_settings(DRIP_SENT_FILTER_LAG=3600):
+            sent_filter = SentDripFilter.for_drip(model_drip)
+            settled = SentDrip.objects.get(user=users[0])
+            self.assertEqual(settled.id, sent_filter.max_sentdrip_id)
+            self.assertEqual(1, sent_filter.count)
+
+            # recent sends are in the filter, but the mark waits for them to settle
+            SentDrip.objects.create(drip=model_drip, user=users[1], subject='hi', body='hi')
+            sent_filter = SentDripFilter.for_drip(model_drip)
+            self.assertEqual(settled.id, sent_filter.max_sentdrip_id)
+            self.assertTrue(users[1].id in sent_filter.bloom())
+
+            self.assertEqual(set([users[0].id, users[1].id]),
+                             sent_filter.sent_user_ids([u.id for u in users]))
+
+    def test_prune_with_sent_filter(self):
+        from django.test.utils import override_settings
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        with override_settings(DRIP_SENT_FILTER=True):
+            drip = model_drip.drip
+            user = drip.get_queryset()[0]
+            SentDrip.objects.create(drip=model_drip, user=user, subject='hi', body='hi')
+
+            self.assertEqual(1, model_drip.drip.run())
+            self.assertEqual(0, model_drip.drip.run())
+            self.assertEqual(2, SentDrip.objects.filter(drip=model_drip).count())
+            self.assertTrue(all(u.id in model_drip.sent_filter.bloom()
+                                for u in model_drip.drip.get_queryset()))
+
+    ##############
+    ### CLAIMS ###
+    ##############
+
+    def test_claim(self):
+        from drip.models import SentDripClaim
+
+        model_drip = self.build_joined_date_drip()
+        user_ids = list(User.objects.values_list('id', flat=True))
+
+        self.assertEqual(set(user_ids[:5]), SentDripClaim.claim(model_drip, user_ids[:5], 'first', batch_size=2))
+        self.assertEqual(set(user_ids[5:8]), SentDripClaim.claim(model_drip, user_ids[:8], 'second', batch_size=3))
+        self.assertEqual(set(), SentDripClaim.claim(model_drip, user_ids[:8], 'third'))
+        self.assertEqual(8, SentDripClaim.objects.filter(drip=model_drip).count())
+
+        SentDripClaim.release(model_drip, 'second')
+        self.assertEqual(set(user_ids[5:8]), SentDripClaim.claim(model_drip, user_ids[:8], 'fourth'))
+
+    def test_claimed_sends(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+        sent_already = model_drip.drip.get_queryset()[0]
+        SentDrip.objects.create(drip=model_drip, user=sent_already, subject='hi', body='hi')
+
+        with override_settings(DRIP_CLAIM_SENDS=True, DRIP_CLAIM_SKIP_PRUNE=True):
+            call_command('backfill_drip_claims', stdout=StringIO())
+
+            self.assertEqual(1, model_drip.drip.run())
+            self.assertEqual(0, model_drip.drip.run())
+
+        self.assertEqual(2, SentDrip.objects.filter(drip=model_drip).count())
+        self.assertEqual(1, SentDrip.objects.filter(drip=model_drip, user=sent_already).count())
+
+    def test_failed_run_releases_unsent_claims(self):
+        from django.test.utils import override_settings
+        from drip.models import SentDripClaim
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        drip = model_drip.drip
+        build_email = drip.build_email
+        def build_one_email(user, send=False):
+            if SentDrip.objects.exists():
+                raise ValueError('SMTP went away')
+            return build_email(user, send=send)
+        drip.build_email = build_one_email
+
+        with override_settings(DRIP_CLAIM_SENDS=True):
+            self.assertRaises(ValueError, drip.run)
+            # the user who got it keeps the claim, the other is free again
+            self.assertEqual(list(SentDrip.objects.values_list('user_id', flat=True)),
+                             list(SentDripClaim.objects.values_list('user_id', flat=True)))
+
+            self.assertEqual(1, model_drip.drip.run())
+        self.assertEqual(2, SentDrip.objects.filter(drip=model_drip).count())
+
+    ##############
+    ### OUTBOX ###
+    ##############
+
+    def test_outbox(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+        from drip.models import DripOutbox
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        with override_settings(DRIP_USE_OUTBOX=True):
+            self.assertEqual(2, model_drip.drip.run())
+            self.assertEqual(0, model_drip.drip.run())
+            self.assertEqual(0, SentDrip.objects.count())
+            self.assertEqual(2, DripOutbox.objects.filter(status='pending').count())
+
+            call_command('drain_drip_outbox', batch_size=1, stdout=StringIO())
+            self.assertEqual(2, SentDrip.objects.filter(drip=model_drip).count())
+            self.assertEqual(2, DripOutbox.objects.filter(status='done').count())
+            self.assertEqual(2, model_drip.sent_stats.get().count)
+
+            self.assertEqual(0, model_drip.drip.run())
+
+    def test_outbox_claims(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+        from drip.models import DripOutbox
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        with override_settings(DRIP_USE_OUTBOX=True, DRIP_CLAIM_SENDS=True, DRIP_CLAIM_SKIP_PRUNE=True):
+            self.assertEqual(2, model_drip.drip.run())
+            call_command('drain_drip_outbox', stdout=StringIO())
+            # delivered rows are neither pruned nor queued again
+            self.assertEqual(0, model_drip.drip.run())
+            self.assertEqual(2, DripOutbox.objects.count())
+            self.assertEqual(2, SentDrip.objects.filter(drip=model_drip).count())
+
+    def test_outbox_stale_render_key(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+        from drip.models import DripOutbox
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.save()
+
+        with override_settings(DRIP_USE_OUTBOX=True, DRIP_CLAIM_SENDS=True):
+            self.assertEqual(2, model_drip.drip.run())
+            model_drip.subject_template = 'GOODBYE {{ user.username }}'
+            model_drip.save()
+
+            call_command('drain_drip_outbox', stdout=StringIO())
+            self.assertEqual(0, SentDrip.objects.count())
+            self.assertEqual(2, DripOutbox.objects.filter(status='failed').count())
+
+            # queued again under the new templates
+            self.assertEqual(2, model_drip.drip.run())
+            call_command('drain_drip_outbox', stdout=StringIO())
+            self.assertEqual(['GOODBYE'] * 2, [sent.subject.split()[0] for sent in SentDrip.objects.all()])
+
+    def test_outbox_frequency_cap(self):
+        from django.test.utils import override_settings
+        from drip.models import DripOutbox
+
+        model_drip = self.build_joined_date_drip()
+        other_drip = Drip.objects.create(name='Other', subject_template='hi', body_html_template='hi')
+        capped = model_drip.drip.get_queryset()[0]
+        DripOutbox.objects.create(drip=other_drip, user=capped, render_key='x')
+
+        with override_settings(DRIP_USE_OUTBOX=True, DRIP_FREQUENCY_CAP=1):
+            drip = model_drip.drip
+            drip.prune()
+            self.assertEqual(1, drip.get_queryset().count())
+            self.assertNotIn(capped, drip.get_queryset())
+
+        with override_settings(DRIP_FREQUENCY_CAP=1):
+            drip = model_drip.drip
+            drip.prune()
+            self.assertEqual(2, drip.get_queryset().count())
+
+    def test_outbox_lease(self):
+        from drip.models import DripOutbox
+
+        model_drip = self.build_joined_date_drip()
+        for user in User.objects.all()[:3]:
+            DripOutbox.objects.create(drip=model_drip, user=user, render_key='x')
+
+        first = DripOutbox.lease(batch_size=2)
+        second = DripOutbox.lease(batch_size=2)
+        self.assertEqual(2, len(first))
+        self.assertEqual(1, len(second))
+        self.assertEqual([], DripOutbox.lease())
+
+        # an expired lease goes back up for grabs
+        DripOutbox.objects.filter(id=first[0].id).update(leased_until=datetime.now() - timedelta(seconds=1))
+        self.assertEqual([first[0].id], [row.id for row in DripOutbox.lease()])
+
+    #####################
+    ### USER FEATURES ###
+    #####################
+
+    def test_user_features(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from drip.batch import evaluate_drips
+        from drip.models import UserFeature, connect_feature_models
+
+        features = {
+            'credits': {'model': 'credits.Profile', 'aggregate': 'max', 'field': 'credits'},
+            'joined': {'model': 'auth.User', 'aggregate': 'max', 'field': 'date_joined', 'user_field': 'id'},
+            'profiles': {'model': 'credits.Profile', 'aggregate': 'count'},
+        }
+        with override_connected_settings(connect_feature_models, DRIP_USER_FEATURES=features):
+            call_command('refresh_drip_features', stdout=StringIO())
+            self.assertEqual(20, UserFeature.objects.filter(name='credits').count())
+            self.assertEqual(20, UserFeature.objects.filter(name='joined', value_date__isnull=False).count())
+
+            model_drip = Drip.objects.create(name='Featured', body_html_template='Hi')
+            QuerySetRule.objects.create(drip=model_drip, field_name='feature:credits',
+                                        lookup_type='gte', field_value='100')
+            QuerySetRule.objects.create(drip=model_drip, field_name='feature:joined', method_type='exclude',
+                                        lookup_type='lt', field_value='now-7 days')
+            expected = User.objects.filter(profile__credits__gte=100, date_joined__gte=datetime.now() - timedelta(days=7))
+            self.assertEqual(set(expected), set(model_drip.drip.get_queryset()))
+            self.assertEqual(3, len(expected))
+
+            # saves keep the feature current
+            profile = User.objects.get(username='first_no_credits').get_profile()
+            profile.credits = 500
+            profile.save()
+            self.assertEqual(500, UserFeature.objects.get(name='credits', user=profile.user).value_number)
+            self.assertEqual(4, model_drip.drip.get_queryset().count())
+            self.assertEqual(20, UserFeature.objects.filter(name='credits').count())
+
+            # users left without rows lose their value
+            profile.delete()
+            self.assertFalse(UserFeature.objects.filter(name='credits', user=profile.user).exists())
+            self.assertEqual(3, model_drip.drip.get_queryset().count())
+
+            # though without a row, they still count 0 profiles
+            profileless = Drip.objects.create(name='Profileless', body_html_template='Hi')
+            QuerySetRule.objects.create(drip=profileless, field_name='feature:profiles',
+                                        lookup_type='lt', field_value='1')
+            self.assertEqual([profile.user], list(profileless.drip.get_queryset()))
+            QuerySetRule.objects.create(drip=profileless, field_name='feature:profiles', method_type='exclude',
+                                        lookup_type='exact', field_value='0')
+            self.assertEqual([], list(profileless.drip.get_queryset()))
+
+            # and feature rules evaluate in a batch like any other
+            evaluated = evaluate_drips([model_drip.drip])
+            self.assertEqual(3, evaluated[0].get_queryset().count())
+
+            # parsed once per setting
+            from drip.features import get_features
+            self.assertTrue(get_features() is get_features())
+
+    #######################
+    ### SENT DRIP RULES ###
+    #######################
+
+    def test_sent_drip_rules(self):
+        from django.db import connection
+        from drip.batch import evaluate_drips
+        from drip.models import AudienceView, SentDripRule
+
+        first = self.build_joined_date_drip()
+        first.drip.send()
+        early, late = SentDrip.objects.order_by('id')
+        SentDrip.objects.filter(id=early.id).update(date=datetime.now() - timedelta(days=5))
+        SentDrip.objects.filter(id=late.id).update(date=datetime.now() - timedelta(days=1))
+
+        follow_up = Drip.objects.create(name='Follow up', body_html_template='Hi')
+        rules_hash = follow_up.rules_hash()
+        rule = SentDripRule.objects.create(drip=follow_up, sent_drip=first, older_than='3 days')
+        self.assertNotEqual(rules_hash, follow_up.rules_hash())
+
+        self.assertEqual([early.user_id], [user.id for user in follow_up.drip.get_queryset()])
+
+        rule.older_than, rule.newer_than = '', '2 days'
+        rule.save()
+        self.assertEqual([late.user_id], [user.id for user in follow_up.drip.get_queryset()])
+
+        rule.method_type, rule.newer_than = 'exclude', ''
+        rule.save()
+        expected = set(User.objects.exclude(id__in=[early.user_id, late.user_id]))
+        self.assertEqual(expected, set(follow_up.drip.get_queryset()))
+
+        # evaluated in a batch, and published as a view, they pick the same users
+        self.assertEqual(expected, set(evaluate_drips([follow_up.drip])[0].get_queryset()))
+        cursor = connection.cursor()
+        cursor.execute(AudienceView(drip=follow_up).compile())
+        self.assertEqual(set([user.id for user in expected]), set([row[0] for row in cursor.fetchall()]))
+
+        # nested in another query, the rule stays on the inner user table
+        qs = follow_up.drip.get_queryset()
+        self.assertEqual(0, SentDrip.objects.filter(user__in=qs.values('pk')).count())
+
+    def test_sent_drip_rule_checks(self):
+        from django.core.exceptions import ValidationError
+        from django.db.models.deletion import ProtectedError
+        from drip.models import SentDripRule
+
+        first = self.build_joined_date_drip()
+        follow_up = Drip.objects.create(name='Follow up', body_html_template='Hi')
+        rule = SentDripRule(drip=follow_up, sent_drip=first, older_than='garbage')
+        self.assertRaises(ValidationError, rule.full_clean)
+        rule.older_than = '3 days'
+        rule.full_clean()
+        rule.save()
+
+        self.assertRaises(ProtectedError, first.delete)
+
+    ################
+    ### PIPELINE ###
+    ################
+
+    def test_pipeline(self):
+        from drip.pipeline import Pipeline
+
+        batches = []
+        pipeline = Pipeline(chunk_size=4, flush_size=5, queue_size=1)
+        count = pipeline.run(xrange(25), lambda i: i * 2 if i % 3 else None, batches.append)
+
+        self.assertEqual(25, count)
+        self.assertEqual([i * 2 for i in range(25) if i % 3], sum(batches, []))
+        self.assertTrue(max(map(len, batches)) <= 5)
+
+    def test_pipeline_failures(self):
+        from drip.pipeline import Pipeline
+
+        def broken_items():
+            yield 1
+            raise ValueError('fetch')
+
+        def broken(i):
+            raise ValueError('broken')
+
+        for items, process, flush in [(broken_items(), int, len),
+                                      (xrange(1000), broken, len),
+                                      (xrange(1000), int, broken)]:
+            self.assertRaises(ValueError, Pipeline(chunk_size=10, flush_size=10).run, items, process, flush)
+
+    def test_send_pipelined(self):
+        from django.test.utils import override_settings
+
+        model_drip = self.build_joined_date_drip()
+        with override_settings(DRIP_SEND_PIPELINE=True, DRIP_PIPELINE_CHUNK_SIZE=1):
+            self.assertEqual(2, model_drip.drip.send(dry_run=True))
+            self.assertEqual(0, SentDrip.objects.count())
+            self.assertEqual(2, model_drip.drip.send())
+
+        self.assertEqual(2, SentDrip.objects.filter(drip=model_drip, subject__startswith='HELLO').count())
+
+    #####################
+    ### PENDING USERS ###
+    #####################
+
+    def test_send_drips_pending(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+        from drip.models import PendingUser, connect_eligibility_models
+
+        model_drip = Drip.objects.create(name='Rich', body_html_template='$$$', enabled=True)
+        QuerySetRule.objects.create(drip=model_drip, field_name='profile__credits',
+                                    lookup_type='gte', field_value='200')
+
+        with override_connected_settings(connect_eligibility_models,
+                                         DRIP_ELIGIBILITY_MODELS={'credits.Profile': 'user'}):
+            user = User.objects.get(username='first_no_credits')
+            profile = user.get_profile()
+            profile.credits = 300
+            profile.save()
+            profile.save()
+
+            self.assertEqual([user.id], list(PendingUser.objects.values_list('user_id', flat=True)))
+            call_command('send_drips', pending=True, stdout=StringIO())
+
+        # users who qualified all along weren't pending, so they wait for a full run
+        self.assertEqual([user.id], list(SentDrip.objects.values_list('user_id', flat=True)))
+        self.assertEqual(None, Drip.objects.get(id=model_drip.id).last_run)
+        self.assertEqual(0, PendingUser.objects.count())
+
+        from django.core.management.base import CommandError
+        from drip.management.commands.send_drips import Command
+
+        # only the listed models are connected
+        profile.save()
+        self.assertEqual(0, PendingUser.objects.count())
+
+        with override_settings(DRIP_ELIGIBILITY_MODELS={'credits.Profile': 'user'}):
+            self.assertRaises(CommandError, Command().handle, pending=True, time_budget=60,
+                              batch_evaluate=False, daemon=False, profile=False)
+
+    def test_send_drips_pending_batch_evaluate(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+        from drip.models import PendingUser
+
+        model_drip = Drip.objects.create(name='Rich', body_html_template='$$$', enabled=True)
+        QuerySetRule.objects.create(drip=model_drip, field_name='profile__credits',
+                                    lookup_type='gte', field_value='200')
+
+        user = User.objects.get(username='first_no_credits')
+        PendingUser.enqueue([user.id, User.objects.get(username='tenth_25_credits_a_day').id])
+        user.get_profile().__class__.objects.filter(user=user).update(credits=300)
+
+        call_command('send_drips', pending=True, batch_evaluate=True, stdout=StringIO())
+        self.assertEqual(set([user.id, User.objects.get(username='tenth_25_credits_a_day').id]),
+                         set(SentDrip.objects.values_list('user_id', flat=True)))
+
+    ########################
+    ### BATCH EVALUATION ###
+    ########################
+
+    def build_batch_drips(self):
+        week_ago = self.build_joined_date_drip()
+
+        credits = Drip.objects.create(name='Credits', body_html_template='$$$', enabled=True)
+        QuerySetRule.objects.create(drip=credits, field_name='profile__credits',
+                                    lookup_type='gte', field_value='100')
+        QuerySetRule.objects.create(drip=credits, method_type='exclude', field_name='date_joined',
+                                    lookup_type='lt', field_value='now-6 days')
+
+        no_credits = Drip.objects.create(name='No Credits', body_html_template='...', enabled=True)
+        QuerySetRule.objects.create(drip=no_credits, method_type='exclude', field_name='profile__credits',
+                                    lookup_type='gt', field_value='0')
+
+        everyone = Drip.objects.create(name='Everyone', body_html_template='Hi', enabled=True)
+
+        annotated = Drip.objects.create(name='Annotated', body_html_template='Hi', enabled=True)
+        QuerySetRule.objects.create(drip=annotated, field_name='sent_drips', annotate='count',
+                                    lookup_type='exact', field_value='0')
+
+        many = Drip.objects.create(name='Many', body_html_template='Hi', enabled=True)
+        QuerySetRule.objects.create(drip=many, field_name='sent_drips__drip__name',
+                                    lookup_type='exact', field_value='Everyone')
+
+        Drip.objects.all().update(enabled=True)
+        return [week_ago, credits, no_credits, everyone, annotated, many]
+
+    def test_evaluate_drips(self):
+        from drip.batch import evaluate_drips
+
+        drip_models = self.build_batch_drips()
+        expected = dict((model.name, set(model.drip.get_queryset().values_list('id', flat=True)))
+                        for model in drip_models)
+
+        drips = [model.drip for model in drip_models]
+        evaluated = evaluate_drips(drips)
+        self.assertEqual(['A Custom Week Ago', 'Credits', 'No Credits', 'Everyone'],
+                         [drip.name for drip in evaluated])
+
+        for drip in drips:
+            self.assertEqual(expected[drip.name], set(drip.get_queryset().values_list('id', flat=True)))
+        self.assertEqual(20, len(expected['Everyone']))
+        self.assertEqual(11, len(expected['No Credits']))
+
+    def test_send_drips_batch_evaluate(self):
+        from django.core.management import call_command
+
+        self.build_batch_drips()
+        call_command('send_drips', batch_evaluate=True)
+        batched = sorted(SentDrip.objects.values_list('drip__name', 'user_id'))
+
+        SentDrip.objects.all().delete()
+        call_command('send_drips')
+        self.assertEqual(sorted(SentDrip.objects.values_list('drip__name', 'user_id')), batched)
+
+    ##############
+    ### DAEMON ###
+    ##############
+
+    def test_is_due(self):
+        model_drip = self.build_joined_date_drip()
+        self.assertTrue(model_drip.is_due())
+
+        model_drip.last_run = datetime.now() - timedelta(hours=5)
+        model_drip.send_interval = '6 hours'
+        self.assertFalse(model_drip.is_due())
+        self.assertTrue(model_drip.is_due(now=datetime.now() + timedelta(hours=1)))
+
+        from django.core.exceptions import ValidationError
+        from drip.models import validate_timedelta
+        self.assertRaises(ValidationError, validate_timedelta, '0 days')
+
+    def test_failed_run_waits_its_interval(self):
+        from drip.management.commands.send_drips import Command
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.send_interval = '1 hour'
+        model_drip.subject_template = '{% broken %}'
+        model_drip.save()
+
+        self.assertEqual([], Command().run_due())
+        self.assertTrue(Drip.objects.get(id=model_drip.id).last_run)
+        self.assertEqual(0, SentDrip.objects.count())
+        # not retried on the next tick
+        self.assertFalse(Drip.objects.get(id=model_drip.id).is_due())
+
+    def test_run_due(self):
+        from drip.management.commands.send_drips import Command
+
+        model_drip = self.build_joined_date_drip()
+        model_drip.enabled = True
+        model_drip.send_interval = '1 hour'
+        model_drip.save()
+
+        self.assertEqual([model_drip.name], Command().run_due())
+        self.assertEqual(2, SentDrip.objects.count())
+        self.assertTrue(Drip.objects.get(id=model_drip.id).last_run)
+
+        # not due again for an hour
+        self.assertEqual([], Command().run_due())
+
+        # a bad interval from before validation only skips that drip
+        from django.core.exceptions import ValidationError
+        broken = Drip.objects.create(name='Broken', body_html_template='Hi', enabled=True,
+                                     send_interval='garbage', last_run=datetime.now() - timedelta(days=1))
+        self.assertRaises(ValidationError, broken.full_clean)
+        Drip.objects.filter(id=model_drip.id).update(last_run=None)
+        self.assertEqual([model_drip.name], Command().run_due())
+
+    def test_time_budget(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        model_drip = self.build_joined_date_drip()
+        slow = Drip.objects.create(name='Slow', body_html_template='zzz', priority=10,
+                                   estimated_duration=120)
+        Drip.objects.all().update(enabled=True)
+
+        out = StringIO()
+        call_command('send_drips', time_budget=60, stdout=out)
+        self.assertIn('deferred  Slow', out.getvalue())
+        self.assertIn('ran       A Custom Week Ago', out.getvalue())
+
+        # the slow one never ran, the one that did now has an estimate
+        self.assertEqual(None, Drip.objects.get(id=slow.id).last_run)
+        self.assertTrue(Drip.objects.get(id=model_drip.id).estimated_duration is not None)
+
+    def test_compile_template(self):
+        from drip.drips import compile_template
+
+        self.assertTrue(compile_template('HELLO {{ user.username }}') is compile_template('HELLO {{ user.username }}'))
+
+    def test_partial_template(self):
+        from django.template import Context, Template
+        from django.utils.html import strip_tags
+        from drip.rendering import PartialTemplate
+
+        user = User.objects.get(id=1)
+        sources = [
+            '<h2>This</h2> is an <b>example</b> html <strong>body</strong>.',
+            'HELLO {{ user.username }}, <b>{{ missing|default:"friend" }}</b>',
+            '<a href="mailto:{{ user.email }}">{{ user.email|upper }}</a> & more',
+            '{% if user.is_active %}<p>active</p>{% else %}inactive{% endif %} <i>{{ user.id }}</i>',
+            '{% firstof nothing "<b" %}>bold?{{ user.username }} <i>{{ "x"|default:user.email }}</i>',
+            'trailing <',
+        ]
+        for source in sources:
+            partial = PartialTemplate(source)
+            body, plain = partial.render_with_plain(Context({'user': user}))
+            self.assertEqual(Template(source).render(Context({'user': user})), body)
+            self.assertEqual(strip_tags(body), plain)
+
+        self.assertTrue(PartialTemplate(sources[0]).is_static())
+        self.assertEqual([(u'HELLO ', None), (u', <b>friend</b>', None)],
+                         [piece for piece in PartialTemplate(sources[1]).pieces if piece[1] is None])
+
+    ###############
+    ### ID SETS ###
+    ###############
+
+    def test_idset_algebra(self):
+        from drip.idsets import IdSet
+
+        a = IdSet.from_sorted([1, 2, 2, 3, None, 5, 8])
+        b = IdSet.from_iterable([8, 3, 4, 1])
+        self.assertEqual([1, 2, 3, 5, 8], list(a))
+        self.assertEqual([1, 3, 4, 8], list(b))
+        self.assertEqual([1, 3, 8], list(a.intersection(b)))
+        self.assertEqual([2, 5], list(a.difference(b)))
+        self.assertEqual([1, 2, 3, 4, 5, 8], list(a.union(b)))
+        self.assertEqual([], list(IdSet().union(IdSet())))
+        self.assertTrue(5 in a)
+        self.assertFalse(4 in a)
+
+    def test_subquery_rules(self):
+        from drip.models import SubqueryRule, ExcludeSubqueryRule
+
+        model_drip = Drip.objects.create(name='Big Spenders', body_html_template='$$$')
+        SubqueryRule.objects.create(drip=model_drip, app_name='credits', model_name='Profile',
+                                    field_name='credits', lookup_type='gte', field_value='100')
+        ExcludeSubqueryRule.objects.create(drip=model_drip, app_name='credits', model_name='Profile',
+                                           field_name='credits', lookup_type='gte', field_value='200')
+
+        expected = User.objects.filter(profile__credits__gte=100, profile__credits__lt=200)
+        self.assertEqual(set(expected.values_list('id', flat=True)),
+                         set(model_drip.drip.get_queryset().values_list('id', flat=True)))
+
+        # previews leave subquery rules to the exact count
+        drip = model_drip.drip
+        self.assertEqual((20, 'sample without subquery rules'), drip.estimate_count())
+        self.assertFalse(hasattr(drip, '_queryset'))
+
+    #####################
+    ### INDEX ADVISOR ###
+    #####################
+
+    def test_get_field_index_map(self):
+        from drip.utils import get_field_index_map
+
+        index_map = get_field_index_map(User)
+        self.assertTrue(index_map['id'])
+        self.assertTrue(index_map['username'])
+        self.assertFalse(index_map['date_joined'])
+        self.assertFalse(index_map['profile__credits'])
+
+
+class DripExplainTestCase(TransactionTestCase):
+    """
+    EXPLAIN makes pysqlite commit the open transaction, so these can't
+    run inside a TestCase.
+    """
+    def setUp(self):
+        for i in range(10):
+            user = User.objects.create(username='user_%d' % i, email='user_%d@test.com' % i)
+            User.objects.filter(id=user.id).update(date_joined=datetime.now() - timedelta(days=i, hours=2))
+
+    def test_drip_explain_command(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.db import connections
+
+        model_drip = Drip.objects.create(name='A Custom Week Ago', body_html_template='KETTEHS ROCK!')
+        QuerySetRule.objects.create(
+            drip=model_drip,
+            field_name='date_joined',
+            lookup_type='lt',
+            field_value='now-7 days'
+        )
+        QuerySetRule.objects.create(
+            drip=model_drip,
+            field_name='profile__credits',
+            lookup_type='gte',
+            field_value='5'
+        )
+
+        out = StringIO()
+        call_command('drip_explain', str(model_drip.id), stdout=out)
+        output = out.getvalue()
+
+        self.assertIn('== get_queryset ==', output)
+        self.assertIn('== prune ==', output)
+        self.assertIn('User.date_joined: no index', output)
+        self.assertIn('User.profile__credits: no index', output)
+
+        from django.core.management.base import CommandError
+        from drip.management.commands.drip_explain import Command
+        from drip.utils import watch_queries, unwatch_queries
+
+        model_drip.enabled = True
+        model_drip.save()
+        out = StringIO()
+        statements = []
+        def watch(sql, duration):
+            statements.append(sql)
+        connection = connections['default']
+        watch_queries(connection, watch)
+        try:
+            call_command('drip_explain', all=True, stdout=out)
+        finally:
+            unwatch_queries(connection, watch)
+        self.assertIn(model_drip.name, out.getvalue())
+        self.assertIn('== no planner cost ==', out.getvalue())
+        # no counts, nothing written: only the rules are read, then explained
+        self.assertEqual(['EXPLAIN'], [sql.split()[0] for sql in statements if 'auth_user' in sql])
+        self.assertEqual([], [sql for sql in statements if sql.split()[0] in ('INSERT', 'UPDATE', 'DELETE', 'CREATE')])
+
+        self.assertRaises(CommandError, Command().handle, all=True, analyze=True)
+
+
+class BenchmarkTestCase(TestCase):
+    def test_run_benchmark(self):
+        from drip.benchmarks import run_benchmark
+
+        report = run_benchmark(200)
+
+        self.assertEqual(200, report['size'])
+        self.assertEqual(200, User.objects.count())
+        for phase in ('populate', 'audience', 'prune', 'render', 'record'):
+            self.assertIn('rows_per_second', report['results'][phase])
+        self.assertTrue(report['results']['audience']['rows'] >= report['results']['prune']['rows'])
+        self.assertEqual(report['results']['prune']['rows'], report['results']['record']['rows'])
+
+
+class IdSetTempTableTestCase(TransactionTestCase):
+    """
+    Creating temporary tables makes pysqlite commit the open transaction.
+    """
+    def test_temp_table_subquery_rules(self):
+        from django.test.utils import override_settings
+        from drip.models import SubqueryRule, ExcludeSubqueryRule
+
+        for i in range(10):
+            user = User.objects.create(username='user_%d' % i, email='user_%d@test.com' % i)
+            user.get_profile().__class__.objects.filter(user=user).update(credits=i * 25)
+
+        model_drip = Drip.objects.create(name='Big Spenders', body_html_template='$$$', enabled=True)
+        SubqueryRule.objects.create(drip=model_drip, app_name='credits', model_name='Profile',
+                                    field_name='credits', lookup_type='gte', field_value='50')
+        ExcludeSubqueryRule.objects.create(drip=model_drip, app_name='credits', model_name='Profile',
+                                           field_name='credits', lookup_type='gte', field_value='200')
+
+        with override_settings(DRIP_IDSET_TEMP_TABLE_THRESHOLD=2):
+            drip = model_drip.drip
+            self.assertIn('drip_idset_', str(drip.get_queryset().query))
+            self.assertEqual(6, drip.get_queryset().count())
+
+            self.assertEqual(6, drip.run())
+            self.assertEqual(6, SentDrip.objects.count())
+            self.assertEqual([], drip._temp_tables)
+
+            # nested, as prune does, the ids stay on the inner query's alias
+            qs = drip.get_queryset()
+            self.assertEqual(6, SentDrip.objects.filter(user__in=qs.values('pk')).count())
+            self.assertNotIn('"auth_user"."id" IN (SELECT id FROM', str(
+                SentDrip.objects.filter(user__in=qs.values('pk')).query))
+            drip.drop_temp_tables()
+
+
+class AudienceViewTestCase(TransactionTestCase):
+    """
+    Creating views makes pysqlite commit the open transaction.
+    """
+    def setUp(self):
+        for i in range(10):
+            user = User.objects.create(username='user_%d' % i, email='user_%d@test.com' % i)
+            User.objects.filter(id=user.id).update(date_joined=datetime.now() - timedelta(days=i, hours=1))
+            user.get_profile().__class__.objects.filter(user=user).update(credits=i * 25)
+
+        self.model_drip = Drip.objects.create(name='Viewed', body_html_template='Hi', enabled=True)
+        QuerySetRule.objects.create(drip=self.model_drip, field_name='date_joined',
+                                    lookup_type='lt', field_value='now-2 days')
+        QuerySetRule.objects.create(drip=self.model_drip, field_name='profile__credits',
+                                    lookup_type='lte', field_value='150')
+
+    def test_audience_view(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.db import connection
+        from drip.models import AudienceView
+
+        expected = set(self.model_drip.drip.get_queryset().values_list('id', flat=True))
+        self.assertEqual(5, len(expected))
+
+        call_command('refresh_drip_views', self.model_drip.name, create=True, stdout=StringIO())
+        view = AudienceView.objects.get(drip=self.model_drip)
+        self.assertEqual('VIEW', view.kind)
+        self.assertTrue(view.is_usable())
+
+        qs = self.model_drip.drip.get_queryset()
+        self.assertTrue('drip_audience_%d' % self.model_drip.id in str(qs.query))
+        self.assertEqual(expected, set(qs.values_list('id', flat=True)))
+        self.assertEqual(5, self.model_drip.drip.run())
+
+        # changing a rule leaves the view unused until it's refreshed
+        rule = QuerySetRule.objects.get(drip=self.model_drip, lookup_type='lte')
+        rule.field_value = '100'
+        rule.save()
+        self.assertFalse(AudienceView.objects.get(id=view.id).is_usable())
+        call_command('refresh_drip_views', self.model_drip.name, stdout=StringIO())
+        self.assertTrue(AudienceView.objects.get(id=view.id).is_usable())
+        cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM drip_audience_%d' % self.model_drip.id)
+        self.assertEqual(3, cursor.fetchone()[0])
+
+        call_command('refresh_drip_views', self.model_drip.name, drop=True, stdout=StringIO())
+        self.assertEqual(0, AudienceView.objects.count())
+        self.assertFalse('drip_audience_' in str(self.model_drip.drip.get_queryset().query))
+
+    def test_admin_refresh_failure(self):
+        from django.contrib.admin.sites import AdminSite
+        from django.test.client import RequestFactory
+        from django.test.utils import override_settings
+        from drip.admin import DripAdmin, refresh_audience_views
+        from drip.models import AudienceView, SubqueryRule
+
+        view = AudienceView.objects.create(drip=self.model_drip)
+        view.refresh()
+        self.addCleanup(AudienceView.objects.filter(id=view.id).delete)
+        SubqueryRule.objects.create(drip=self.model_drip, app_name='credits', model_name='Profile',
+                                    field_name='credits', lookup_type='gte', field_value='0')
+
+        messages = []
+        modeladmin = DripAdmin(Drip, AdminSite())
+        modeladmin.message_user = lambda request, message: messages.append(message)
+        with override_settings(DRIP_IDSET_TEMP_TABLE_THRESHOLD=2):
+            refresh_audience_views(modeladmin, RequestFactory().post('/'), Drip.objects.all())
+
+        self.assertIn('too many subquery rule users', messages[0])
+        self.assertEqual('Refreshed 0 audience view(s).', messages[1])
+        self.assertFalse(AudienceView.objects.get(id=view.id).is_usable())
+
+
+class GuardTestCase(TransactionTestCase):
+    """
+    Timeouts roll back, which TestCase's transaction can't show.
+    """
+    def setUp(self):
+        for i in range(4):
+            User.objects.create(username='user_%d' % i, email='user_%d@test.com' % i)
+        self.model_drip = Drip.objects.create(name='Guarded', subject_template='HELLO {{ user.username }}',
+                                              body_html_template='Hi', enabled=True)
+
+    def test_statement_timeout(self):
+        from django.db import connection
+        from drip.guards import Guard, DripTimeout
+
+        runaway = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT COUNT(*) FROM c'
+        try:
+            with Guard(statement_timeout=0.05, using=['default'], read_using='default'):
+                connection.cursor().execute(runaway)
+        except DripTimeout as e:
+            self.assertEqual(runaway, e.sql)
+        else:
+            self.fail('The runaway query was not interrupted')
+
+        # the handler is gone again
+        connection.cursor().execute('SELECT COUNT(*) FROM auth_user')
+
+    def test_settle_keeps_the_run(self):
+        from django.db import connection
+        from drip.guards import Guard
+
+        queries = len(connection.queries)
+        try:
+            with Guard(time_limit=60, using=['default'], read_using='default') as guard:
+                SentDrip.objects.create(drip=self.model_drip, user=User.objects.all()[0], subject='', body='')
+                guard.settle()
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertEqual(1, SentDrip.objects.count())
+        # statements are watched, not logged
+        self.assertEqual(queries, len(connection.queries))
+
+    def test_time_limit_rolls_back(self):
+        import time
+        from django.test.utils import override_settings
+        from drip.guards import DripTimeout
+
+        drip = self.model_drip.drip
+        render_email = drip.render_email
+        def slow_render(user):
+            time.sleep(0.3)
+            return render_email(user)
+        drip.render_email = slow_render
+
+        with override_settings(DRIP_TIME_LIMIT=0.2):
+            self.assertRaises(DripTimeout, drip.run)
+
+        # the first user's SentDrip went with the rest of the run
+        self.assertEqual(0, SentDrip.objects.count())
+        self.assertTrue(Drip.objects.get(id=self.model_drip.id).failed)
+
+    def test_send_drips_moves_on(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from django.test.utils import override_settings
+
+        Drip.objects.create(name='Also guarded', body_html_template='Hi', enabled=True)
+        with override_settings(DRIP_TIME_LIMIT=1e-9):
+            call_command('send_drips', stdout=StringIO())
+        self.assertEqual(2, Drip.objects.filter(failed=True).count())
+        self.assertEqual(0, SentDrip.objects.count())
+
+        call_command('send_drips', stdout=StringIO())
+        self.assertEqual(0, Drip.objects.filter(failed=True).count())
+        self.assertEqual(8, SentDrip.objects.count())
@@ -1,3 +1,5 @@
+from time import time
+
 from django.db.models import ForeignKey, OneToOneField, ManyToManyField
 from django.db.models.related import RelatedObject
 
@@ -93,3 +95,350 @@ def give_model_field(full_field, Model):
 def get_simple_fields(Model, **kwargs):
     return [[f[0], f[3].__name__] for f in get_fields(Model, **kwargs)]
 
+
+def get_field_index_map(Model, **kwargs):
+    """
+    Given a Model, return a dict of full field keys (as walked by
+    `get_fields`) to whether the column behind that key is indexed:
+
+    {'username': True, 'date_joined': False, 'profile__credits': False, ...}
+
+    Reverse relations and many to many fields are joined on a foreign key,
+    so they count as indexed whenever that foreign key is.
+    """
+    index_map = {}
+
+    for full_key, name, _Model, _ModelField in get_fields(Model, **kwargs):
+        field, model, direct, m2m = _Model._meta.get_field_by_name(name)
+        if m2m:
+            indexed = True
+        elif not direct:
+            indexed = field.field.db_index or field.field.unique
+        else:
+            indexed = field.primary_key or field.unique or field.db_index
+        index_map[full_key] = bool(indexed)
+
+    return index_map
+
+def explain_queryset(qs, analyze=False):
+    """
+    Run EXPLAIN for a queryset on whichever backend it is bound to.
+
+    Returns a list of plan lines as strings. ANALYZE actually runs the
+    query, and is ignored on backends that don't support it.
+    """
+    from django.db import connections
+
+    connection = connections[qs.db]
+    sql, params = qs.query.sql_with_params()
+
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN'
+    elif connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE' if analyze else 'EXPLAIN'
+    elif connection.vendor == 'mysql':
+        prefix = 'EXPLAIN'
+    else:
+        raise NotImplementedError('EXPLAIN is not supported on `{0}`.'.format(connection.vendor))
+
+    # note that pysqlite commits any open transaction before an EXPLAIN
+    cursor = connection.cursor()
+    cursor.execute('%s %s' % (prefix, sql), params)
+    return ['\t'.join([unicode(col) for col in row]) for row in cursor.fetchall()]
+
+def get_plan_cost(plan):
+    """
+    Given the output of `explain_queryset`, return the planner's total
+    estimated cost, or None if the backend doesn't report one.
+    """
+    import re
+
+    for line in plan:
+        match = re.search(r'cost=[\d.]+\.\.([\d.]+)', line)
+        if match:
+            return float(match.group(1))
+    return None
+
+def iter_keyset(qs, fields, chunk_size=1000):
+    """
+    Yield values_list rows of `fields` from qs in primary key order, a
+    chunk at a time, seeking past the last key seen instead of using
+    OFFSET. Memory stays at one chunk however big qs is.
+    """
+    pk_name = qs.model._meta.pk.name
+    fields = list(fields)
+    pk_index = fields.index(pk_name) if pk_name in fields else None
+    if pk_index is None:
+        fields.append(pk_name)
+
+    last_pk = None
+    while True:
+        chunk = qs
+        if last_pk is not None:
+            chunk = chunk.filter(**{'%s__gt' % pk_name: last_pk})
+        rows = list(chunk.order_by(pk_name).values_list(*fields)[:chunk_size])
+        if not rows:
+            return
+
+        for row in rows:
+            yield row if pk_index is not None else row[:-1]
+        last_pk = rows[-1][pk_index if pk_index is not None else -1]
+
+def get_plan_rows(plan):
+    """
+    Given the output of `explain_queryset`, return the planner's row
+    estimate for the whole query, or None if the backend doesn't give one.
+    """
+    import re
+
+    for line in plan:
+        match = re.search(r'rows=(\d+)', line)
+        if match:
+            return int(match.group(1))
+    return None
+
+def sample_count(qs, fraction=0.01, windows=10):
+    """
+    Estimate qs.count() by counting only inside `windows` primary key
+    ranges spread evenly over the table, covering `fraction` of the key
+    space between them, and scaling back up.
+
+    Spreading the windows keeps old and new rows (eg. date_joined rules)
+    fairly represented, and each window is an index range scan.
+    """
+    import operator
+    from django.db.models import Max, Min, Q
+
+    pk_name = qs.model._meta.pk.name
+    bounds = qs.model._default_manager.using(qs.db).aggregate(low=Min(pk_name), high=Max(pk_name))
+    if bounds['low'] is None:
+        return 0
+
+    span = bounds['high'] - bounds['low'] + 1
+    width = int(span * fraction / windows)
+    if width < 1:
+        return qs.count()
+
+    step = span // windows
+    where = reduce(operator.or_, [
+        Q(**{'%s__range' % pk_name: (bounds['low'] + i * step, bounds['low'] + i * step + width - 1)})
+        for i in range(windows)
+    ])
+
+    return int(qs.filter(where).count() * span / float(width * windows))
+
+def estimate_count(qs):
+    """
+    Returns (count, method): a quick guess at qs.count(), from the planner
+    where the backend gives row estimates, otherwise by `sample_count`.
+    """
+    from django.db import connections
+
+    if connections[qs.db].vendor == 'postgresql':
+        rows = get_plan_rows(explain_queryset(qs))
+        if rows is not None:
+            return rows, 'planner'
+    return sample_count(qs), 'sample'
+
+def inline_sql(qs):
+    """
+    The SQL of qs with its parameters quoted into it, for statements that
+    can't take parameters, like CREATE VIEW ... AS.
+    """
+    import datetime
+    import decimal
+    from django.db import connections
+
+    connection = connections[qs.db]
+    sql, params = qs.query.get_compiler(qs.db).as_sql()
+
+    if connection.vendor == 'postgresql':
+        return connection.cursor().mogrify(sql, params)
+    if connection.vendor == 'mysql':
+        connection.cursor()  # make sure it's connected
+        return sql % tuple([connection.connection.literal(param) for param in params])
+
+    def quote(value):
+        if value is None:
+            return 'NULL'
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, (int, long, float, decimal.Decimal)):
+            return str(value)
+        if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+            value = unicode(value)
+        return "'%s'" % unicode(value).replace("'", "''")
+    return sql % tuple([quote(param) for param in params])
+
+def bulk_insert_ignore(model, fields, rows, using=None, batch_size=200):
+    """
+    Insert rows (tuples of values for `fields`, ids for foreign keys) into
+    model's table, silently skipping any that break a unique constraint.
+    """
+    from django.db import connections, router, transaction, IntegrityError
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+
+    insert = {
+        'postgresql': 'INSERT INTO %s (%s) VALUES %%s ON CONFLICT DO NOTHING',
+        'mysql': 'INSERT IGNORE INTO %s (%s) VALUES %%s',
+        'sqlite': 'INSERT OR IGNORE INTO %s (%s) VALUES %%s',
+    }.get(connection.vendor)
+
+    rows = list(rows)
+    if insert is None:
+        attnames = [opts.get_field(name).attname for name in fields]
+        for row in rows:
+            sid = transaction.savepoint(using=using)
+            try:
+                model.objects.using(using).create(**dict(zip(attnames, row)))
+                transaction.savepoint_commit(sid, using=using)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=using)
+        return
+
+    insert = insert % (qn(opts.db_table), ', '.join([qn(opts.get_field(name).column) for name in fields]))
+    placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+    cursor = connection.cursor()
+    for start in xrange(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        cursor.execute(insert % ', '.join([placeholders] * len(batch)), [value for row in batch for value in row])
+    transaction.commit_unless_managed(using=using)
+
+def bulk_upsert(model, fields, key_fields, rows, using=None, batch_size=200):
+    """
+    Insert rows (tuples of values for `fields`, ids for foreign keys) into
+    model's table, overwriting the rows that match on the unique
+    `key_fields` in the same statement, so there's no moment when the
+    row is missing.
+    """
+    from django.db import connections, router, transaction, IntegrityError
+
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    columns = [qn(opts.get_field(name).column) for name in fields]
+    keys = [qn(opts.get_field(name).column) for name in key_fields]
+    updates = [column for column in columns if column not in keys]
+
+    insert = {
+        'postgresql': 'INSERT INTO %%s (%%s) VALUES %%%%s ON CONFLICT (%s) DO UPDATE SET %s' % (
+            ', '.join(keys), ', '.join(['%s = EXCLUDED.%s' % (column, column) for column in updates])),
+        'mysql': 'INSERT INTO %%s (%%s) VALUES %%%%s ON DUPLICATE KEY UPDATE %s' % (
+            ', '.join(['%s = VALUES(%s)' % (column, column) for column in updates])),
+        'sqlite': 'INSERT OR REPLACE INTO %s (%s) VALUES %%s',
+    }.get(connection.vendor)
+
+    rows = list(rows)
+    if insert is None:
+        attnames = [opts.get_field(name).attname for name in fields]
+        for row in rows:
+            values = dict(zip(attnames, row))
+            lookup = dict((opts.get_field(name).attname, values.pop(opts.get_field(name).attname))
+                          for name in key_fields)
+            if model.objects.using(using).filter(**lookup).update(**values):
+                continue
+            sid = transaction.savepoint(using=using)
+            try:
+                model.objects.using(using).create(**dict(lookup, **values))
+                transaction.savepoint_commit(sid, using=using)
+            except IntegrityError:
+                # inserted since the update, so update after all
+                transaction.savepoint_rollback(sid, using=using)
+                model.objects.using(using).filter(**lookup).update(**values)
+        return
+
+    insert = insert % (qn(opts.db_table), ', '.join(columns))
+    placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+    cursor = connection.cursor()
+    for start in xrange(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        cursor.execute(insert % ', '.join([placeholders] * len(batch)), [value for row in batch for value in row])
+    transaction.commit_unless_managed(using=using)
+
+class AliasedWhere(object):
+    """
+    A raw WHERE condition on the base table of a query, written with
+    `{pk}` for its primary key column. Unlike `extra(where=...)` it is
+    relabelled along with the query, eg. to U0 once the queryset is
+    nested in another as a subquery.
+    """
+    def __init__(self, sql, params, alias, column):
+        self.sql = sql
+        self.params = list(params)
+        self.alias = alias
+        self.column = column
+
+    def as_sql(self, qn=None, connection=None):
+        pk = '%s.%s' % (qn(self.alias), connection.ops.quote_name(self.column))
+        return self.sql.replace('{pk}', pk), self.params
+
+    def relabel_aliases(self, change_map):
+        self.alias = change_map.get(self.alias, self.alias)
+
+def where_pk(qs, sql, params=()):
+    """
+    Filter qs by a raw condition on its primary key, `{pk}` in sql.
+    """
+    from django.db.models.sql.where import AND
+
+    qs = qs._clone()
+    alias = qs.query.get_initial_alias()
+    qs.query.where.add(AliasedWhere(sql, params, alias, qs.model._meta.pk.column), AND)
+    return qs
+
+class WatchedCursor(object):
+    """
+    Wraps a connection's cursor to tell its query watchers about each
+    statement, without keeping them all the way the debug cursor does.
+    """
+    def __init__(self, cursor, db, watchers):
+        self.cursor = cursor
+        self.db = db
+        self.watchers = watchers
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=()):
+        start = time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.notify(self.db.ops.last_executed_query(self.cursor, sql, params), time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.notify(sql, time() - start)
+
+    def notify(self, sql, duration):
+        for watcher in list(self.watchers):
+            watcher(sql, duration)
+
+def watch_queries(connection, watcher):
+    """
+    Call watcher(sql, duration) after every statement connection runs,
+    whether or not it uses the debug cursor, until `unwatch_queries`.
+    """
+    watchers = connection.__dict__.setdefault('drip_query_watchers', [])
+    if not watchers:
+        cursor = connection.__class__.cursor
+        connection.cursor = lambda: WatchedCursor(cursor(connection), connection, watchers)
+    watchers.append(watcher)
+
+def unwatch_queries(connection, watcher):
+    watchers = connection.__dict__.get('drip_query_watchers', [])
+    if watcher in watchers:
+        watchers.remove(watcher)
+    if not watchers:
+        connection.__dict__.pop('cursor', None)